@@ -0,0 +1,364 @@
+# ----------------------- BENCHMARK SCRIPT -----------------------
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" This is the python script of the benchmarks of the guide module and of
+the hot paths of the bot. It runs without network: the city graphs are
+synthetic (a grid and a random geometric graph of the given sizes) plus the
+saved graph of a real city if there is one, and the images are rendered
+with blank tiles.
+
+The results are written as JSON, so runs can be compared over time:
+
+    python3 benchmark.py --sizes 30 100 --output before.json """
+
+
+import os  # standard library
+import sys
+import json
+import math
+import time
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+import statistics
+
+import networkx as nx  # 3rd party packages
+import numpy as np
+from haversine import haversine
+
+import bot  # local source
+import compact
+import guide
+import registry
+import tiles
+
+
+__title__ = "Benchmark"
+__author__ = "Pau Matas and Tomás Gadea"
+__maintainer__ = "Pau Matas and Tomás Gadea"
+__email__ = "paumatasalbi@gmail.com and 01tomas.gadea@gmail.com"
+__status__ = "Production"
+
+
+ORIGIN = (41.38, 2.15)  # south west corner of the synthetic cities
+BLOCK = 100.0  # meters between neighbour nodes of the grid city
+STREETS = 200  # street names of the geometric city (see _street_name)
+
+
+# ---------------------------- Synthetic cities --------------------------
+
+
+def grid_city(side, seed=0):
+    """ Returns a networkx graph like the ones of osmnx: a side x side grid of
+    two-way streets, BLOCK meters apart, with lengths, bearings and names.
+    """
+
+    rng = random.Random(seed)
+    dlat, dlon = _degrees(BLOCK)
+    coords = {i * side + j: (ORIGIN[0] + i * dlat, ORIGIN[1] + j * dlon)
+              for i in range(side) for j in range(side)}
+
+    edges = []
+    for i in range(side):
+        for j in range(side):
+            if j + 1 < side:
+                edges.append((i * side + j, i * side + j + 1, i))
+            if i + 1 < side:
+                edges.append((i * side + j, (i + 1) * side + j, side + j))
+    return _city('grid-%d' % side, coords, edges, rng)
+
+
+def geometric_city(n, seed=0):
+    """ Returns a networkx graph like the ones of osmnx: a random geometric
+    graph of n nodes in a square of the density of the grid city (only its
+    largest connected component, so every route exists). """
+
+    rng = random.Random(seed)
+    side = math.sqrt(n) * BLOCK  # meters
+    radius = 1.5 / math.sqrt(n)  # about 7 neighbours per node
+    geometric = nx.random_geometric_graph(n, radius, seed=seed)
+    geometric = geometric.subgraph(max(nx.connected_components(geometric),
+                                       key=len))
+
+    dlat, dlon = _degrees(side)
+    coords = {node: (ORIGIN[0] + y * dlat, ORIGIN[1] + x * dlon)
+              for node, (x, y) in geometric.nodes(data='pos')}
+    edges = [(u, v, rng.randrange(STREETS)) for u, v in geometric.edges]
+    return _city('geometric-%d' % n, coords, edges, rng)
+
+
+# ------------------------------ Benchmarks ------------------------------
+
+
+def run(graph, name, repeat=20, seed=0):
+    """ Runs every benchmark on a graph and returns the list of results (see
+    measure). The graph is a networkx graph or the directory of a saved one.
+    """
+
+    rng = random.Random(seed)
+    directory = tempfile.mkdtemp(prefix='benchmark-')
+    graphs = bot.graphs
+    try:
+        if isinstance(graph, str):
+            path = graph
+        else:
+            path = os.path.join(directory, 'city.cg')
+            guide.save_graph(compact.from_networkx(graph, name), path)
+
+        results = [measure(name, 'load_graph', repeat,
+                           lambda: guide.load_graph(path))]
+        graph = guide.load_graph(path)
+        bot.graphs = _Graphs(graph)  # the graph of every journey
+        info = {'nodes': graph.number_of_nodes(),
+                'edges': graph.number_of_edges()}
+
+        south, west, north, east = graph.bounds()
+        pairs = [((rng.uniform(south, north), rng.uniform(west, east)),
+                  (rng.uniform(south, north), rng.uniform(west, east)))
+                 for i in range(repeat)]
+        points = [pair[0] for pair in pairs]
+        cycle = _cycle(pairs)
+        cycle_points = _cycle(points)
+
+        results.append(measure(name, '_closest_node_to', repeat,
+                               lambda: guide._closest_node_to(
+                                   graph, next(cycle_points))))
+
+        results.append(measure(name, 'get_directions', repeat,
+                               lambda: guide.get_directions(
+                                   graph, *next(cycle)),
+                               setup=guide.routes.invalidate))
+
+        results.append(measure(name, 'get_directions_cached', repeat,
+                               lambda: guide.get_directions(
+                                   graph, *pairs[0])))
+
+        paths = [guide._shortest_path(graph,
+                                      guide._closest_node_to(graph, a),
+                                      guide._closest_node_to(graph, b))
+                 for a, b in pairs]
+        cycle_paths = _cycle(list(zip(paths, pairs)))
+
+        def from_path():
+            path, (source, destination) = next(cycle_paths)
+            guide._from_path_to_directions(graph, path, source, destination)
+
+        results.append(measure(name, '_from_path_to_directions', repeat,
+                               from_path))
+
+        source, destination = pairs[0]
+        directions = guide.get_directions(graph, source, destination)
+        results.append(measure(name, 'plot_directions', max(1, repeat // 4),
+                               lambda: guide.plot_directions(
+                                   graph, source, destination, directions)))
+
+        results.append(measure(name, 'common_where', repeat,
+                               _journey(graph, source, destination,
+                                        directions)))
+
+        for result in results:
+            result.update(info)
+        return results
+
+    finally:
+        bot.graphs = graphs
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def measure(graph, benchmark, repeat, function, setup=None):
+    """ Runs function repeat times (calling setup before each run, out of the
+    measure) and returns a dict with the min, median, mean and max seconds.
+    """
+
+    times = []
+    for i in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+
+    return {'graph': graph, 'benchmark': benchmark, 'repeat': repeat,
+            'min': min(times), 'median': statistics.median(times),
+            'mean': statistics.mean(times), 'max': max(times)}
+
+
+# ------------------------------ Private functions -----------------------
+
+
+def _city(name, coords, edges, rng):
+    """ Returns the osmnx-like MultiDiGraph with the given node coordinates
+    and two-way edges (u, v, street name number). """
+
+    graph = nx.MultiDiGraph(name=name)
+    for node, (lat, lon) in coords.items():
+        graph.add_node(node, y=lat, x=lon, osmid=node)
+
+    for u, v, street in edges:
+        length = haversine(coords[u], coords[v], unit='m') * \
+            rng.uniform(1.0, 1.2)
+        for a, b in ((u, v), (v, u)):
+            graph.add_edge(a, b, length=length, name=_street_name(street),
+                           bearing=_bearing(coords[a], coords[b]))
+    return graph
+
+
+def _street_name(street):
+    """ Returns the name of the street with number street. """
+
+    return "Carrer %d" % street
+
+
+def _degrees(meters):
+    """ Returns the degrees of latitude and longitude of meters at ORIGIN. """
+
+    dlat = math.degrees(meters / guide.EARTH_RADIUS)
+    return dlat, dlat / math.cos(math.radians(ORIGIN[0]))
+
+
+def _bearing(a, b):
+    """ Returns the compass bearing (degrees) from a to b (lat,long). """
+
+    lat1, lat2 = math.radians(a[0]), math.radians(b[0])
+    dlon = math.radians(b[1] - a[1])
+    x = math.sin(dlon) * math.cos(lat2)
+    y = math.cos(lat1) * math.sin(lat2) - \
+        math.sin(lat1) * math.cos(lat2) * math.cos(dlon)
+    return math.degrees(math.atan2(x, y)) % 360
+
+
+def _cycle(items):
+    """ Returns an endless iterator over items. """
+
+    while True:
+        for item in items:
+            yield item
+
+
+def _journey(graph, source, destination, directions):
+    """ Returns a function that handles (with bot.common_where) the next
+    location of a user walking the journey: its checkpoints and the middle
+    of its streets, with a fake telegram conversation. """
+
+    context = _Context()
+    bot.store(context, 'benchmark', destination, directions, 'benchmark')
+    context.user_data['location'] = source
+    context.user_data['test'] = False
+
+    walk = []
+    for section in directions[:-1]:
+        walk.append(section['src'])
+        walk.append(tuple((np.array(section['src']) +
+                           np.array(section['mid'])) / 2))
+    locations = _cycle(walk)
+    update = _Update()
+
+    def where():
+        loc = context.user_data['location'] = next(locations)
+        if loc == walk[0]:  # start the journey again
+            context.user_data['checkpoint'] = 0
+        bot.common_where(update, context, loc)
+
+    return where
+
+
+class _Context:
+    """ Stand-in for the telegram CallbackContext of a conversation. """
+
+    def __init__(self):
+        self.user_data = {}
+        self.bot = _Bot()
+        self.args = []
+
+
+class _Update:
+    """ Stand-in for the telegram Update of a location message. """
+
+    class effective_chat:
+        id = 0
+        first_name = 'benchmark'
+
+
+class _Bot:
+    """ Stand-in for the telegram Bot: messages are dropped. """
+
+    def send_message(self, **kwargs):
+        pass
+
+    def send_photo(self, **kwargs):
+        pass
+
+
+class _Graphs:
+    """ Stand-in for the bot's GraphRegistry serving a single graph. """
+
+    def __init__(self, graph):
+        self.graph = graph
+
+    def get(self, place=None, timeout=None):
+        return self.graph
+
+    def city_of(self, location):
+        return None
+
+
+# --------------------------------- Main ---------------------------------
+
+
+def main():
+    """ Runs the benchmarks of the synthetic cities (and of the saved city
+    graphs found in the current directory) and writes the results as JSON.
+    """
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[30, 100],
+                        help='sides of the grid cities (the geometric '
+                        'cities have as many nodes)')
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--graph', action='append', default=[],
+                        help='saved compact graph to benchmark too')
+    parser.add_argument('--output', help='JSON file (default: stdout)')
+    args = parser.parse_args()
+
+    # No network: blank tiles and no geocoding.
+    guide.tile_cache = tiles.TileCache(directory=None, offline=True)
+
+    graphs = [(grid_city(side, args.seed), 'grid-%d' % side)
+              for side in args.sizes]
+    graphs += [(geometric_city(side * side, args.seed),
+                'geometric-%d' % (side * side)) for side in args.sizes]
+
+    saved = args.graph or [registry.city_filename(place) + '.cg'
+                           for place in bot.cities]
+    graphs += [(path, os.path.basename(path)) for path in saved
+               if compact.is_compact(path)]
+
+    results = []
+    for graph, name in graphs:
+        print('benchmarking', name, file=sys.stderr)
+        results += run(graph, name, args.repeat, args.seed)
+
+    report = {'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'python': platform.python_version(),
+              'numpy': np.__version__,
+              'machine': platform.machine(),
+              'results': results}
+
+    text = json.dumps(report, indent=2)
+    if args.output is None:
+        print(text)
+    else:
+        f = open(args.output, 'w')  # open on write mode
+        f.write(text + '\n')
+        f.close()
+
+
+if __name__ == "__main__":
+    main()
+
+
+##########################################################################
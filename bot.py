@@ -10,14 +10,25 @@ This bot is thought to work in Barcelona. Then, coding language is English, but
 interaction with user is done in Catalan."""
 
 
-import os  # standard libraries
+import time  # standard libraries
+import queue
+import threading
 import traceback
+from urllib.parse import urlparse
 
 import telegram  # 3rd party packages
-from telegram.ext import Updater, CommandHandler, MessageHandler, Filters
+from telegram.ext import Updater, Dispatcher, CommandHandler, \
+    MessageHandler, TypeHandler, Filters
 import numpy as np
 
 import guide  # local source
+import metrics
+import outbox
+import registry
+import scheduler
+import sessions
+import sharding
+import tiles
 
 
 __title__ = "SCARLETT-GUIDEBOT"
@@ -30,17 +41,52 @@ __status__ = "Production"
 # ----------------------------- Initialization ---------------------------
 
 # Constants:
-city = "Barcelona"
+city = "Barcelona"  # default city
+cities = ["Barcelona"]  # cities served (the user's one is found by location)
+memory_budget = 1024 * 2**20  # max bytes of city graphs kept loaded
+cpu_workers = 2  # processes for routing and rendering (0: no processes)
+io_workers = 8  # threads running the users' tasks and sending messages
+max_pending = 256  # max tasks waiting, then commands wait and locations drop
+metrics_port = 9100  # local port of the metrics (None for no metrics server)
+metrics_log = None  # file of the log of every handled update (None: no log)
+sessions_file = 'sessions.sqlite'  # journeys saved across restarts (None: no)
+webhook_url = None  # public URL where Telegram posts the updates, with a
+# secret path (https://host/<secret>). None to get them by long polling.
+webhook_listen = ('0.0.0.0', 8443)  # address of the webhook HTTP server
+bot_api_url = None  # base URL of the Bot API, None for Telegram's (e.g.
+# 'http://127.0.0.1:8081/bot' for the local fakeapi)
+token_file = 'token.txt'  # file with the token of the telegram bot
+tile_url = tiles.OSM_URL  # URL template and directory of the map tiles
+tile_directory = 'tiles'
+shards = 1  # processes serving the users, each one always by the same one
+# (see sharding module). With more than one, the metrics of the shard i are
+# served at metrics_port + 1 + i.
 distance = 20  # max distance from user to checkpoint to consider him near it.
+off_route = 40  # min distance (meters) from user to journey to reroute him.
+min_interval = 3.0  # a location of a user is handled only if it comes these
+min_movement = 10  # seconds after, and is these meters away from, the last
+# one handled (0 to handle them all). Locations at a new checkpoint always are.
+photo_format = 'JPEG'  # format and quality (1-100) of the journey images
+photo_quality = 80
+window = 10  # checkpoints searched before and after the current one when the
+# user moves (None to search the whole journey, as in testing mode).
+
+SETTINGS = ('city', 'cities', 'memory_budget', 'cpu_workers', 'io_workers',
+            'max_pending', 'metrics_port', 'metrics_log', 'sessions_file',
+            'webhook_url', 'webhook_listen', 'bot_api_url', 'token_file',
+            'tile_url', 'tile_directory', 'shards', 'distance', 'off_route',
+            'min_interval', 'min_movement', 'photo_format', 'photo_quality',
+            'window')  # see configure()
 
 # Global variables:
-map = None   # variable to store the map/graph of the city
-
-TOKEN = open('token.txt').read().strip()
-updater = Updater(token=TOKEN, use_context=True)
-dispatcher = updater.dispatcher
-
-updater.start_polling()
+# shared maps/graphs of the cities:
+graphs = registry.GraphRegistry(cities, city, budget=memory_budget)
+# work scheduler of the users' tasks (started in main() ):
+jobs = scheduler.Scheduler(cpu_workers, io_workers, max_pending)
+# sessions (journeys) of the users (saved on disk from main() ):
+saved = sessions.SessionStore()
+updater = None  # telegram Updater and Dispatcher (see main() )
+dispatcher = None
 
 # ------------------------------------------------------------------------------
 
@@ -48,9 +94,10 @@ updater.start_polling()
 
 
 def start(update, context):
-    """ Initializes the city graph and starts the conversation. """
+    """ Starts the conversation. The city graph is loaded at boot, this only
+    makes sure it is loading (it never waits for it). """
 
-    init_map(city)
+    graphs.warm(user_city(context))
 
     user = update.effective_chat.first_name
     salute = '''
@@ -102,23 +149,24 @@ def go(update, context):
     user's shortest journey to reach the chosen destination from current
     location. """
 
-    global map
-
     try:
         location = context.user_data['location']  # KeyError if not shared
+        place = user_city(context)
+        graph = graphs.get(place)  # waits if the graph is still loading
 
         message = str(' '.join(context.args))
 
         # destination is a tuple (lat, long)
-        destination = guide.address_coord(message)
+        destination = guide.address_coord(message, graph)
         if destination is None:
             raise dstError
 
-        # directions is a list of dicts
-        directions = guide.get_directions(map, location, destination)
+        # directions is a list of sections (see journey module)
+        directions = jobs.cpu(guide.get_directions, graph, location,
+                              destination)
 
         # Save vars in user dictionary
-        store(context, message, destination, directions)
+        store(context, message, destination, directions, place)
 
         send_photo(update, context, directions)
         send_first_text(update, context, directions)
@@ -159,6 +207,30 @@ def zoom(update, context):
         print(traceback.format_exc())
 
 
+def choose_city(update, context):
+    """ Given a city (str) as an argument of the command, sets the city where
+    the user is guided. Without argument, sends the current and available
+    cities. """
+
+    if not context.args:
+        info = '''
+Ara et guio per *%s*.
+Puc guiar-te per: %s
+''' % (user_city(context), ', '.join(graphs.places))
+        send_markdown(update, context, info)
+        return
+
+    place = graphs.find(' '.join(context.args))
+    if place is None:
+        cityErr(update, context)
+        return
+
+    context.user_data['city'] = place
+    context.user_data['city_choice'] = True  # don't guess it from location
+    graphs.warm(place)
+    send_markdown(update, context, '''D'acord, et guio per *%s*!''' % place)
+
+
 def cancel(update, context):
     """ Cancels the current user's journey and resets user's journey data. """
 
@@ -168,6 +240,9 @@ def cancel(update, context):
     # Reset initial conditions:
     del context.user_data['directions']
     del context.user_data['destination']
+    context.user_data.pop('checkpoints', None)
+    context.user_data.pop('journey_city', None)
+    context.user_data.pop('route', None)
     context.user_data['checkpoint'] = 0
     context.user_data['test'] = False
 
@@ -232,6 +307,18 @@ Prova l'estructura */go* _Lloc, Localitat, País_
     send_markdown(update, context, dstErr)
 
 
+def cityErr(update, context):
+    """ Sends a markdown text with the issue to the user. (see choose_city() ).
+    """
+
+    cityErr = '''
+No conec aquesta ciutat!
+
+Puc guiar-te per: %s
+''' % (', '.join(graphs.places))
+    send_markdown(update, context, cityErr)
+
+
 def zoomErr(update, context):
     """ Sends a markdown text with the issue to the user. (see zoom() ). """
 
@@ -248,21 +335,20 @@ Utilitza la comanda */go* _destinació_ per començar la ruta.
 
 
 def send_photo(update, context, chopped_dir):
-    """ Generates, saves, sends, and deletes a staticmap image of journey. """
+    """ Generates and sends a staticmap image of journey. The image is
+    encoded in memory, it is never written to disk. """
 
-    global map
     location = context.user_data['location']
     destination = context.user_data['destination']
-    # Get user_id to name uniquely the image file:
-    user_id = str(update.message.from_user.id)
-
-    guide.plot_directions(map, location, destination, chopped_dir, user_id)
+    graph = graphs.get(context.user_data.get('journey_city'))
 
-    context.bot.send_photo(
-        chat_id=update.effective_chat.id,
-        photo=open(str(user_id) + '.png', 'rb'))
+    # rendered in the process pool:
+    photo = jobs.cpu(guide.plot_directions, graph, location, destination,
+                     chopped_dir, image_format=photo_format,
+                     quality=photo_quality)
 
-    os.remove(user_id + '.png')
+    with metrics.stage('upload'):
+        context.bot.send_photo(chat_id=update.effective_chat.id, photo=photo)
 
 
 def send_first_text(update, context, directions):
@@ -313,16 +399,88 @@ def send_markdown(update, context, info):
 # ----------------------------- Aux functions ----------------------------
 
 
-def store(context, message, destination, directions):
+def store(context, message, destination, directions, place=None):
     """ Defines and stores the essential user data at the start of a journey.
     """
 
     context.user_data['address'] = message
+    context.user_data['journey_city'] = place  # city of the journey graph
     context.user_data['destination'] = destination
     context.user_data['directions'] = directions
+    # Array of checkpoint coordinates, to compute distances at once:
+    context.user_data['checkpoints'] = directions.checkpoints()
+    # Index of the journey segments, to find if the user goes off it:
+    context.user_data['route'] = guide.route_index(directions)
     context.user_data['checkpoint'] = 0  # Create pair {'checkpoint' : int}
 
 
+def scheduled(handler, droppable=False, coalesce=None):
+    """ Returns a handler that runs the given one as a task of the user in the
+    work scheduler (see scheduler module), so the dispatcher threads are never
+    blocked by routing or rendering. If droppable, the update is dropped when
+    the scheduler is full instead of waiting for it. If coalesce is given,
+    an update waiting to be handled is replaced by a newer one with the same
+    coalesce key. """
+
+    def task(update, context):
+        try:
+            handler(update, context)
+        finally:  # the journey may have changed
+            saved.put(update.effective_user.id,
+                      sessions.session_of(context.user_data))
+
+    def submit(update, context):
+        try:
+            jobs.submit(update.effective_chat.id, task, update, context,
+                        block=not droppable, coalesce=coalesce)
+        except scheduler.Busy:
+            print("busy: update of", update.effective_chat.id, "dropped")
+
+    return submit
+
+
+def restore(user_data, session):
+    """ Restores a saved session (see sessions module) into the user's dict,
+    building again the indexes of the journey. """
+
+    user_data.update(session)
+    if 'directions' in session:
+        directions = session['directions']
+        user_data['checkpoints'] = directions.checkpoints()
+        user_data['route'] = guide.route_index(directions)
+
+
+def handlers():
+    """ Returns the list of telegram handlers of the bot. Every handler is
+    measured (see metrics module); the ones that use or change the journey
+    run as ordered user tasks (see scheduled). """
+
+    def measured(name, function, droppable=False, coalesce=None):
+        function = metrics.handler(name, function)
+        if name in ('start', 'help', 'author'):
+            return function
+        return scheduled(function, droppable, coalesce)
+
+    return [CommandHandler('start', measured('start', start)),
+            CommandHandler('help', measured('help', help)),
+            CommandHandler('author', measured('author', author)),
+            CommandHandler('go', measured('go', go)),
+            CommandHandler('city', measured('city', choose_city)),
+            CommandHandler('cancel', measured('cancel', cancel)),
+            CommandHandler('jump', measured('jump', jump)),
+            CommandHandler('zoom', measured('zoom', zoom)),
+            MessageHandler(Filters.location,
+                           measured('where', where, droppable=True,
+                                    coalesce='location'))]
+
+
+def user_city(context):
+    """ Returns the city chosen by the user (with /city or by location), or
+    the default city. """
+
+    return context.user_data.get('city', city)
+
+
 def end_route(update, context):
     """ Sends the last markdown text message that the user will recive and
     cancel the journey, when the user ends journey. """
@@ -379,27 +537,13 @@ def meters(directions, check):
     should travel. """
 
     meters = '''i avança '''
-    if not ('lenght' in directions[check] or
-            directions[check]['lenght'] is None):
+    if 'length' in directions[check] and \
+            directions[check]['length'] is not None:
         meters += str(round(directions[check]['length'])) + ''' metres'''
 
     return meters
 
 
-def init_map(city):
-    """ Downloads and saves the city map, if it already exists only loads it.
-    """
-
-    global map
-    try:
-        map = guide.load_graph(city + "_map")
-    except FileNotFoundError:
-        print("downloading...")
-        map = guide.download_graph(city)
-        guide.save_graph(map, city + "_map")
-        print("downloaded!")
-
-
 # ------------------------------------------------------------------------------
 
 # -------------------------- Location functions --------------------------
@@ -411,7 +555,8 @@ def where(update, context):
     Manages the directions to be sent to the user when needed. """
 
     # check if we are testing:
-    if 'location' not in context.user_data or not context.user_data['test']:
+    if 'location' not in context.user_data or \
+            not context.user_data.get('test'):
         regular_where(update, context)
 
     else:
@@ -423,9 +568,24 @@ def regular_where(update, context):
     user's dict. """
 
     message = update.edited_message if update.edited_message else update.message
+
+    # Updates can arrive out of order, drop the ones older than the last:
+    sent = message.edit_date or message.date
+    last = context.user_data.get('location_date')
+    if sent is not None and last is not None and sent < last:
+        metrics.recorded.inc('locations_skipped_total', {'reason': 'stale'})
+        return
+    context.user_data['location_date'] = sent
+
     loc = context.user_data['location'] = (message.location.latitude,
                                            message.location.longitude)
 
+    # Guess the user's city from the location, unless chosen with /city:
+    if not context.user_data.get('city_choice'):
+        place = graphs.city_of(loc)
+        if place is not None:
+            context.user_data['city'] = place
+
     common_where(update, context, loc)
 
 
@@ -441,23 +601,127 @@ def common_where(update, context, loc):
     """ Sends a markdown message with new instructions to the user if has
     arrived to another checkpoint. """
 
-    check = context.user_data['checkpoint']
+    if 'directions' not in context.user_data:
+        return  # live location shared before (or after) a journey
+
     directions = context.user_data['directions']
 
-    # Find nearest checkpoint to the user. Could be any checkpoint in the whole
-    # journey:
-    # Create a list with all distances from user to each checkpoint:
-    dist_list = [guide.dist(loc, section['src']) for section in directions]
-    # Get checkpoint that minimizes the distance:
-    nearest_check = np.argmin(dist_list)
-    nearest_dist = dist_list[nearest_check]
+    nearest_check, nearest_dist = nearest_checkpoint(context, loc)
 
     global distance
 
+    arrived = nearest_dist <= distance and \
+        nearest_check != context.user_data['checkpoint']
+    if not arrived and throttled(context, loc):
+        metrics.recorded.inc('locations_skipped_total',
+                             {'reason': 'throttled'})
+        return
+    context.user_data['handled'] = (time.monotonic(), loc)
+
     if nearest_dist <= distance:
         # user near checkpoint (See constant variable 'distance')
         next_checkpoint(update, context, nearest_check, directions)
 
+    elif off_journey(context, loc):
+        # user away from the journey (See constant variable 'off_route')
+        reroute(update, context, loc)
+
+
+def throttled(context, loc):
+    """ Returns True if the user location (loc) comes less than
+    'min_interval' seconds after the last location handled or is less than
+    'min_movement' meters away from it. Never when we are testing. """
+
+    handled = context.user_data.get('handled')
+    if handled is None or context.user_data.get('test'):
+        return False
+
+    global min_interval, min_movement
+
+    seconds, last = handled
+    return time.monotonic() - seconds < min_interval or \
+        guide.dist(last, loc) < min_movement
+
+
+def off_journey(context, loc):
+    """ Returns True if the user location (loc) is farther than 'off_route'
+    meters from every segment of the journey. Never when we are testing. """
+
+    route = context.user_data.get('route')
+    if route is None or context.user_data.get('test'):
+        return False
+
+    global off_route
+
+    return route.distance(loc)[1] > off_route
+
+
+def reroute(update, context, loc):
+    """ Starts a new journey from the user location (loc) to the same
+    destination, without geocoding it again. The route is computed in the
+    process pool, where the shortest path tree of the destination is shared
+    by the reroutes of every user going there (see guide.reroute). """
+
+    destination = context.user_data['destination']
+    place = context.user_data.get('journey_city')
+
+    try:
+        graph = graphs.get(place)
+        directions = jobs.cpu(guide.reroute, graph, loc, destination)
+
+    except ValueError:  # the destination can not be reached from here
+        print(traceback.format_exc())
+        return
+
+    store(context, context.user_data['address'], destination, directions,
+          place)
+
+    send_markdown(update, context, '''
+T'has desviat del camí 🔄
+Et porto per una nova ruta.
+''')
+    send_photo(update, context, directions)
+    send_first_text(update, context, directions)
+
+
+def nearest_checkpoint(context, loc):
+    """ Returns the checkpoint nearest to the user location (loc) and its
+    distance in meters. Only the checkpoints within 'window' positions of the
+    current one are considered, unless we are testing (the user can jump
+    anywhere) or the journey has no checkpoints array. If none of them is
+    near but the user is still on the journey (they went past the window,
+    e.g. after a GPS gap), all the checkpoints are considered. """
+
+    check = context.user_data['checkpoint']
+    directions = context.user_data['directions']
+    checkpoints = context.user_data.get('checkpoints')
+
+    global window, distance, off_route
+
+    if checkpoints is None:
+        # Create a list with all distances from user to each checkpoint:
+        dist_list = [guide.dist(loc, section['src']) for section in directions]
+        # Get checkpoint that minimizes the distance:
+        nearest_check = int(np.argmin(dist_list))
+        return nearest_check, dist_list[nearest_check]
+
+    if window is None or context.user_data.get('test'):
+        first, last = 0, len(checkpoints)
+    else:
+        first = max(0, check - window)
+        last = min(len(checkpoints), check + window + 1)
+
+    dist_array = guide.dist_many(loc, checkpoints[first:last])
+    nearest = int(np.argmin(dist_array))
+
+    route = context.user_data.get('route')
+    if dist_array[nearest] > distance and last - first < len(checkpoints) \
+            and route is not None and route.distance(loc)[1] <= off_route:
+        first, dist_array = 0, guide.dist_many(loc, checkpoints)
+        nearest = int(np.argmin(dist_array))
+
+    return first + nearest, float(dist_array[nearest])
+
 
 def next_checkpoint(update, context, nearest_check, directions):
     """ Sends the markdown message with the instructions to arrive from
@@ -485,19 +749,175 @@ COMMANDS = {
     'go destí': "et començo a guiar per a arrivar de la teva posició actual \
     fins al punt de destí que m'hagis especificat.🧭\nT'anire enviant \
     indicacions al teu dispositiu de les direccions que has de prendre.📲",
+    'city ciutat': "canvia la ciutat on et guio (si no, la dedueixo de la \
+    teva ubicació).",
     'cancel': "cancel·la el sistema de guia actiu.",
     'zoom': "Envia una foto ampliada amb els 3 pròxims checkpoints."
 }
 
 
-dispatcher.add_handler(CommandHandler('start', start))
-dispatcher.add_handler(CommandHandler('help', help))
-dispatcher.add_handler(CommandHandler('author', author))
-dispatcher.add_handler(CommandHandler('go', go))
-dispatcher.add_handler(CommandHandler('cancel', cancel))
-dispatcher.add_handler(CommandHandler('jump', jump))
-dispatcher.add_handler(CommandHandler('zoom', zoom))
-dispatcher.add_handler(MessageHandler(Filters.location, where))
+def main():
+    """ Creates the telegram updater, registers the handlers, starts the
+    metrics server and the work scheduler, restores the saved journeys,
+    starts loading the city graph and polls until the bot is stopped. With
+    more than one shard, the updates are handled by worker processes (see
+    serve_shard) and this one only polls and forwards them. """
+
+    global updater, dispatcher
+
+    updater = Updater(bot=new_bot(), use_context=True)
+    dispatcher = updater.dispatcher
+
+    if shards > 1:
+        # Saved (and converted) once here, the workers only map the files:
+        for place in cities:
+            registry.prepare_city(place)
+
+        workers = sharding.Supervisor(serve_shard, shards, (settings(),))
+        workers.start()
+        dispatcher.add_handler(TypeHandler(telegram.Update, lambda update,
+                                           context: forward(workers, update)))
+        if metrics_port is not None:
+            metrics.serve(metrics_port)
+
+        receive_updates(updater)
+        updater.idle()  # until stopped (Ctrl-C or SIGTERM)
+        workers.shutdown()
+        return
+
+    serve_users(dispatcher, metrics_port)
+    receive_updates(updater)
+    updater.idle()  # until stopped (Ctrl-C or SIGTERM)
+    stop_serving()
+
+
+def serve_shard(shard, count, updates, config):
+    """ Main function of the worker process of a shard (see sharding
+    module): handles the updates of its users, received as dicts from the
+    updates queue, with its own dispatcher until the supervisor stops it.
+    config holds the settings of the supervisor (see configure). """
+
+    global dispatcher
+
+    configure(config)
+    # The rate limits of the bot are shared by the shards:
+    bot = new_bot(outbox.RateLimiter(outbox.RATE / count,
+                                     burst=max(1, outbox.BURST // count)))
+    dispatcher = Dispatcher(bot, queue.Queue(), use_context=True)
+    jobs.cpu_workers = 0  # the shards are the processes
+
+    serve_users(dispatcher,
+                None if metrics_port is None else metrics_port + 1 + shard,
+                lambda user: sharding.shard_of(user, count) == shard)
+    thread = threading.Thread(target=dispatcher.start, name='dispatcher',
+                              daemon=True)
+    thread.start()
+
+    sharding.serve(updates, lambda data: dispatcher.update_queue.put(
+        telegram.Update.de_json(data, bot)))
+
+    dispatcher.stop()
+    thread.join()
+    stop_serving()
+
+
+def serve_users(dispatcher, port, mine=None):
+    """ Registers the handlers in the dispatcher, restores the saved
+    journeys (only of the users for which mine(user) is True, if given),
+    starts the metrics server on port and the work scheduler and starts
+    loading the city graph. """
+
+    global saved
+
+    for handler in handlers():
+        dispatcher.add_handler(handler)
+
+    if sessions_file is not None:
+        saved = sessions.SQLiteSessionStore(sessions_file)
+    restored = {user: session for user, session in saved.load().items()
+                if mine is None or mine(user)}
+    for user, session in restored.items():
+        restore(dispatcher.user_data[user], session)
+        if 'directions' in session:
+            graphs.warm(session.get('journey_city'))
+    print(len(restored), "sessions restored")
+
+    metrics.log_filename = metrics_log
+    if port is not None:
+        metrics.serve(port)
+
+    jobs.start(configure, (settings(),))
+    graphs.warm()  # load the default graph in the background while polling
+
+
+def settings():
+    """ Returns the dict of the constants of the bot (see SETTINGS). """
+
+    return {name: globals()[name] for name in SETTINGS}
+
+
+def configure(config):
+    """ Sets the constants of the bot to the ones of config (a dict, see
+    settings), before serving. The worker processes import this module
+    again, so they are configured with the settings of the main process. """
+
+    global graphs, jobs
+
+    globals().update((name, config[name]) for name in SETTINGS
+                     if name in config)
+    graphs = registry.GraphRegistry(cities, city, budget=memory_budget)
+    jobs = scheduler.Scheduler(cpu_workers, io_workers, max_pending)
+    guide.tile_cache = tiles.TileCache(tile_url, directory=tile_directory)
+
+
+def stop_serving():
+    """ Waits for the users' tasks and writes the last changes of the
+    journeys. """
+
+    jobs.shutdown()
+    saved.close()
+
+
+def receive_updates(updater):
+    """ Starts receiving the updates in the background: on the webhook HTTP
+    server if webhook_url is set (TLS is left to a reverse proxy in front of
+    it), by long polling otherwise. """
+
+    if webhook_url is None:
+        updater.start_polling()
+    else:
+        listen, port = webhook_listen
+        updater.start_webhook(listen=listen, port=port,
+                              url_path=urlparse(webhook_url).path.strip('/'))
+        updater.bot.set_webhook(webhook_url)
+
+
+def new_bot(limiter=None):
+    """ Returns the telegram Bot that sends the messages (see outbox module),
+    with a connection for every thread that can send at once. """
+
+    return outbox.Bot(read_token(), bot_api_url, pool_size=io_workers + 4,
+                      limiter=limiter)
+
+
+def forward(workers, update):
+    """ Sends an update to the worker of the shard of its user. """
+
+    user = update.effective_user
+    workers.submit(None if user is None else user.id, update.to_dict())
+
+
+def read_token():
+    """ Returns the token of the telegram bot (from token_file). """
+
+    f = open(token_file)  # open on read mode
+    token = f.read().strip()
+    f.close()
+    return token
+
+
+if __name__ == '__main__':
+    main()
 
 
 ##########################################################################
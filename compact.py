@@ -0,0 +1,429 @@
+# ----------------------- COMPACT MODULE -----------------------
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" This is the python script of the compact module. It defines a read-only,
+array-backed representation of a city graph: the adjacency is kept in CSR
+format (indptr/indices), together with the reverse adjacency (the incoming
+edges of every node, rindptr/rindices) used by the searches of the routing
+module, and every node and edge attribute that the guide module needs lives
+in its own NumPy array.
+
+A compact graph is stored on disk as a directory of .npy files that can be
+memory-mapped, so loading it is almost instant and no per-node or per-edge
+Python dicts are ever created. Nodes are identified by their position
+(0..n-1) in the arrays; the original OSM ids are kept in the osmid array.
+
+The module can also be run as a script to convert the pickle files written
+by guide.save_graph:
+
+    python3 compact.py Barcelona_map Barcelona_map.cg """
+
+
+import os  # standard library
+import json
+import hashlib
+import pickle
+import weakref
+import argparse
+from collections import deque
+
+import numpy as np  # 3rd party packages
+
+
+__title__ = "Compact"
+__author__ = "Pau Matas and Tomás Gadea"
+__maintainer__ = "Pau Matas and Tomás Gadea"
+__email__ = "paumatasalbi@gmail.com and 01tomas.gadea@gmail.com"
+__status__ = "Production"
+
+
+FORMAT_VERSION = 1
+ATTACHED = 2  # graphs kept attached by a process when nobody uses them
+
+# Graphs attached by this process, by directory (see attach), while they are
+# used, and the last ones attached (kept even if unused):
+_attached = weakref.WeakValueDictionary()
+_recent = deque(maxlen=ATTACHED)
+
+# Arrays stored (one .npy file each) in a compact graph directory:
+ARRAYS = ('osmid', 'lat', 'lon', 'indptr', 'indices', 'length', 'bearing',
+          'name_id')
+
+# Reverse adjacency, derived from the arrays above (and also saved with them,
+# so it is memory-mapped and shared like the rest of the graph):
+REVERSE_ARRAYS = ('rindptr', 'rindices', 'rlength')
+
+
+# ------------------------------ Compact graph ---------------------------
+
+
+class CompactGraph:
+    """ City graph stored as flat NumPy arrays.
+
+    Node i has coordinates (lat[i], lon[i]) and its outgoing edges are the
+    positions indptr[i]..indptr[i + 1] - 1 of the edge arrays: indices holds
+    the target node, length the length in meters, bearing the compass bearing
+    (NaN if unknown) and name_id the position of the street name in names
+    (-1 if the street has no name).
+
+    The incoming edges of node i are rindptr[i]..rindptr[i + 1] - 1 of the
+    reverse arrays: rindices holds their source node and rlength their
+    length. They are built from the edge arrays if not given. """
+
+    def __init__(self, arrays, names, meta=None, path=None):
+        for key in ARRAYS:
+            setattr(self, key, arrays[key])
+        if not all(key in arrays for key in REVERSE_ARRAYS):
+            arrays = reverse_csr(self.indptr, self.indices, self.length)
+        for key in REVERSE_ARRAYS:
+            setattr(self, key, arrays[key])
+        self.names = list(names)
+        self.meta = dict(meta or {})
+        self.path = path  # directory the graph was loaded from (if any)
+
+    def __len__(self):
+        return len(self.lat)
+
+    def __reduce_ex__(self, protocol):
+        """ Graphs loaded from disk are pickled as their directory, so sending
+        them to another process is cheap: the process memory-maps the same
+        files (see attach). """
+
+        if self.path is None:
+            return object.__reduce_ex__(self, protocol)
+        return (attach, (self.path,))
+
+    def __repr__(self):
+        return '<CompactGraph %s: %d nodes, %d edges>' % (
+            self.meta.get('name', ''), self.number_of_nodes(),
+            self.number_of_edges())
+
+    def number_of_nodes(self):
+        """ Returns the number of nodes of the graph. """
+
+        return len(self.lat)
+
+    def number_of_edges(self):
+        """ Returns the number of (directed) edges of the graph. """
+
+        return len(self.indices)
+
+    def nbytes(self):
+        """ Returns the size in bytes of all the arrays of the graph. """
+
+        return sum(getattr(self, key).nbytes
+                   for key in ARRAYS + REVERSE_ARRAYS)
+
+    def version(self):
+        """ Returns a short hash of the contents of the graph (kept in its
+        metadata), so results computed with another graph are never mistaken
+        for results of this one. """
+
+        if 'version' not in self.meta:
+            digest = hashlib.sha1()
+            for key in ARRAYS:
+                digest.update(np.ascontiguousarray(getattr(self, key)).data)
+            digest.update(json.dumps(self.names).encode('utf-8'))
+            self.meta['version'] = digest.hexdigest()[:16]
+        return self.meta['version']
+
+    def bounds(self):
+        """ Returns the bounding box (south, west, north, east) of the nodes.
+        """
+
+        if 'bounds' not in self.meta:
+            self.meta['bounds'] = _bounds(self.lat, self.lon)
+        return tuple(self.meta['bounds'])
+
+    def node_coord(self, node):
+        """ Returns the coordinates (lat, long) of a node (by index). """
+
+        return (float(self.lat[node]), float(self.lon[node]))
+
+    def successors(self, node):
+        """ Returns the array of nodes reachable from node with one edge. """
+
+        return self.indices[self.indptr[node]:self.indptr[node + 1]]
+
+    def predecessors(self, node):
+        """ Returns the array of nodes from which node is reached with one
+        edge. """
+
+        return self.rindices[self.rindptr[node]:self.rindptr[node + 1]]
+
+    def edge_index(self, node1, node2):
+        """ Returns the position in the edge arrays of the edge node1->node2.
+        Raises KeyError if there is no such edge. """
+
+        start = int(self.indptr[node1])
+        found = np.flatnonzero(self.successors(node1) == node2)
+        if len(found) == 0:
+            raise KeyError((node1, node2))
+        return start + int(found[0])
+
+    def edge_attributes(self, edge):
+        """ Returns a dict with the attributes of the edge (by position) in the
+        same format networkx uses: {'length', 'bearing', 'name'}. Missing
+        attributes are left out of the dict. """
+
+        info = {'length': float(self.length[edge])}
+
+        bearing = float(self.bearing[edge])
+        if not np.isnan(bearing):
+            info['bearing'] = bearing
+
+        name_id = int(self.name_id[edge])
+        if name_id >= 0:
+            info['name'] = self.names[name_id]
+
+        return info
+
+    def route_edge_attributes(self, path):
+        """ Returns the list of edge attribute dicts along a path (list of
+        nodes by index). """
+
+        return [self.edge_attributes(self.edge_index(u, v))
+                for u, v in zip(path[:-1], path[1:])]
+
+    def shortest_path(self, source, target):
+        """ Returns the path (list of nodes) with fewest edges from source to
+        target, like networkx.shortest_path does when no weight is given.
+        Raises ValueError if target can not be reached. """
+
+        parent = {source: None}
+        queue = deque([source])
+        indptr, indices = self.indptr, self.indices
+
+        while queue:
+            node = queue.popleft()
+            if node == target:
+                break
+            for nxt in indices[indptr[node]:indptr[node + 1]].tolist():
+                if nxt not in parent:
+                    parent[nxt] = node
+                    queue.append(nxt)
+
+        if target not in parent:
+            raise ValueError('no path from %s to %s' % (source, target))
+
+        path = [target]
+        while parent[path[-1]] is not None:
+            path.append(parent[path[-1]])
+        return path[::-1]
+
+
+# ------------------------------ Conversion ------------------------------
+
+
+def from_networkx(graph, name=None):
+    """ Builds a CompactGraph from an osmnx MultiDiGraph. When there are
+    parallel edges between two nodes only the shortest one is kept. """
+
+    osmids = list(graph.nodes)
+    index = {node: i for i, node in enumerate(osmids)}
+
+    lat = np.array([graph.nodes[node]['y'] for node in osmids], np.float64)
+    lon = np.array([graph.nodes[node]['x'] for node in osmids], np.float64)
+
+    names = []
+    name_ids = {}  # street name -> position in names (interning)
+    indptr = [0]
+    indices, length, bearing, name_id = [], [], [], []
+
+    for node1 in osmids:
+        for node2, parallel in graph.adj[node1].items():
+            edge = min(parallel.values(),
+                       key=lambda info: info.get('length', float('inf')))
+
+            street = first_name(edge.get('name'))
+            if street is not None and street not in name_ids:
+                name_ids[street] = len(names)
+                names.append(street)
+
+            indices.append(index[node2])
+            length.append(edge.get('length', 0.0))
+            bearing.append(edge.get('bearing', np.nan))
+            name_id.append(-1 if street is None else name_ids[street])
+        indptr.append(len(indices))
+
+    arrays = {'osmid': np.array(osmids, np.int64),
+              'lat': lat,
+              'lon': lon,
+              'indptr': np.array(indptr, np.int64),
+              'indices': np.array(indices, np.int32),
+              'length': np.array(length, np.float32),
+              'bearing': np.array(bearing, np.float32),
+              'name_id': np.array(name_id, np.int32)}
+
+    if name is None:
+        name = graph.graph.get('name', '')
+
+    return CompactGraph(arrays, names,
+                        {'name': name, 'bounds': _bounds(lat, lon)})
+
+
+def reverse_csr(indptr, indices, length):
+    """ Returns the reverse adjacency {'rindptr', 'rindices', 'rlength'} of
+    the edges given in CSR format: the incoming edges of every node, sorted by
+    target node (and by source node among the edges of the same target). """
+
+    n = len(indptr) - 1
+    sources = np.repeat(np.arange(n, dtype=np.int32), np.diff(indptr))
+    order = np.argsort(indices, kind='stable')
+
+    rindptr = np.zeros(n + 1, np.int64)
+    np.cumsum(np.bincount(indices, minlength=n), out=rindptr[1:])
+
+    return {'rindptr': rindptr,
+            'rindices': sources[order],
+            'rlength': np.asarray(length)[order]}
+
+
+def first_name(name):
+    """ Returns the street name of an edge 'name' attribute: the name itself
+    or the first one if it is a list (see guide._get_street_name). """
+
+    if isinstance(name, str):
+        return name
+    elif isinstance(name, list) and name:
+        return name[0]
+    return None
+
+
+def convert_pickle(pickle_file, directory):
+    """ Converts a graph saved with guide.save_graph (pickle file) into the
+    compact format, saved in directory. Returns the CompactGraph. """
+
+    f = open(pickle_file, 'rb')  # open on read mode
+    graph = from_networkx(pickle.load(f))
+    f.close()
+
+    save(graph, directory)
+    return graph
+
+
+# ------------------------------ Input/Output ----------------------------
+
+
+def save(graph, directory):
+    """ Saves a CompactGraph into directory (one .npy file per array plus the
+    street names and the metadata in json). """
+
+    os.makedirs(directory, exist_ok=True)
+
+    for key in ARRAYS + REVERSE_ARRAYS:
+        np.save(os.path.join(directory, key + '.npy'), getattr(graph, key))
+
+    meta = dict(graph.meta, format=FORMAT_VERSION, version=graph.version())
+    _dump_json(os.path.join(directory, 'meta.json'), meta)
+    _dump_json(os.path.join(directory, 'names.json'), graph.names)
+
+
+def load(directory, mmap=True):
+    """ Returns the CompactGraph saved in directory. If mmap is True the arrays
+    are memory-mapped read-only instead of being read into memory (graphs
+    saved without the reverse arrays get them built in memory: save them
+    again to share them). Raises FileNotFoundError if there is no compact
+    graph in directory. """
+
+    meta = _load_json(os.path.join(directory, 'meta.json'))
+    if meta.get('format') != FORMAT_VERSION:
+        raise ValueError('unsupported compact graph format in ' + directory)
+
+    mode = 'r' if mmap else None
+    arrays = {key: np.load(os.path.join(directory, key + '.npy'),
+                           mmap_mode=mode)
+              for key in ARRAYS}
+    for key in REVERSE_ARRAYS:
+        filename = os.path.join(directory, key + '.npy')
+        if os.path.exists(filename):
+            arrays[key] = np.load(filename, mmap_mode=mode)
+    names = _load_json(os.path.join(directory, 'names.json'))
+
+    return CompactGraph(arrays, names, meta, path=directory)
+
+
+def load_meta(directory):
+    """ Returns the metadata (name, bounds...) of the compact graph saved in
+    directory without loading the graph. """
+
+    return _load_json(os.path.join(directory, 'meta.json'))
+
+
+def save_reverse(directory):
+    """ Saves the reverse arrays of the compact graph saved in directory if
+    they are missing (graphs saved by older versions), so they can be
+    memory-mapped too. """
+
+    filenames = [os.path.join(directory, key + '.npy')
+                 for key in REVERSE_ARRAYS]
+    if all(os.path.exists(filename) for filename in filenames):
+        return
+
+    graph = load(directory)
+    for key, filename in zip(REVERSE_ARRAYS, filenames):
+        np.save(filename, getattr(graph, key))
+
+
+def attach(directory):
+    """ Returns the CompactGraph saved in directory, memory-mapped. A
+    process loads each directory only once while it is in use, and keeps
+    only the last ATTACHED graphs mapped when it is not (e.g. the cities
+    evicted by the registry are unmapped by the workers of the process
+    pool once they route other cities). """
+
+    graph = _attached.get(directory)
+    if graph is None:
+        graph = _attached[directory] = load(directory)
+    if graph not in _recent:
+        _recent.append(graph)
+    return graph
+
+
+def is_compact(path):
+    """ Returns True if path is a directory holding a compact graph. """
+
+    return os.path.isfile(os.path.join(path, 'meta.json'))
+
+
+# ------------------------------ Private functions -----------------------
+
+
+def _bounds(lat, lon):
+    """ Returns the bounding box [south, west, north, east] of the points. """
+
+    if len(lat) == 0:
+        return [0.0, 0.0, 0.0, 0.0]
+    return [float(np.min(lat)), float(np.min(lon)),
+            float(np.max(lat)), float(np.max(lon))]
+
+
+def _dump_json(filename, obj):
+    f = open(filename, 'w', encoding='utf-8')  # open on write mode
+    json.dump(obj, f, ensure_ascii=False)
+    f.close()
+
+
+def _load_json(filename):
+    f = open(filename, 'r', encoding='utf-8')  # open on read mode
+    obj = json.load(f)
+    f.close()
+    return obj
+
+
+# ------------------------------ Script ----------------------------------
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Convert a pickled city graph into the compact format.')
+    parser.add_argument('pickle_file', help='graph saved by guide.save_graph')
+    parser.add_argument('directory', help='output directory')
+    args = parser.parse_args()
+
+    compact = convert_pickle(args.pickle_file, args.directory)
+    print(compact, '->', args.directory)
+
+
+##########################################################################
@@ -0,0 +1,421 @@
+# ----------------------- FAKE BOT API SCRIPT -----------------------
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" This is the python script of a local stand-in of the Telegram Bot API,
+to measure the throughput of the bot without Telegram.
+
+It answers the methods the bot uses (getMe, getUpdates, setWebhook,
+sendMessage, sendPhoto...), records every message sent by the bot and, like
+Telegram, answers "Too Many Requests" (429) when the bot sends too fast. The
+updates of fake users are delivered by long polling or, if the bot has set a
+webhook, posted to it. It also serves blank map tiles (see tile_url), so
+the images can be drawn without the tile server. Point the bot to it with
+bot_api_url in bot.py:
+
+    bot_api_url = 'http://127.0.0.1:8081/bot'
+
+and run, while the bot is running:
+
+    python3 fakeapi.py --users 50 --updates 10 --output webhook.json """
+
+
+import re  # standard library
+import json
+import time
+import zlib
+import struct
+import argparse
+import threading
+import urllib.request
+from collections import deque
+from urllib.parse import urlparse, parse_qs
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+__title__ = "Fake Bot API"
+__author__ = "Pau Matas and Tomás Gadea"
+__maintainer__ = "Pau Matas and Tomás Gadea"
+__email__ = "paumatasalbi@gmail.com and 01tomas.gadea@gmail.com"
+__status__ = "Production"
+
+
+SENDS = ('sendMessage', 'sendPhoto')  # methods recorded as sent messages
+CONNECTIONS = 40  # max simultaneous posts to the webhook (as Telegram)
+BOT_USER = {'id': 1, 'is_bot': True, 'first_name': 'Scarlett',
+            'username': 'scarlett_guidebot'}
+
+_tiles = {}  # size -> blank PNG tile (see _tile)
+
+
+# ------------------------------ Fake Bot API ----------------------------
+
+
+class FakeBotAPI:
+    """ HTTP server that behaves as the Bot API for any token.
+
+    limit is the max number of messages per second accepted from the bot
+    (None for no limit) and latency the seconds every method takes. """
+
+    def __init__(self, port=8081, host='127.0.0.1', limit=30, latency=0.0):
+        self.limit = limit
+        self.latency = latency
+
+        self.sent = []  # (time, method, chat id) of the messages sent
+        self.rejected = 0  # messages answered with 429
+        self.webhook = None  # URL set by the bot with setWebhook
+
+        self._polled = False  # True once the bot has called getUpdates
+        self._updates = []  # updates for getUpdates
+        self._next_id = 1  # update_id of the next update
+        self._recent = deque()  # times of the messages of the last second
+        self._changed = threading.Condition()
+        # The updates of a chat are posted in order, by the same thread:
+        self._posters = [ThreadPoolExecutor(1) for i in range(CONNECTIONS)]
+
+        self._server = ThreadingHTTPServer((host, port), _Handler)
+        self._server.daemon_threads = True
+        self._server.api = self
+
+    @property
+    def url(self):
+        """ Base URL of the API, the bot_api_url of bot.py. """
+
+        host, port = self._server.server_address[:2]
+        return 'http://%s:%d/bot' % (host, port)
+
+    @property
+    def tile_url(self):
+        """ URL template of the blank map tiles, the tile_url of bot.py. """
+
+        host, port = self._server.server_address[:2]
+        return 'http://%s:%d/tiles/{z}/{x}/{y}.png' % (host, port)
+
+    def start(self):
+        """ Starts serving in a background thread. """
+
+        thread = threading.Thread(target=self._server.serve_forever,
+                                  name='fakeapi', daemon=True)
+        thread.start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        for poster in self._posters:
+            poster.shutdown()
+
+    def push(self, message, kind='message'):
+        """ Delivers an update with message (dict) to the bot: posts it to its
+        webhook or keeps it for getUpdates. kind is the field of the update
+        with the message ('message' or 'edited_message'). """
+
+        with self._changed:
+            update = {'update_id': self._next_id, kind: message}
+            self._next_id += 1
+            if self.webhook is None:
+                self._updates.append(update)
+                self._changed.notify_all()
+                return
+
+        poster = self._posters[message['chat']['id'] % CONNECTIONS]
+        poster.submit(_post, self.webhook, update)
+
+    def wait_sent(self, count, timeout=None):
+        """ Waits until the bot has sent count messages (at most timeout
+        seconds). Returns True if it has. """
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._changed:
+            while len(self.sent) < count:
+                left = None if deadline is None else \
+                    deadline - time.monotonic()
+                if left is not None and left <= 0:
+                    return False
+                self._changed.wait(left)
+        return True
+
+    def wait_connected(self, timeout=None):
+        """ Waits until the bot has asked for updates or set its webhook. """
+
+        with self._changed:
+            return self._changed.wait_for(
+                lambda: self.webhook is not None or self._polled, timeout)
+
+    def call(self, method, params):
+        """ Returns the result of a method of the API, or raises _Error. """
+
+        if self.latency:
+            time.sleep(self.latency)
+
+        if method == 'getMe':
+            return BOT_USER
+        if method == 'getMyCommands':
+            return []
+        if method == 'setWebhook':
+            with self._changed:
+                self.webhook = params.get('url') or None
+                self._changed.notify_all()
+            return True
+        if method == 'deleteWebhook':
+            self.webhook = None
+            return True
+        if method == 'getWebhookInfo':
+            return {'url': self.webhook or '', 'has_custom_certificate': False,
+                    'pending_update_count': len(self._updates)}
+        if method == 'getUpdates':
+            return self._get_updates(int(params.get('offset') or 0),
+                                     float(params.get('timeout') or 0))
+        if method in SENDS:
+            return self._send(method, int(params['chat_id']))
+        if method == 'sendChatAction':
+            return True
+        raise _Error(404, 'Not Found: method not found')
+
+    def _get_updates(self, offset, timeout):
+        with self._changed:
+            self._polled = True
+            self._changed.notify_all()
+            self._updates = [update for update in self._updates
+                             if update['update_id'] >= offset]
+            if not self._updates:
+                self._changed.wait(timeout)
+            return list(self._updates[:100])
+
+    def _send(self, method, chat):
+        with self._changed:
+            now = time.monotonic()
+            while self._recent and self._recent[0] <= now - 1.0:
+                self._recent.popleft()
+            if self.limit is not None and len(self._recent) >= self.limit:
+                self.rejected += 1
+                raise _Error(429, 'Too Many Requests: retry after 1',
+                             {'retry_after': 1})
+            self._recent.append(now)
+            self.sent.append((time.time(), method, chat))
+            self._changed.notify_all()
+
+        message = {'message_id': len(self.sent), 'date': int(time.time()),
+                   'chat': {'id': chat, 'type': 'private'}}
+        if method == 'sendPhoto':
+            message['photo'] = [{'file_id': 'photo', 'file_unique_id': 'photo',
+                                 'width': 1, 'height': 1}]
+        else:
+            message['text'] = ''
+        return message
+
+
+# ------------------------------ Load -----------------------------------
+
+
+def drive(api, users=50, updates=10, text='/help', replies=1,
+          timeout=120.0):
+    """ Sends updates messages with text from each of users fake users (all
+    of them at once) and waits for the replies (replies per update) of the
+    bot. Returns a dict with the updates per second handled and the latency
+    percentiles (seconds) from each update to its first reply. """
+
+    first = len(api.sent)
+    pushed = {}  # chat -> deque of the times its updates were pushed
+    start = time.time()
+
+    for i in range(updates):
+        for user in range(users):
+            chat = 1000 + user
+            pushed.setdefault(chat, deque()).append(time.time())
+            api.push(user_message(chat, i + 1, text))
+
+    expected = first + users * updates * replies
+    complete = api.wait_sent(expected, timeout)
+    elapsed = time.time() - start
+
+    latencies = []
+    counts = {}
+    for when, method, chat in api.sent[first:]:
+        counts[chat] = counts.get(chat, 0) + 1
+        if (counts[chat] - 1) % replies == 0 and pushed.get(chat):
+            latencies.append(when - pushed[chat].popleft())
+    latencies.sort()
+
+    return {'users': users, 'updates': users * updates,
+            'sent': len(api.sent) - first, 'complete': complete,
+            'rejected': api.rejected, 'seconds': elapsed,
+            'updates_per_second': len(latencies) / elapsed,
+            'webhook': api.webhook is not None,
+            'latency': {'p50': percentile(latencies, 0.5),
+                        'p90': percentile(latencies, 0.9),
+                        'p99': percentile(latencies, 0.99),
+                        'max': percentile(latencies, 1.0)}}
+
+
+def user_message(chat, message_id, text):
+    """ Returns a text message (dict) of a fake user in a private chat. """
+
+    user = {'id': chat, 'is_bot': False, 'first_name': 'User %d' % chat}
+    message = {'message_id': message_id, 'date': int(time.time()),
+               'chat': {'id': chat, 'type': 'private',
+                        'first_name': user['first_name']},
+               'from': user, 'text': text}
+    if text.startswith('/'):
+        message['entities'] = [{'type': 'bot_command', 'offset': 0,
+                                'length': len(text.split()[0])}]
+    return message
+
+
+def percentile(values, q):
+    """ Returns the q (0 to 1) percentile of the sorted list values. """
+
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+# ------------------------------ Private functions -----------------------
+
+
+class _Error(Exception):
+    """ Error of a method, answered as the Bot API does. """
+
+    def __init__(self, code, description, parameters=None):
+        Exception.__init__(self, description)
+        self.code = code
+        self.description = description
+        self.parameters = parameters
+
+
+class _Handler(BaseHTTPRequestHandler):
+    """ Requests of the Bot API: /bot<token>/<method>. """
+
+    protocol_version = 'HTTP/1.1'  # keep-alive, as Telegram
+
+    def do_GET(self):
+        if self.path.startswith('/tiles/'):
+            self._reply(200, _tile(), 'image/png')
+        else:
+            self._answer(parse_qs(urlparse(self.path).query))
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length)
+        kind = self.headers.get('Content-Type', '')
+
+        if kind.startswith('application/json'):
+            params = json.loads(body or b'{}')
+        elif kind.startswith('multipart/form-data'):
+            params = _form_fields(body)
+        else:
+            params = parse_qs(body.decode('utf-8'))
+        self._answer(params)
+
+    def log_message(self, format, *args):
+        pass
+
+    def _answer(self, params):
+        params = {key: value[0] if isinstance(value, list) else value
+                  for key, value in params.items()}
+        method = urlparse(self.path).path.rsplit('/', 1)[-1]
+
+        try:
+            code, reply = 200, {'ok': True,
+                                'result': self.server.api.call(method, params)}
+        except _Error as error:
+            code, reply = error.code, {'ok': False, 'error_code': error.code,
+                                       'description': error.description}
+            if error.parameters:
+                reply['parameters'] = error.parameters
+
+        self._reply(code, json.dumps(reply).encode('utf-8'),
+                    'application/json')
+
+    def _reply(self, code, body, content_type):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def _form_fields(body):
+    """ Returns the text fields of a multipart/form-data body. """
+
+    return {name.decode(): value.decode('utf-8', 'replace')
+            for name, value in re.findall(
+                rb'name="([^"]+)"\r\n(?:[^\r\n]+\r\n)*\r\n([^\r]*)\r\n', body)
+            if len(value) < 256}
+
+
+def _tile(size=256):
+    """ Returns a light grey PNG map tile of size x size pixels. """
+
+    if size not in _tiles:
+        def chunk(kind, data):
+            return struct.pack('>I', len(data)) + kind + data + \
+                struct.pack('>I', zlib.crc32(kind + data))
+
+        rows = b''.join(b'\x00' + b'\xee' * size for y in range(size))
+        _tiles[size] = b'\x89PNG\r\n\x1a\n' + \
+            chunk(b'IHDR', struct.pack('>IIBBBBB', size, size, 8, 0, 0, 0,
+                                       0)) + \
+            chunk(b'IDAT', zlib.compress(rows)) + chunk(b'IEND', b'')
+    return _tiles[size]
+
+
+def _post(url, update):
+    """ Posts an update to the webhook of the bot. """
+
+    request = urllib.request.Request(
+        url, json.dumps(update).encode('utf-8'),
+        {'Content-Type': 'application/json'})
+    try:
+        urllib.request.urlopen(request, timeout=30).close()
+    except OSError as error:
+        print("webhook failed:", error)
+
+
+# --------------------------------- Main ---------------------------------
+
+
+def main():
+    """ Serves the fake API, waits for the bot to connect, sends the updates
+    of the fake users and writes the measures as JSON. """
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--updates', type=int, default=10,
+                        help='updates sent by each user')
+    parser.add_argument('--text', default='/help',
+                        help='text of the messages of the users')
+    parser.add_argument('--replies', type=int, default=1,
+                        help='messages the bot sends for each update')
+    parser.add_argument('--limit', type=int, default=30,
+                        help='messages per second accepted (0: no limit)')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds every method takes')
+    parser.add_argument('--output', help='JSON file (default: stdout)')
+    args = parser.parse_args()
+
+    api = FakeBotAPI(args.port, limit=args.limit or None,
+                     latency=args.latency)
+    api.start()
+    print("waiting for the bot at", api.url)
+    api.wait_connected()
+    time.sleep(1.0)  # let it finish starting
+
+    text = json.dumps(drive(api, args.users, args.updates, args.text,
+                            args.replies), indent=2)
+    api.stop()
+
+    if args.output is None:
+        print(text)
+    else:
+        f = open(args.output, 'w')  # open on write mode
+        f.write(text + '\n')
+        f.close()
+
+
+if __name__ == "__main__":
+    main()
+
+
+##########################################################################
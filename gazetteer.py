@@ -0,0 +1,182 @@
+# ----------------------- GAZETTEER MODULE -----------------------
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" This is the python script of the gazetteer module. It defines Gazetteer,
+an offline index of the street names of a city graph, so that destinations
+which are plain street names can be found without asking a remote geocoder.
+
+Names are normalized (lower case, without accents nor extra spaces) and kept
+in a sorted list, which works as a prefix index with binary search. Every
+street is mapped to a representative point: the node of the street closest
+to the centroid of all its nodes. """
+
+
+import bisect  # standard library
+import unicodedata
+
+import numpy as np  # 3rd party packages
+
+import compact  # local source
+import geocache
+
+
+__title__ = "Gazetteer"
+__author__ = "Pau Matas and Tomás Gadea"
+__maintainer__ = "Pau Matas and Tomás Gadea"
+__email__ = "paumatasalbi@gmail.com and 01tomas.gadea@gmail.com"
+__status__ = "Production"
+
+
+MIN_PREFIX = 4  # min length of a query to be completed as a prefix
+
+
+# ---------------------------- Public Functions --------------------------
+
+
+def normalize(name):
+    """ Returns the key of a street name or address: the normalized address
+    (see geocache.normalize) without accents. """
+
+    name = unicodedata.normalize('NFKD', geocache.normalize(name))
+    return ''.join(c for c in name if not unicodedata.combining(c))
+
+
+# ------------------------------ Gazetteer -------------------------------
+
+
+class Gazetteer:
+    """ Sorted-array prefix index of street names.
+
+    keys is the sorted list of normalized names, names the original name of
+    each key and coords the representative point (lat,long) of each one. """
+
+    def __init__(self, keys, names, coords):
+        self.keys = keys
+        self.names = names
+        self.coords = coords
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.keys)
+
+    @classmethod
+    def from_graph(cls, graph):
+        """ Returns the Gazetteer of the street names of a graph (networkx or
+        compact). """
+
+        names, name_ids, lats, lons = _street_points(graph)
+        if len(name_ids) == 0:
+            return cls([], [], [])
+
+        # Group the points by street:
+        order = np.argsort(name_ids, kind='stable')
+        name_ids, lats, lons = name_ids[order], lats[order], lons[order]
+        starts = np.flatnonzero(np.r_[True, np.diff(name_ids) != 0])
+        counts = np.diff(np.r_[starts, len(name_ids)])
+
+        # Centroid of each street, repeated for each of its points:
+        mean_lat = np.add.reduceat(lats, starts) / counts
+        mean_lon = np.add.reduceat(lons, starts) / counts
+        group = np.repeat(np.arange(len(starts)), counts)
+        d2 = (lats - mean_lat[group])**2 + \
+            ((lons - mean_lon[group]) * np.cos(np.radians(lats)))**2
+
+        # Point of each street nearest to its centroid:
+        nearest = np.lexsort((d2, group))[starts]
+
+        streets = {}  # key -> (name, coords), first name wins
+        for point in nearest.tolist():
+            name = names[name_ids[point]]
+            key = normalize(name)
+            if key not in streets:
+                streets[key] = (name, (float(lats[point]),
+                                       float(lons[point])))
+
+        keys = sorted(streets)
+        return cls(keys, [streets[key][0] for key in keys],
+                   [streets[key][1] for key in keys])
+
+    def lookup(self, address, prefix=False):
+        """ Returns the representative coordinates (lat,long) of the street
+        named in address, or None if it is not found. The whole address is
+        tried first and then, if the rest is only a locality (as in "street,
+        city", with no house number), its first comma separated part. Names
+        must match exactly, unless prefix is True: then the prefix of a single
+        name is enough (for completion, the point may be far from what the
+        user meant). """
+
+        key = normalize(address)
+        candidates = [key]
+        if ',' in key:
+            street, rest = key.split(',', 1)
+            if not any(c.isdigit() for c in rest):
+                candidates.append(street)
+
+        for candidate in candidates:
+            position = self._find(candidate, prefix)
+            if position is not None:
+                self.hits += 1
+                return self.coords[position]
+
+        self.misses += 1
+        return None
+
+    def complete(self, prefix, limit=10):
+        """ Returns up to limit street names starting with prefix. """
+
+        key = normalize(prefix)
+        first = bisect.bisect_left(self.keys, key)
+        last = bisect.bisect_left(self.keys, key + '\uffff', first)
+        return self.names[first:min(last, first + limit)]
+
+    def _find(self, key, prefix=False):
+        """ Returns the position of the key that is equal to the given one, or
+        if prefix is True the position of the only key that starts with it.
+        None otherwise. """
+
+        first = bisect.bisect_left(self.keys, key)
+        if first < len(self.keys) and self.keys[first] == key:
+            return first
+
+        if prefix and len(key) >= MIN_PREFIX:
+            last = bisect.bisect_left(self.keys, key + '\uffff', first)
+            if last - first == 1:
+                return first
+        return None
+
+
+# ------------------------------ Private functions -----------------------
+
+
+def _street_points(graph):
+    """ Returns the street names of a graph and, for the source node of every
+    named edge, the street (position in names), latitude and longitude, as
+    NumPy arrays. """
+
+    if isinstance(graph, compact.CompactGraph):
+        named = np.flatnonzero(np.asarray(graph.name_id) >= 0)
+        sources = np.repeat(np.arange(len(graph)), np.diff(graph.indptr))
+        nodes = sources[named]
+        return (graph.names, np.asarray(graph.name_id)[named],
+                np.asarray(graph.lat)[nodes], np.asarray(graph.lon)[nodes])
+
+    names, ids = [], {}
+    name_ids, lats, lons = [], [], []
+    for node1, node2, edge in graph.edges(data=True):
+        name = compact.first_name(edge.get('name'))
+        if name is None:
+            continue
+        if name not in ids:
+            ids[name] = len(names)
+            names.append(name)
+        name_ids.append(ids[name])
+        lats.append(graph.nodes[node1]['y'])
+        lons.append(graph.nodes[node1]['x'])
+
+    return (names, np.array(name_ids, np.int64), np.array(lats, np.float64),
+            np.array(lons, np.float64))
+
+
+##########################################################################
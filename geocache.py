@@ -0,0 +1,216 @@
+# ----------------------- GEOCACHE MODULE -----------------------
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" This is the python script of the geocache module. It defines
+GeocodeCache, a two-tier cache in front of a geocoder: an in-process LRU
+dictionary whose entries expire after some time (TTL), and a persistent
+SQLite database shared by every run of the bot.
+
+Addresses are normalized before being used as keys, and addresses that the
+geocoder could not find are cached too (for a shorter time), so repeated
+typos don't reach the geocoder either.
+
+A geocoder is any function that receives an address (str) and returns its
+coordinates (lat,long), or None if the address does not exist. Exceptions
+raised by the geocoder (network errors...) are not cached. """
+
+
+import time  # standard library
+import sqlite3
+import threading
+import unicodedata
+from collections import OrderedDict
+
+import osmnx as ox  # 3rd party packages
+
+
+__title__ = "Geocache"
+__author__ = "Pau Matas and Tomás Gadea"
+__maintainer__ = "Pau Matas and Tomás Gadea"
+__email__ = "paumatasalbi@gmail.com and 01tomas.gadea@gmail.com"
+__status__ = "Production"
+
+
+# ---------------------------- Public Functions --------------------------
+
+
+def osmnx_geocoder(address):
+    """ Default geocoder: OpenStreetMap's Nominatim through osmnx. Returns
+    None if the address is not found. """
+
+    try:
+        return ox.geo_utils.geocode(address)
+
+    except OSError:  # network errors (requests exceptions), not cacheable
+        raise
+
+    except Exception:  # raised by osmnx when the address is not found
+        return None
+
+
+def normalize(address):
+    """ Returns the key used to cache an address: lower case, unicode
+    normalized, with single spaces and without empty comma separated parts.
+    """
+
+    address = unicodedata.normalize('NFKC', address).lower()
+    parts = (' '.join(part.split()) for part in address.split(','))
+    return ', '.join(part for part in parts if part)
+
+
+# ---------------------------- Geocode cache -----------------------------
+
+
+class GeocodeCache:
+    """ Two-tier (memory and SQLite) cache of a geocoder.
+
+    size is the max number of addresses kept in memory, ttl the number of
+    seconds a found address is valid and negative_ttl the number of seconds a
+    not found address is remembered. If filename is None there is no
+    persistent tier. """
+
+    def __init__(self, geocoder=osmnx_geocoder, filename=None, size=1024,
+                 ttl=30 * 24 * 3600, negative_ttl=24 * 3600):
+        self.geocoder = geocoder
+        self.filename = filename
+        self.size = size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+
+        self._memory = OrderedDict()  # key -> (coords or None, expiry time)
+        self._lock = threading.Lock()
+        self._db = None
+        self._counters = dict.fromkeys(
+            ('memory_hits', 'disk_hits', 'negative_hits', 'misses',
+             'errors'), 0)
+
+    def lookup(self, address):
+        """ Returns the coordinates (lat,long) of an address, or None if the
+        geocoder can not find it. Raises the exceptions of the geocoder. """
+
+        key = normalize(address)
+        now = time.time()
+
+        found, coords = self._memory_get(key, now)
+        if found:
+            self._count('memory_hits' if coords else 'negative_hits')
+            return coords
+
+        found, coords, expiry = self._disk_get(key, now)
+        if found:
+            self._count('disk_hits' if coords else 'negative_hits')
+            self._memory_put(key, coords, expiry)
+            return coords
+
+        self._count('misses')
+        try:
+            coords = self.geocoder(address)
+        except Exception:
+            self._count('errors')
+            raise
+
+        if coords is not None:
+            coords = (float(coords[0]), float(coords[1]))
+            expiry = now + self.ttl
+        else:
+            expiry = now + self.negative_ttl
+
+        self._memory_put(key, coords, expiry)
+        self._disk_put(key, coords, expiry)
+        return coords
+
+    def stats(self):
+        """ Returns a dict with the hit and miss counters of the cache, the
+        number of addresses in memory and the hit rate. """
+
+        with self._lock:
+            stats = dict(self._counters)
+            stats['memory_size'] = len(self._memory)
+
+        hits = stats['memory_hits'] + stats['disk_hits'] + \
+            stats['negative_hits']
+        lookups = hits + stats['misses']
+        stats['hit_rate'] = hits / lookups if lookups else 0.0
+        return stats
+
+    def clear(self):
+        """ Removes every address from both tiers of the cache. """
+
+        with self._lock:
+            self._memory.clear()
+            db = self._connection()
+            if db is not None:
+                db.execute('DELETE FROM geocode')
+                db.commit()
+
+    def close(self):
+        """ Closes the SQLite database, if open. """
+
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+    # --> Memory tier:
+
+    def _memory_get(self, key, now):
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is None:
+                return False, None
+            if entry[1] < now:  # expired
+                del self._memory[key]
+                return False, None
+            self._memory.move_to_end(key)
+            return True, entry[0]
+
+    def _memory_put(self, key, coords, expiry):
+        with self._lock:
+            self._memory[key] = (coords, expiry)
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.size:
+                self._memory.popitem(last=False)  # least recently used
+
+    # --> Disk tier:
+
+    def _connection(self):
+        """ Returns the SQLite connection (opened the first time it is needed)
+        or None if there is no persistent tier. Call with the lock held. """
+
+        if self._db is None and self.filename is not None:
+            self._db = sqlite3.connect(self.filename, check_same_thread=False)
+            self._db.execute('CREATE TABLE IF NOT EXISTS geocode ('
+                             'address TEXT PRIMARY KEY, lat REAL, lon REAL, '
+                             'expiry REAL)')
+            self._db.commit()
+        return self._db
+
+    def _disk_get(self, key, now):
+        with self._lock:
+            db = self._connection()
+            if db is None:
+                return False, None, None
+            row = db.execute('SELECT lat, lon, expiry FROM geocode '
+                             'WHERE address = ?', (key,)).fetchone()
+
+        if row is None or row[2] < now:
+            return False, None, None
+        coords = None if row[0] is None else (row[0], row[1])
+        return True, coords, row[2]
+
+    def _disk_put(self, key, coords, expiry):
+        lat, lon = (None, None) if coords is None else coords
+        with self._lock:
+            db = self._connection()
+            if db is not None:
+                db.execute('INSERT OR REPLACE INTO geocode '
+                           'VALUES (?, ?, ?, ?)', (key, lat, lon, expiry))
+                db.commit()
+
+    def _count(self, counter):
+        with self._lock:
+            self._counters[counter] += 1
+
+
+##########################################################################
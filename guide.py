@@ -12,12 +12,30 @@ bot.py module, it works under the hood. This means it is not directly related
 with the telegram bot and could be used on multiple purposes. """
 
 
-import pickle  # standard library
+import io  # standard library
+import os
+import sys
+import pickle
+import weakref
+import itertools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 
 import osmnx as ox  # 3rd party packages
 import networkx as nx
+import numpy as np
 from haversine import haversine
-from staticmap import StaticMap, Line, CircleMarker
+from staticmap import Line, CircleMarker
+
+import compact  # local source
+import gazetteer
+import geocache
+import journey
+import metrics
+import routecache
+import routing
+import spatial
+import tiles
 
 
 __title__ = "Guide"
@@ -27,6 +45,45 @@ __email__ = "paumatasalbi@gmail.com and 01tomas.gadea@gmail.com"
 __status__ = "Production"
 
 
+EARTH_RADIUS = 6371008.8  # mean Earth radius in meters (as haversine uses)
+
+# Attributes of the graphs read by this module (the others are pruned):
+NODE_ATTRIBUTES = ('x', 'y')
+EDGE_ATTRIBUTES = ('length', 'bearing', 'name')
+
+# Simplified images of the journeys (see plot_directions):
+TURN = 22.5  # min angle (degrees) of a turn drawn with a marker (as bot.angle)
+TOLERANCE = 1.0  # max distance (pixels) from the simplified line to the path
+MARKER_GAP = 12  # min distance (pixels) between two turn markers
+
+# Cache of the geocoder used by address_coord (see geocache module). It can be
+# replaced, e.g. to use another geocoder: guide.geocoding = GeocodeCache(...)
+geocoding = geocache.GeocodeCache(filename='geocode_cache.sqlite')
+
+# Source of the map tiles used by plot_directions (see tiles module). Use
+# tiles.TileCache(directory=..., offline=True) to render from a local store.
+tile_cache = tiles.TileCache(directory='tiles')
+
+# Routes computed by get_directions, by snapped nodes and graph version (see
+# routecache module). On a hit only the legs of the user are computed again.
+routes = routecache.RouteCache()
+
+# Shortest path trees towards the destinations of the journeys (see
+# destination_tree), shared by the users going to the same node. Their size
+# is bounded by routing.MAX_TREE_NODES.
+trees = routecache.RouteCache(size=16)
+
+# Spatial index of the nodes of every graph used so far (freed with the graph):
+_node_indexes = weakref.WeakKeyDictionary()
+
+# Offline index of the street names of every graph loaded (see gazetteer):
+_gazetteers = weakref.WeakKeyDictionary()
+
+# Versions given to the networkx graphs used so far (see graph_version):
+_graph_versions = weakref.WeakKeyDictionary()
+_version_counter = itertools.count()
+
+
 # ---------------------------- Public Functions --------------------------
 
 
@@ -39,36 +96,144 @@ def download_graph(place):
     ox.geo_utils.add_edge_bearings(graph)
 
     # filter and delete extra info of the graph:
-    for node1, info1 in graph.nodes.items():
-        for node2, info2 in graph.adj[node1].items():
-            edge = info2[0]
-            if 'geometry' in edge:
-                del(edge['geometry'])
+    prune_graph(graph)
 
     return graph
 
 
+def prune_graph(graph, report=False):
+    """ Removes from a networkx graph every node and edge attribute that is
+    not used (see NODE_ATTRIBUTES and EDGE_ATTRIBUTES), and keeps a single
+    street name per edge (the first one, as _get_street_name) shared by all
+    the edges of the street. Returns a dict with the number of nodes, edges
+    and street names and the bytes of the attributes before and after; if
+    report is True it is printed too. """
+
+    before = _attributes_nbytes(graph)
+
+    for node, info in graph.nodes.items():
+        for key in [key for key in info if key not in NODE_ATTRIBUTES]:
+            del info[key]
+
+    names = {}  # street name -> the instance shared by its edges
+    for node1, node2, info in graph.edges(data=True):
+        for key in [key for key in info if key not in EDGE_ATTRIBUTES]:
+            del info[key]
+
+        if 'name' in info:
+            name = compact.first_name(info['name'])
+            if name is None:
+                del info['name']
+            else:
+                info['name'] = names.setdefault(name, sys.intern(name))
+
+    stats = {'nodes': graph.number_of_nodes(),
+             'edges': graph.number_of_edges(), 'names': len(names),
+             'before': before, 'after': _attributes_nbytes(graph)}
+
+    if report:
+        print("%(nodes)d nodes, %(edges)d edges, %(names)d street names: "
+              "attributes %(before)d -> %(after)d bytes" % stats)
+    return stats
+
+
 def save_graph(graph, filename):
     """ Saves a graph(first parameter) into a pickle file (named as second
-    parameter). """
+    parameter). Compact graphs are saved in their own format instead: a
+    directory of memory-mappable arrays (see compact module). The spatial
+    index of the nodes is saved next to the graph. """
+
+    if isinstance(graph, compact.CompactGraph):
+        compact.save(graph, filename)
+    else:
+        f = open(filename, 'wb')  # open on write mode
+        pickle.dump(graph, f)
+        f.close()
 
-    f = open(filename, 'wb')  # open on write mode
-    pickle.dump(graph, f)
-    f.close()
+    _node_index(graph).save(_index_path(filename))
 
 
 def load_graph(filename):
-    """ Returns a graph read from a pickle file."""
+    """ Returns a graph read from a pickle file. If filename is a directory
+    written by save_graph with a compact graph, returns the (memory-mapped)
+    CompactGraph. The spatial index saved next to the graph is loaded too,
+    or built and saved if it is missing. """
+
+    if os.path.isdir(filename):
+        graph = compact.load(filename)
+    else:
+        f = open(filename, 'rb')  # open on read mode
+        graph = pickle.load(f)
+        f.close()
 
-    f = open(filename, 'rb')  # open on read mode
-    graph = pickle.load(f)
-    f.close()
+    try:
+        _node_indexes[graph] = spatial.NodeIndex.load(_index_path(filename))
+    except FileNotFoundError:
+        try:
+            _node_index(graph).save(_index_path(filename))
+        except OSError:  # read-only location, keep the index in memory only
+            pass
+
+    _gazetteer(graph)  # build the street names index at load time
     return graph
 
 
+def prepare_graph(filename):
+    """ Writes the files missing next to the compact graph saved in filename
+    (its reverse adjacency and its spatial index), without keeping anything
+    loaded, so that other processes only have to memory-map them. """
+
+    compact.save_reverse(filename)
+    if not os.path.exists(_index_path(filename)):
+        spatial.NodeIndex.from_graph(compact.load(filename)).save(
+            _index_path(filename))
+
+
+def graph_nbytes(graph):
+    """ Returns the size in bytes of a compact graph plus its spatial index.
+    """
+
+    return graph.nbytes() + _node_index(graph).nbytes()
+
+
+def graph_version(graph):
+    """ Returns the version of a graph used to key its cached routes: the hash
+    of the contents of a compact graph, or an id given to a networkx graph
+    the first time it is used. """
+
+    if isinstance(graph, compact.CompactGraph):
+        return graph.version()
+
+    version = _graph_versions.get(graph)
+    if version is None:
+        version = _graph_versions[graph] = 'nx%d' % next(_version_counter)
+    return version
+
+
+def invalidate_routes(graph):
+    """ Removes the cached routes of a graph. Must be called after changing a
+    networkx graph in place (which also gets a new version). Returns the
+    number of routes removed. """
+
+    removed = routes.invalidate(graph_version(graph))
+    trees.invalidate(graph_version(graph))
+    if not isinstance(graph, compact.CompactGraph):
+        _graph_versions[graph] = 'nx%d' % next(_version_counter)
+    return removed
+
+
 def print_graph(graph):
     """ Prints nodes and edges of the graph, also a summary of its info. """
 
+    if isinstance(graph, compact.CompactGraph):
+        print(graph)
+        for node1 in range(len(graph)):
+            print(node1, graph.node_coord(node1))
+            for edge in range(graph.indptr[node1], graph.indptr[node1 + 1]):
+                print('    ', graph.indices[edge])
+                print('        ', graph.edge_attributes(edge))
+        return
+
     print(nx.info(graph))
 
     for node1, info1 in graph.nodes.items():
@@ -79,37 +244,164 @@ def print_graph(graph):
             print('        ', edge)
 
 
-def get_directions(graph, source_location, destination_location):
-    """ Returns a list of dictionaries that represents the information of the
-    directions to take in order to move from point A (source_location) to point
-    B (destination_location) using the shortest path."""
+def get_directions(graph, source_location, destination_location,
+                   weight='length', algorithm='astar'):
+    """ Returns the sections (a journey.Directions, that behaves as a list of
+    dictionaries) with the information of the directions to take in order to
+    move from point A (source_location) to point B (destination_location)
+    using the shortest path.
+
+    weight is the edge attribute to minimize: 'length' (meters) or None
+    (fewest streets). algorithm is the shortest path algorithm: 'astar'
+    (bidirectional A* guided by the haversine distance), 'dijkstra'
+    (bidirectional Dijkstra) or 'bfs' (fewest streets).
 
-    src = _closest_node_to(graph, source_location)  # node represented by ID
-    dst = _closest_node_to(graph, destination_location)  # node repr. by ID
+    Routes between the same pair of nodes are taken from the route cache. """
 
-    sp_nodes = nx.shortest_path(graph, src, dst)  # list of nodes repr. by ID
+    with metrics.stage('snap'):
+        src = _closest_node_to(graph, source_location)  # node repr. by ID
+        dst = _closest_node_to(graph, destination_location)  # node by ID
 
-    return _from_path_to_directions(graph, sp_nodes, source_location,
-                                    destination_location)
+    key = (src, dst, graph_version(graph), weight, algorithm)
+    route = routes.get(key)
+    if route is None:
+        with metrics.stage('route'):
+            # list of nodes repr. by ID:
+            sp_nodes = _shortest_path(graph, src, dst, weight, algorithm)
+            route = _route(graph, sp_nodes)
+        routes.put(key, route, routecache.route_nbytes(*route))
+
+    with metrics.stage('sections'):
+        return _route_directions(graph, route, source_location,
+                                 destination_location)
+
+
+def route_index(directions):
+    """ Returns the spatial index (see spatial.RouteIndex) of the polyline of
+    some directions, to find how far a location is from the journey. """
+
+    return spatial.RouteIndex(directions.points())
+
+
+def destination_tree(graph, destination_location):
+    """ Returns the shortest path tree (see routing.ReverseTree) towards the
+    node nearest to destination_location, used by reroute. The trees of the
+    last destinations are kept in the trees cache and shared by every user
+    going there. Returns None for networkx graphs. """
+
+    if not isinstance(graph, compact.CompactGraph):
+        return None
+
+    dst = _closest_node_to(graph, destination_location)
+    key = (None, dst, graph_version(graph))  # from any source
+    tree = trees.get(key)
+    if tree is None:
+        tree = routing.ReverseTree(graph, dst)
+        trees.put(key, tree)
+    return tree
+
+
+def reroute(graph, source_location, destination_location):
+    """ Returns the directions (see get_directions) from source_location to
+    destination_location of a user that has left the journey. The path is
+    read from the tree of the destination (see destination_tree) kept by
+    this process, which resumes its search only when the user is somewhere
+    it has not reached yet. Raises ValueError if there is no path. """
+
+    with metrics.stage('snap'):
+        src = _closest_node_to(graph, source_location)
+
+    with metrics.stage('reroute'):
+        tree = destination_tree(graph, destination_location)
+        if tree is not None:
+            sp_nodes = tree.path_from(src)
+        else:
+            dst = _closest_node_to(graph, destination_location)
+            sp_nodes = _shortest_path(graph, src, dst)
+
+    with metrics.stage('sections'):
+        return _from_path_to_directions(graph, sp_nodes, source_location,
+                                        destination_location)
+
+
+def get_directions_many(graph, source_locations, destination_locations,
+                        weight='length', processes=None):
+    """ Returns the directions (see get_directions) from every source location
+    to every destination location: a list with, for each source, the list of
+    directions to each destination (None if it can not be reached).
+
+    All the locations are snapped to the graph in a single batched query and
+    the routes of each source come from a single shortest path tree. Sources
+    are routed in parallel by the given number of worker processes (all the
+    CPUs if None, 1 to route them in this process). """
+
+    source_locations = [tuple(location) for location in source_locations]
+    destination_locations = [tuple(location)
+                             for location in destination_locations]
+
+    ids = _node_index(graph).query(source_locations + destination_locations)[0]
+    nodes = ids[:, 0].tolist()
+    srcs, dsts = nodes[:len(source_locations)], nodes[len(source_locations):]
+
+    if processes is None:
+        processes = os.cpu_count() or 1
+    processes = max(1, min(processes, len(srcs)))
+
+    if processes == 1:
+        return _directions_from(graph, srcs, source_locations, dsts,
+                                destination_locations, weight)
+
+    # One chunk of sources per process, so the graph is sent only once to
+    # each (compact graphs loaded from disk are sent as their path):
+    chunks = [range(i, len(srcs), processes) for i in range(processes)]
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(processes, mp_context=context) as executor:
+        futures = [executor.submit(_directions_from, graph,
+                                   [srcs[i] for i in chunk],
+                                   [source_locations[i] for i in chunk],
+                                   dsts, destination_locations, weight)
+                   for chunk in chunks]
+
+        directions = [None] * len(srcs)
+        for chunk, future in zip(chunks, futures):
+            for i, routes in zip(chunk, future.result()):
+                directions[i] = routes
+    return directions
 
 
 def plot_directions(graph, source_location, destination_location, directions,
-                    filename, width=400, height=400):
+                    filename=None, width=400, height=400, image_format='PNG',
+                    quality=85, simplify=True):
     """ Plots and saves the directions from source_location to
-    destination_location in a file named "filename.png"  """
+    destination_location in a file named "filename.png". If no filename is
+    given, returns the encoded image in a BytesIO buffer instead.
+
+    image_format is any format supported by Pillow ('PNG', 'JPEG', 'WEBP'...)
+    and quality the compression quality (1-100) of lossy formats.
+
+    If simplify is True the journey is drawn as a single line, simplified for
+    the zoom of the image, with markers only at its ends and turns, so long
+    journeys are as fast to draw as short ones. Otherwise every section is
+    drawn with its own line and marker. """
 
-    m = StaticMap(width, height)  # create a StaticMap canvas
+    with metrics.stage('render'):
+        return _plot_directions(directions, filename, width, height,
+                                image_format, quality, simplify)
 
-    for i in enumerate(directions):
-        # enumerate(directions) returns an enumeration object
-        # from this object we are only interested in i[0]
-        marker, line = _marker_line(directions, i[0])
-        m.add_marker(marker)
-        if line is not None:
-            m.add_line(line)
 
-    image = m.render()
-    image.save(str(filename) + '.png')
+def prefetch_tiles(graph, zooms=tiles.ZOOMS, max_tiles=5000):
+    """ Downloads to the tile cache the map tiles that cover the whole graph
+    at the given zoom levels, so the images of its journeys are drawn without
+    requesting tiles. Returns the number of tiles stored. """
+
+    if isinstance(graph, compact.CompactGraph):
+        lats, lons = graph.lat, graph.lon
+    else:
+        lats = [info['y'] for node, info in graph.nodes.items()]
+        lons = [info['x'] for node, info in graph.nodes.items()]
+
+    return tile_cache.prefetch(min(lats), min(lons), max(lats), max(lons),
+                               zooms, max_tiles)
 
 
 def dist(a, b):
@@ -119,32 +411,190 @@ def dist(a, b):
     return haversine(a, b, unit='m')
 
 
-def address_coord(address):
-    """ Returns the tuple (lat,long) of a point given by an address (str). """
+def dist_many(a, points):
+    """ Returns a NumPy array with the geografical distances in meters from a
+    (lat,long) to each of the points, given as an array-like of n pairs
+    (lat,long). Vectorized version of dist. """
 
-    try:
-        return ox.geo_utils.geocode(address)
+    points = np.radians(np.asarray(points, np.float64).reshape(-1, 2))
+    lat, lon = np.radians(a[0]), np.radians(a[1])
 
-    except Exception:  # raised when address is not found in the city graph
-        return None
+    h = np.sin((points[:, 0] - lat) / 2)**2 + \
+        np.cos(lat) * np.cos(points[:, 0]) * \
+        np.sin((points[:, 1] - lon) / 2)**2
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.minimum(h, 1.0)))
+
+
+def address_coord(address, graph=None):
+    """ Returns the tuple (lat,long) of a point given by an address (str).
+    If the graph of the city is given and the address is exactly one of its
+    street names (maybe followed by the city), no geocoder is used.
+    Otherwise addresses are looked up in the geocoding cache first. """
+
+    with metrics.stage('geocode'):
+        if graph is not None:
+            coords = _gazetteer(graph).lookup(address)
+            if coords is not None:
+                return coords
+
+        try:
+            return geocoding.lookup(address)
+
+        except Exception:  # raised when the geocoder could not be reached
+            return None
 
 # -------------------------------------------------------------------------------
 
 # ---------------------------- Private Functions -------------------------
 
 
+def _attributes_nbytes(graph):
+    """ Returns an estimate of the bytes used by the attributes of the nodes
+    and edges of a networkx graph: their dicts and values (values shared by
+    several attributes are counted once). """
+
+    seen = set()
+
+    def nbytes(value):
+        if id(value) in seen:
+            return 0
+        seen.add(id(value))
+        size = sys.getsizeof(value)
+        if isinstance(value, (list, tuple, set)):
+            size += sum(nbytes(item) for item in value)
+        return size
+
+    total = 0
+    for node, info in graph.nodes.items():
+        total += sys.getsizeof(info) + sum(nbytes(v) for v in info.values())
+    for node1, node2, info in graph.edges(data=True):
+        total += sys.getsizeof(info) + sum(nbytes(v) for v in info.values())
+    return total
+
+
 def _closest_node_to(graph, source_location):
     """ Returns the nearest graph node (by ID) to some specified
     source_location repr. by tuple: (lat,long). """
 
-    return ox.geo_utils.get_nearest_node(graph, source_location,
-                                         method='haversine')
+    return _node_index(graph).nearest(source_location)
+
+
+def _node_index(graph):
+    """ Returns the spatial index (see spatial module) of the nodes of the
+    graph, building it the first time the graph is used. """
+
+    index = _node_indexes.get(graph)
+    if index is None:
+        if isinstance(graph, compact.CompactGraph) and graph.path is not None:
+            try:  # saved next to the graph (see save_graph)
+                index = spatial.NodeIndex.load(_index_path(graph.path))
+            except FileNotFoundError:
+                pass
+        if index is None:
+            index = spatial.NodeIndex.from_graph(graph)
+        _node_indexes[graph] = index
+    return index
+
+
+def _gazetteer(graph):
+    """ Returns the gazetteer (see gazetteer module) of the street names of
+    the graph, building it the first time the graph is used. """
+
+    index = _gazetteers.get(graph)
+    if index is None:
+        index = _gazetteers[graph] = gazetteer.Gazetteer.from_graph(graph)
+    return index
+
+
+def _index_path(filename):
+    """ Returns the path where the spatial index of the graph saved in
+    filename is stored: inside the directory of compact graphs, next to the
+    file of pickled graphs. """
+
+    if os.path.isdir(filename):
+        return os.path.join(filename, 'index')
+    return filename + '_index'
+
+
+def _shortest_path(graph, src, dst, weight='length', algorithm='astar'):
+    """ Returns the shortest path (list of nodes by ID) from src to dst using
+    the given weight and algorithm (see get_directions). Compact graphs use
+    the routing module, networkx graphs the equivalent networkx algorithm. """
+
+    if isinstance(graph, compact.CompactGraph):
+        return routing.shortest_path(graph, src, dst, weight, algorithm)
+
+    if algorithm not in routing.ALGORITHMS:
+        raise ValueError('unknown algorithm: %s' % algorithm)
+
+    if weight is None or algorithm == 'bfs':
+        return nx.shortest_path(graph, src, dst)
+
+    elif algorithm == 'astar':
+        def heuristic(node1, node2):
+            return dist(_node_coord(graph, node1), _node_coord(graph, node2))
+
+        return nx.astar_path(graph, src, dst, heuristic, weight=weight)
+
+    return nx.bidirectional_dijkstra(graph, src, dst, weight=weight)[1]
+
+
+def _shortest_paths(graph, src, dsts, weight='length'):
+    """ Returns a dict {dst: path} with the shortest paths from src to every
+    reachable node of dsts, from a single shortest path tree. """
+
+    if isinstance(graph, compact.CompactGraph):
+        return routing.shortest_paths(graph, src, dsts, weight)
+
+    if weight is None:
+        paths = nx.single_source_shortest_path(graph, src)
+    else:
+        paths = nx.single_source_dijkstra_path(graph, src, weight=weight)
+
+    return {dst: paths[dst] for dst in dsts if dst in paths}
+
+
+def _directions_from(graph, srcs, source_locations, dsts,
+                     destination_locations, weight='length'):
+    """ Returns, for each source node (and its location), the list of
+    directions to each destination node (and location), or None if it can
+    not be reached (see get_directions_many). """
+
+    directions = []
+    for src, source_location in zip(srcs, source_locations):
+        paths = _shortest_paths(graph, src, dsts, weight)
+        directions.append(
+            [_from_path_to_directions(graph, paths[dst], source_location,
+                                      destination_location)
+             if dst in paths else None
+             for dst, destination_location in zip(dsts,
+                                                  destination_locations)])
+    return directions
 
 
 def _from_path_to_directions(graph, sp_nodes, source_location,
                              destination_location):
     """ Returns the transformation from a path (repr. as a list of nodes) to
-    directions in their correct format: list of dictionaries. """
+    directions in their correct format (see journey.Directions). """
+
+    return _route_directions(graph, _route(graph, sp_nodes), source_location,
+                             destination_location)
+
+
+def _route(graph, sp_nodes):
+    """ Returns the part of the directions along a path that does not depend
+    on the user: the tuple (path, edge attributes, node coordinates). This
+    is what the route cache stores. """
+
+    return (tuple(sp_nodes), _route_edge_attributes(graph, sp_nodes),
+            [_id_coord(graph, node) for node in sp_nodes])
+
+
+def _route_directions(graph, route, source_location, destination_location):
+    """ Returns the directions (see journey.Directions) of a route (see
+    _route) from source_location to destination_location. """
+
+    sp_nodes, route_edges, route_coords = route
 
     # Create edge and node lists adding the additional nodes and edges
     # such that we can reach the source_location and the destination_location
@@ -152,27 +602,22 @@ def _from_path_to_directions(graph, sp_nodes, source_location,
     # destination):
     edges = \
         [_edges_fist_edge(graph, sp_nodes, source_location)] + \
-        ox.geo_utils.get_route_edge_attributes(graph, sp_nodes) + \
+        route_edges + \
         [_edges_last_edge(graph, sp_nodes, destination_location)]
 
     coord_nodes = \
         [source_location] + \
-        [_id_coord(graph, node) for node in sp_nodes] + \
+        route_coords + \
         [destination_location]
 
-    # enumerate coord_nodes returns (0, (1,2)), (1, (3,4))...
-    # but we are only interested in (0, 1, ...)
-    # so we select i[0]
-
     n = len(coord_nodes)
 
-    # Create the list of dicts (directions):
-    # (Also, only interested in i[0] from enumerate)
-    directions = \
-        [_section(edges, coord_nodes, i[0], n)
-         for i in enumerate(coord_nodes) if i[0] < n - 1]
-
-    return directions
+    # Create the directions, a section per edge (see journey module):
+    return journey.Directions.build(
+        coord_nodes,
+        [_get_section_angle(edges, i, n) for i in range(n - 1)],
+        [_get_street_length(edges[i]) for i in range(n - 1)],
+        [_get_street_name(edges[i]) for i in range(n - 1)])
 
 
 def _edges_fist_edge(graph, sp_nodes, source_location):
@@ -180,7 +625,7 @@ def _edges_fist_edge(graph, sp_nodes, source_location):
     sp_nodes. Edge is in triplet format: (node1, node2, {'lenght':value}) """
 
     src = sp_nodes[0]
-    src_coord = (graph.nodes[src]['y'], graph.nodes[src]['x'])
+    src_coord = _node_coord(graph, src)
     src_length = dist(source_location, src_coord)  # haversine distance
 
     return (source_location, src_coord, {'length': src_length})
@@ -192,7 +637,7 @@ def _edges_last_edge(graph, sp_nodes, destination_location):
     Edge is in triplet format: (node1, node2, {'lenght':value})"""
 
     dst = sp_nodes[-1]
-    dst_coord = (graph.nodes[dst]['y'], graph.nodes[dst]['x'])
+    dst_coord = _node_coord(graph, dst)
     dst_length = dist(destination_location, dst_coord)
 
     return (dst_coord, destination_location, {'length': dst_length})
@@ -203,30 +648,32 @@ def _id_coord(graph, node):
     Otherwise (node already in coords format) returns the same expression. """
 
     if not isinstance(node, tuple):
-        return (graph.nodes[node]['y'], graph.nodes[node]['x'])
+        return _node_coord(graph, node)
 
     return node
 
 
-# --> Section functions:
+def _node_coord(graph, node):
+    """ Returns the coordinates (lat,long) of a node (by ID) of the graph,
+    which can be either a networkx graph or a CompactGraph. """
+
+    if isinstance(graph, compact.CompactGraph):
+        return graph.node_coord(node)
+
+    return (graph.nodes[node]['y'], graph.nodes[node]['x'])
+
 
-def _section(edges, coord_nodes, i, n):
-    """ From a list (coord_nodes) that represents a path of n nodes and a
-    list (edges) of edges, returns the section (dictionary) that starts in the
-    node i of coord_nodes. The section contains relevant info about the
-    directions to be given in order to reach the destination of the travel. """
+def _route_edge_attributes(graph, sp_nodes):
+    """ Returns the list of edge attribute dicts along the path sp_nodes. """
 
-    section = {'angle': _get_section_angle(edges, i, n),
-               'src': coord_nodes[i],
-               'mid': coord_nodes[i + 1],
-               'dst': _get_section_dst(coord_nodes, i, n),
-               'next_name': _get_section_next_name(edges, i, n),
-               'current_name': _get_street_name(edges[i]),
-               'length': _get_street_length(edges[i])}
+    if isinstance(graph, compact.CompactGraph):
+        return graph.route_edge_attributes(sp_nodes)
 
-    return section
+    return ox.geo_utils.get_route_edge_attributes(graph, sp_nodes)
 
 
+# --> Section functions:
+
 def _get_section_angle(edges, i, n):
     """ Returns the angle of the section formed by the edges i and i + 1 in the
     list of edges, if we can compute it. """
@@ -238,24 +685,6 @@ def _get_section_angle(edges, i, n):
     return edges[i]['bearing'] - edges[i - 1]['bearing']
 
 
-def _get_section_dst(coord_nodes, i, n):
-    """ Returns the "dst" node (by coords) of the section formed by the nodes i,
-    i + 1 and i + 2 in coord_nodes, if it is not out of range. """
-
-    if i + 2 <= n - 1:
-        return coord_nodes[i + 2]
-    return None
-
-
-def _get_section_next_name(edges, i, n):
-    """ Returns the street name "next_name" of the section that corresponds to
-    the street in edges[i + 1], when is not out of range. """
-
-    if i + 2 <= n - 1:
-        return _get_street_name(edges[i + 1])
-    return None
-
-
 def _get_street_name(edge):
     """ Returns the name of the street that corresponds to the given edge. """
 
@@ -279,6 +708,140 @@ def _get_street_length(edge):
 
 # --> Plot directions sub-functions:
 
+def _plot_directions(directions, filename, width, height, image_format,
+                     quality, simplify=True):
+    """ Draws the directions (see plot_directions). """
+
+    # create a StaticMap canvas (with tiles from the tile cache):
+    m = tiles.TiledStaticMap(width, height, tile_cache)
+
+    if simplify:
+        zoom = _add_journey(m, directions)
+
+    else:
+        zoom = None  # computed by StaticMap
+        for i in enumerate(directions):
+            # enumerate(directions) returns an enumeration object
+            # from this object we are only interested in i[0]
+            marker, line = _marker_line(directions, i[0])
+            m.add_marker(marker)
+            if line is not None:
+                m.add_line(line)
+
+    image = m.render(zoom=zoom)
+
+    if filename is not None:
+        image.save(str(filename) + '.png')
+        return None
+
+    buffer = io.BytesIO()
+    if image_format.upper() == 'PNG':
+        image.save(buffer, 'PNG', optimize=True)
+    else:
+        image.save(buffer, image_format, quality=quality)
+    buffer.name = 'directions.' + image_format.lower()  # used by uploads
+    buffer.seek(0)
+    return buffer
+
+
+def _add_journey(m, directions):
+    """ Adds the directions to the StaticMap m as a single line (from the
+    first checkpoint to the last one, as _marker_line) simplified for the
+    zoom at which the whole journey fits in the image, with markers at the
+    ends and at the turns. Returns the zoom. """
+
+    points = np.asarray(directions.checkpoints(), np.float64)  # (lat,long)
+    n = len(points)
+
+    m_color, m_width = _get_marker_feature(0, n)
+    zoom = _fit_zoom(points, m.width, m.height, m.tile_size, m_width)
+    pixels = _pixels(points, zoom, m.tile_size)
+
+    if n > 1:
+        l_color, l_width = _get_line_feature(0, n)
+        kept = points[_simplify(pixels, TOLERANCE)]
+        m.add_line(Line([(lon, lat) for lat, lon in kept], l_color, l_width,
+                        simplify=False))
+
+    last = None  # pixel of the last turn marker
+    for i, section in enumerate(directions):
+        if not 0 < i < n - 1 or not _is_turn(section['angle']):
+            continue
+        if last is not None and np.hypot(*(pixels[i] - last)) < MARKER_GAP:
+            continue  # too close to the last one to be seen
+        color, width = _get_marker_feature(i, n)
+        m.add_marker(CircleMarker((points[i][1], points[i][0]), color, width))
+        last = pixels[i]
+
+    for i in {0, n - 1}:  # the ends, on top
+        m.add_marker(CircleMarker((points[i][1], points[i][0]), m_color,
+                                  m_width))
+    return zoom
+
+
+def _is_turn(angle):
+    """ Returns True if the angle (degrees) of a section is a turn (see
+    bot.angle), False if it goes straight on or it is unknown. """
+
+    return angle is not None and TURN <= angle % 360 <= 360 - TURN
+
+
+def _fit_zoom(points, width, height, tile_size, margin):
+    """ Returns the highest zoom (up to 17, as StaticMap) at which the points
+    (lat,long) fit in an image of width x height pixels with a margin of
+    margin pixels around them. """
+
+    for zoom in range(17, -1, -1):
+        pixels = _pixels(points, zoom, tile_size)
+        span = pixels.max(axis=0) - pixels.min(axis=0) + 2 * margin
+        if span[0] <= width and span[1] <= height:
+            return zoom
+    return 0
+
+
+def _pixels(points, zoom, tile_size):
+    """ Returns the (n, 2) array of the pixels (x, y) of the points
+    (lat,long) in the Web Mercator projection at zoom. """
+
+    lat = np.radians(points[:, 0])
+    scale = tile_size * 2.0**zoom
+    x = (points[:, 1] + 180.0) / 360.0 * scale
+    y = (1.0 - np.log(np.tan(lat) + 1.0 / np.cos(lat)) / np.pi) / 2.0 * scale
+    return np.column_stack((x, y))
+
+
+def _simplify(pixels, tolerance):
+    """ Returns the indexes of the points of the polyline pixels (n, 2) kept
+    by the Douglas-Peucker algorithm: the removed ones are less than
+    tolerance pixels away from the simplified line. """
+
+    n = len(pixels)
+    keep = np.zeros(n, bool)
+    keep[0] = keep[n - 1] = True
+
+    stack = [(0, n - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+
+        # distances from the inner points to the segment first-last:
+        a, ab = pixels[first], pixels[last] - pixels[first]
+        inner = pixels[first + 1:last] - a
+        norm = float(ab @ ab)
+        t = np.zeros(len(inner)) if norm == 0 else \
+            np.clip(inner @ ab / norm, 0.0, 1.0)
+        d = np.hypot(*(inner - t[:, None] * ab).T)
+
+        farthest = int(np.argmax(d))
+        if d[farthest] > tolerance:
+            middle = first + 1 + farthest
+            keep[middle] = True
+            stack += [(first, middle), (middle, last)]
+
+    return np.flatnonzero(keep)
+
+
 def _marker_line(directions, i):
     """ Returns a StaticMap line and marker with different features depending on
     the type of the section given. Section is obtained selecting the i-th dict
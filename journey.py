@@ -0,0 +1,197 @@
+# ----------------------- JOURNEY MODULE -----------------------
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" This is the python script of the journey module. It defines Directions,
+the compact form of the directions of a journey returned by the guide
+module.
+
+Instead of a list with a dict per section, the sections are kept in
+parallel NumPy arrays (coordinates, angles and lengths) and the street names
+are interned (each name is stored once and sections keep its position).
+Directions still behave as a list of section dicts: indexing returns a
+read-only view of a section with the usual keys ('angle', 'src', 'mid',
+'dst', 'next_name', 'current_name', 'length') and slicing returns Directions
+that share the arrays. """
+
+
+import sys  # standard library
+from collections.abc import Mapping, Sequence
+
+import numpy as np  # 3rd party packages
+
+
+__title__ = "Journey"
+__author__ = "Pau Matas and Tomás Gadea"
+__maintainer__ = "Pau Matas and Tomás Gadea"
+__email__ = "paumatasalbi@gmail.com and 01tomas.gadea@gmail.com"
+__status__ = "Production"
+
+
+KEYS = ('angle', 'src', 'mid', 'dst', 'next_name', 'current_name', 'length')
+
+
+# ------------------------------ Directions ------------------------------
+
+
+class Directions(Sequence):
+    """ Sections of a journey.
+
+    The journey passes through the n + 1 points (lat,long) of coords: the
+    section i goes from coords[i] (src) to coords[i + 1] (mid), and then
+    towards coords[i + 2] (dst). angle and length hold the angle of the turn
+    and the length of the street of each section (NaN if unknown) and
+    name_id the position in names of its street name (-1 if unknown).
+
+    start and stop select the sections [start, stop) of the journey seen
+    through this object (slices share the arrays). """
+
+    __slots__ = ('coords', 'angle', 'length', 'name_id', 'names', 'start',
+                 'stop')
+
+    def __init__(self, coords, angle, length, name_id, names, start=0,
+                 stop=None):
+        self.coords = coords
+        self.angle = angle
+        self.length = length
+        self.name_id = name_id
+        self.names = names
+        self.start = start
+        self.stop = len(angle) if stop is None else stop
+
+    @classmethod
+    def build(cls, coords, angles, lengths, names):
+        """ Returns the Directions with the given points (n + 1 tuples) and
+        the given angle, length and street name of each section (None if
+        unknown). """
+
+        interned = {}
+        name_id = np.array([-1 if name is None else
+                            interned.setdefault(name, len(interned))
+                            for name in names], np.int32)
+
+        return cls(np.array(coords, np.float64).reshape(-1, 2),
+                   _floats(angles), _floats(lengths), name_id,
+                   tuple(interned))
+
+    def __len__(self):
+        return self.stop - self.start
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            start, stop, step = i.indices(len(self))
+            if step != 1:
+                return [self[j] for j in range(start, stop, step)]
+            return Directions(self.coords, self.angle, self.length,
+                              self.name_id, self.names, self.start + start,
+                              self.start + max(start, stop))
+
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError('section out of range')
+        return Section(self, self.start + i)
+
+    def __eq__(self, other):
+        if not isinstance(other, Sequence):
+            return NotImplemented
+        return len(self) == len(other) and \
+            all(a == b for a, b in zip(self, other))
+
+    def __repr__(self):
+        return '<Directions: %d sections>' % len(self)
+
+    def checkpoints(self):
+        """ Returns the (n, 2) array of the starting points (src) of the
+        sections. """
+
+        return self.coords[self.start:self.stop]
+
+    def points(self):
+        """ Returns the array of the points of the journey: the src of every
+        section and the mid of the last one. """
+
+        return self.coords[self.start:self.stop + 1]
+
+    def nbytes(self):
+        """ Returns the bytes used by the whole journey (all the arrays and
+        names, even if this is a slice). """
+
+        return self.coords.nbytes + self.angle.nbytes + \
+            self.length.nbytes + self.name_id.nbytes + \
+            sys.getsizeof(self.names) + \
+            sum(sys.getsizeof(name) for name in self.names)
+
+    def value(self, i, key):
+        """ Returns the value of key in the section i of the whole journey.
+        """
+
+        n = len(self.angle)  # sections of the whole journey
+
+        if key == 'src':
+            return _point(self.coords[i])
+        if key == 'mid':
+            return _point(self.coords[i + 1])
+        if key == 'dst':
+            return _point(self.coords[i + 2]) if i + 2 <= n else None
+        if key == 'current_name':
+            return self._name(i)
+        if key == 'next_name':
+            return self._name(i + 1) if i + 2 <= n else None
+        if key == 'angle':
+            return _float(self.angle[i])
+        if key == 'length':
+            return _float(self.length[i])
+        raise KeyError(key)
+
+    def _name(self, i):
+        name_id = int(self.name_id[i])
+        return self.names[name_id] if name_id >= 0 else None
+
+
+class Section(Mapping):
+    """ Read-only view of a section of some Directions, that behaves as the
+    dict of the section. """
+
+    __slots__ = ('directions', 'i')
+
+    def __init__(self, directions, i):
+        self.directions = directions
+        self.i = i
+
+    def __getitem__(self, key):
+        return self.directions.value(self.i, key)
+
+    def __iter__(self):
+        return iter(KEYS)
+
+    def __len__(self):
+        return len(KEYS)
+
+    def __repr__(self):
+        return repr(dict(self))
+
+
+# ------------------------------ Private functions -----------------------
+
+
+def _floats(values):
+    """ Returns the array of values, NaN where the value is None. """
+
+    return np.array([np.nan if value is None else value for value in values],
+                    np.float64)
+
+
+def _float(value):
+    """ Returns an array value as a float, or None if it is NaN. """
+
+    return None if np.isnan(value) else float(value)
+
+
+def _point(row):
+    """ Returns a row of coords as a tuple (lat,long). """
+
+    return (float(row[0]), float(row[1]))
+
+
+##########################################################################
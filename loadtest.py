@@ -0,0 +1,499 @@
+# ----------------------- LOAD TEST SCRIPT -----------------------
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" This is the python script of the load tests of the bot. It simulates
+many users at once: each one shares its live location, asks for a journey
+with /go and then moves along it (sometimes leaving it) while its live
+location is sent to the bot, as Telegram does. When a journey ends, the user
+starts another one.
+
+The bot runs in a process of its own, with its usual configuration except
+that it talks to a local stand-in of the Bot API (see fakeapi) and draws the
+images with blank tiles, so no network is used. The number of users grows
+in steps and every step reports the updates sent per second, the
+percentiles of the latency of the replies (from the update that causes a
+journey image to the image) and the memory of the bot, until the replies
+are too slow or the bot dies:
+
+    python3 loadtest.py --users 10 50 100 200 --output load.json """
+
+
+import os  # standard library
+import sys
+import json
+import math
+import time
+import heapq
+import random
+import signal
+import argparse
+import tempfile
+import subprocess
+from collections import deque
+
+import numpy as np  # 3rd party packages
+
+import bot  # local source
+import fakeapi
+import guide
+import registry
+
+
+__title__ = "Load test"
+__author__ = "Pau Matas and Tomás Gadea"
+__maintainer__ = "Pau Matas and Tomás Gadea"
+__email__ = "paumatasalbi@gmail.com and 01tomas.gadea@gmail.com"
+__status__ = "Production"
+
+
+FAKE_TOKEN = '123456:loadtest-loadtest-loadtest-loadtest'
+LIVE_PERIOD = 3600  # seconds the simulated live locations are shared
+ATTEMPTS = 100  # random journeys tried by a user before giving up
+
+
+# ------------------------------ Simulated user --------------------------
+
+
+class User:
+    """ Simulated user of the bot, in a private chat of id chat.
+
+    It mirrors what the bot does with its locations (see bot.common_where) to
+    know which updates the bot answers with an image: pending holds the times
+    the updates still unanswered were sent. """
+
+    def __init__(self, chat, graph, streets, options, rng):
+        self.chat = chat
+        self.graph = graph
+        self.streets = streets
+        self.options = options
+        self.rng = rng
+
+        self.pending = deque()
+        self.message_id = 0
+        self.live_id = None  # message_id of the live location message
+        self.location = None
+        self.address = None
+        self.destination = None
+        self.directions = None
+        self.handled = None  # (time, location) of the last location handled
+
+    def start(self, api):
+        """ Shares the live location from a random point and asks for a
+        journey to a random street. Raises RuntimeError if no journey is
+        found in ATTEMPTS tries. """
+
+        south, west, north, east = self.graph.bounds()
+        for attempt in range(ATTEMPTS if self.streets else 0):
+            self.location = (self.rng.uniform(south, north),
+                             self.rng.uniform(west, east))
+            self.address = self.rng.choice(self.streets)
+            self.destination = guide.address_coord(self.address, self.graph)
+            if self.destination is None:
+                continue
+            try:
+                self._follow(guide.get_directions(self.graph, self.location,
+                                                  self.destination))
+                break
+            except ValueError:  # no path, try again
+                continue
+        else:
+            raise RuntimeError(
+                'no journey found in %d tries: the %d streets of the city are '
+                'not geocoded or not reachable from inside its bounds' %
+                (ATTEMPTS, len(self.streets)))
+
+        self.live_id = self._send(api, location=self.location)
+        self.pending.append(time.time())
+        self._send(api, text='/go ' + self.address)
+
+    def move(self, api, seconds):
+        """ Moves for some seconds along the journey (or off it) and sends
+        the new location. Returns False once the journey is over. """
+
+        options = self.options
+        self.walked += options.speed * seconds
+        if self.detour is None and self.rng.random() < \
+                options.off * seconds / max(self.duration, seconds):
+            self.detour = 0.0  # starts leaving the journey
+        if self.detour is not None:
+            self.detour += options.speed * seconds
+
+        lat, lon = self._point(min(self.walked, self.length))
+        noise = self.rng.gauss(0, options.noise), \
+            self.rng.gauss(0, options.noise)
+        offset = (noise[0] + (self.detour or 0.0) * self.normal[0],
+                  noise[1] + (self.detour or 0.0) * self.normal[1])
+        self.location = (lat + offset[0] / guide.EARTH_RADIUS * 180 / math.pi,
+                         lon + offset[1] / guide.EARTH_RADIUS * 180 / math.pi /
+                         math.cos(math.radians(lat)))
+
+        when = time.time()
+        self._send(api, location=self.location, edited=True)
+        return self._mirror(when)
+
+    def _mirror(self, when):
+        """ Does what the bot does with the location just sent and returns
+        False if the journey is over. """
+
+        checkpoints = self.checkpoints
+        first, last = 0, len(checkpoints)
+        if bot.window is not None:
+            first = max(0, self.checkpoint - bot.window)
+            last = min(len(checkpoints), self.checkpoint + bot.window + 1)
+        dists = guide.dist_many(self.location, checkpoints[first:last])
+        nearest = first + int(np.argmin(dists))
+        near = dists[nearest - first] <= bot.distance
+
+        if not (near and nearest != self.checkpoint) and \
+                self.handled is not None and \
+                (when - self.handled[0] < bot.min_interval or
+                 guide.dist(self.handled[1], self.location) <
+                 bot.min_movement):
+            return self.walked < self.length + 2 * bot.distance  # throttled
+        self.handled = (when, self.location)
+
+        if near:
+            if nearest == len(self.directions) - 1:
+                return False  # end of the journey, no image
+            self.checkpoint = nearest
+            self.pending.append(when)
+
+        elif self.route.distance(self.location)[1] > bot.off_route:
+            self.pending.append(when)  # rerouted, as the bot does
+            try:
+                self._follow(guide.get_directions(self.graph, self.location,
+                                                  self.destination))
+            except ValueError:
+                return False
+
+        return self.walked < self.length + 2 * bot.distance
+
+    def _follow(self, directions):
+        """ Starts following directions from its first point. """
+
+        self.directions = directions
+        self.checkpoints = directions.checkpoints()
+        self.route = guide.route_index(directions)
+        self.checkpoint = 0
+
+        points = directions.points()
+        steps = [guide.dist(tuple(a), tuple(b))
+                 for a, b in zip(points[:-1], points[1:])]
+        self.points = points
+        self.cumulative = np.concatenate(([0.0], np.cumsum(steps)))
+        self.length = float(self.cumulative[-1])
+        self.duration = self.length / self.options.speed
+        self.walked = 0.0
+        self.detour = None
+
+        angle = self.rng.uniform(0, 2 * math.pi)  # direction of the detours
+        self.normal = (math.cos(angle), math.sin(angle))
+
+    def _point(self, walked):
+        """ Returns the point (lat,long) at walked meters of the journey. """
+
+        i = int(np.searchsorted(self.cumulative, walked, side='right')) - 1
+        i = min(max(i, 0), len(self.points) - 2)
+        step = self.cumulative[i + 1] - self.cumulative[i]
+        t = 0.0 if step == 0 else (walked - self.cumulative[i]) / step
+        a, b = self.points[i], self.points[i + 1]
+        return (float(a[0] + t * (b[0] - a[0])),
+                float(a[1] + t * (b[1] - a[1])))
+
+    def _send(self, api, text=None, location=None, edited=False):
+        """ Sends a message (or the edition of the live location) to the bot
+        and returns its message_id. """
+
+        if edited:
+            message_id = self.live_id
+        else:
+            self.message_id += 1
+            message_id = self.message_id
+
+        message = fakeapi.user_message(self.chat, message_id, text or '')
+        if location is not None:
+            del message['text']
+            message['location'] = {'latitude': location[0],
+                                   'longitude': location[1],
+                                   'live_period': LIVE_PERIOD}
+        if edited:
+            message['edit_date'] = int(time.time())
+            api.push(message, kind='edited_message')
+        else:
+            api.push(message)
+        return message_id
+
+
+# ------------------------------ Load test -------------------------------
+
+
+class LoadTest:
+    """ Simulated users (see User) sending their updates to the bot through
+    api, each one every options.interval seconds. """
+
+    def __init__(self, api, graph, options, seed=0):
+        self.api = api
+        self.graph = graph
+        self.options = options
+        self.rng = random.Random(seed)
+
+        gazetteer = guide._gazetteer(graph)
+        self.streets = sorted(set(gazetteer.names))
+        self.users = {}  # chat -> User
+        self._events = []  # heap of (time, chat)
+        self._read = 0  # messages of api.sent already matched
+        self._step = None  # measures of the current step
+
+    def run_step(self, users, seconds, process=None):
+        """ Adds users until there are users of them and runs for seconds.
+        Returns the measures of the step (see _summary). """
+
+        now = time.time()
+        for chat in range(1000 + len(self.users), 1000 + users):
+            self.users[chat] = User(chat, self.graph, self.streets,
+                                    self.options, self.rng)
+            start = now + self.rng.uniform(0, self.options.interval)
+            heapq.heappush(self._events, (start, chat, True))
+
+        self._step = {'updates': 0, 'journeys': 0, 'latencies': [],
+                      'unmatched': 0, 'lag': 0.0, 'start': now,
+                      'sent': len(self.api.sent),
+                      'rejected': self.api.rejected}
+
+        deadline = now + seconds
+        while time.time() < deadline:
+            if process is not None and process.poll() is not None:
+                break
+            self._match()
+            if not self._events or self._events[0][0] > time.time():
+                time.sleep(0.005)
+                continue
+
+            when, chat, starting = heapq.heappop(self._events)
+            self._step['lag'] = max(self._step['lag'], time.time() - when)
+            user = self.users[chat]
+            if starting:
+                user.start(self.api)
+                self._step['journeys'] += 1
+                going = True
+            else:
+                going = user.move(self.api, self.options.interval)
+            self._step['updates'] += 1
+            heapq.heappush(self._events, (when + self.options.interval, chat,
+                                          not going))
+
+        self._match()
+        return self._summary(users, time.time() - now, process)
+
+    def _match(self):
+        """ Matches the images sent by the bot since the last call with the
+        oldest unanswered update of their chats. """
+
+        sent = self.api.sent
+        while self._read < len(sent):
+            when, method, chat = sent[self._read]
+            self._read += 1
+            user = self.users.get(chat)
+            if method != 'sendPhoto':
+                continue
+            if user is None or not user.pending:
+                self._step['unmatched'] += 1
+                continue
+            self._step['latencies'].append(when - user.pending.popleft())
+
+    def _summary(self, users, seconds, process):
+        step = self._step
+        latencies = sorted(step['latencies'])
+        waiting = [time.time() - user.pending[0]
+                   for user in self.users.values() if user.pending]
+
+        return {'users': users, 'seconds': seconds,
+                'updates_per_second': step['updates'] / seconds,
+                'journeys': step['journeys'],
+                'messages': len(self.api.sent) - step['sent'],
+                'images': len(latencies),
+                'unmatched_images': step['unmatched'],
+                'waiting_replies': len(waiting),
+                'oldest_waiting': max(waiting) if waiting else None,
+                'rejected': self.api.rejected - step['rejected'],
+                'driver_lag': step['lag'],
+                'latency': {'p50': fakeapi.percentile(latencies, 0.5),
+                            'p90': fakeapi.percentile(latencies, 0.9),
+                            'p99': fakeapi.percentile(latencies, 0.99),
+                            'max': fakeapi.percentile(latencies, 1.0)},
+                'rss': None if process is None else rss(process.pid),
+                'alive': process is None or process.poll() is None}
+
+
+# ---------------------------- Public Functions --------------------------
+
+
+def rss(pid):
+    """ Returns the resident memory (bytes) of a process and of all its
+    children, or None if it can not be read (only Linux is supported). The
+    children that exit while they are read are left out. """
+
+    total = _rss(pid)
+    if total is None:
+        return None
+    return total + sum(_rss(child) or 0 for child in _descendants(pid))
+
+
+def start_bot(api, options, directory):
+    """ Starts the bot in a new process, configured to use api, and returns
+    the process. """
+
+    token_file = os.path.join(directory, 'token.txt')
+    f = open(token_file, 'w')  # open on write mode
+    f.write(FAKE_TOKEN)
+    f.close()
+
+    config = {'city': options.city, 'cities': [options.city],
+              'bot_api_url': api.url, 'token_file': token_file,
+              'tile_url': api.tile_url, 'tile_directory': None,
+              'sessions_file': None, 'metrics_port': None,
+              'shards': options.shards, 'cpu_workers': options.cpu_workers}
+    if options.webhook:
+        config['webhook_url'] = 'http://127.0.0.1:%d/loadtest' % \
+            options.webhook
+        config['webhook_listen'] = ['127.0.0.1', options.webhook]
+
+    return subprocess.Popen([sys.executable, os.path.abspath(__file__),
+                             '--serve', json.dumps(config)])
+
+
+def stop_bot(process, timeout=30):
+    """ Stops the bot as Ctrl-C does (killing it after timeout seconds). """
+
+    if process.poll() is None:
+        process.send_signal(signal.SIGINT)
+        try:
+            process.wait(timeout)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+
+
+# ------------------------------ Private functions -----------------------
+
+
+def _rss(pid):
+    """ Returns the resident memory (bytes) of a single process, or None if
+    it can not be read (e.g. it has exited). """
+
+    try:
+        f = open('/proc/%d/status' % pid)  # open on read mode
+        try:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+        finally:
+            f.close()
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def _descendants(pid):
+    """ Returns the pids of the children of a process, recursively. The
+    processes (or threads) that exit while they are read are skipped. """
+
+    children = []
+    try:
+        tasks = os.listdir('/proc/%d/task' % pid)
+    except OSError:
+        return children
+    for task in tasks:
+        try:
+            f = open('/proc/%d/task/%s/children' % (pid, task))
+            children += [int(child) for child in f.read().split()]
+            f.close()
+        except OSError:
+            continue
+    return children + [grandchild for child in children
+                       for grandchild in _descendants(child)]
+
+
+# --------------------------------- Main ---------------------------------
+
+
+def main():
+    """ Starts the fake Bot API and the bot, runs the steps of users and
+    writes the measures as JSON. """
+
+    if len(sys.argv) == 3 and sys.argv[1] == '--serve':  # the bot process
+        bot.configure(json.loads(sys.argv[2]))
+        bot.main()
+        return
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--users', type=int, nargs='+',
+                        default=[10, 25, 50, 100, 200],
+                        help='simulated users of each step')
+    parser.add_argument('--step', type=float, default=30.0,
+                        help='seconds of each step')
+    parser.add_argument('--interval', type=float, default=2.0,
+                        help='seconds between the locations of a user')
+    parser.add_argument('--speed', type=float, default=5.0,
+                        help='speed (m/s) of the users')
+    parser.add_argument('--noise', type=float, default=5.0,
+                        help='GPS error (m, standard deviation)')
+    parser.add_argument('--off', type=float, default=0.2,
+                        help='fraction of the journeys that leave the route')
+    parser.add_argument('--max-latency', type=float, default=5.0,
+                        help='p90 latency (s) at which the bot has fallen')
+    parser.add_argument('--city', default=bot.city)
+    parser.add_argument('--shards', type=int, default=bot.shards)
+    parser.add_argument('--cpu-workers', type=int, default=bot.cpu_workers)
+    parser.add_argument('--webhook', type=int, default=0, metavar='PORT',
+                        help='use a webhook on this port (default: polling)')
+    parser.add_argument('--port', type=int, default=8081,
+                        help='port of the fake Bot API')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='JSON file (default: stdout)')
+    options = parser.parse_args()
+
+    graph = registry.load_city(options.city)  # downloaded if needed
+    api = fakeapi.FakeBotAPI(options.port)
+    api.start()
+    directory = tempfile.mkdtemp(prefix='loadtest-')
+    process = start_bot(api, options, directory)
+
+    steps = []
+    limit = None
+    try:
+        if not api.wait_connected(120):
+            raise RuntimeError('the bot did not connect')
+        time.sleep(1.0)  # let it finish starting
+        test = LoadTest(api, graph, options, options.seed)
+
+        for users in options.users:
+            print('%d users...' % users, file=sys.stderr)
+            step = test.run_step(users, options.step, process)
+            steps.append(step)
+            p90 = step['latency']['p90']
+            if not step['alive'] or (p90 is not None and
+                                     p90 > options.max_latency):
+                limit = users
+                break
+    finally:
+        stop_bot(process)
+        api.stop()
+
+    report = {'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'options': vars(options), 'limit': limit, 'steps': steps}
+    text = json.dumps(report, indent=2)
+    if options.output is None:
+        print(text)
+    else:
+        f = open(options.output, 'w')  # open on write mode
+        f.write(text + '\n')
+        f.close()
+
+
+if __name__ == "__main__":
+    main()
+
+
+##########################################################################
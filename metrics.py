@@ -0,0 +1,353 @@
+# ----------------------- METRICS MODULE -----------------------
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" This is the python script of the metrics module. It records where the
+time of the bot goes: latency histograms, counters and in-flight gauges of
+the telegram handlers (see handler) and of the stages of the guide (see
+stage).
+
+The metrics are served in the Prometheus text format by a local HTTP server
+(see serve), which can also switch on, at runtime, the sampled profiling of
+handlers: one of every so many handled updates is run under cProfile and its
+stats dumped to a file. Every handled update can also be written to a
+structured log (one JSON object per line).
+
+Metrics recorded in the worker processes of the bot are sent back with the
+result of the work and merged into the metrics of the bot (see collect). """
+
+
+import os  # standard library
+import json
+import time
+import random
+import cProfile
+import threading
+import contextlib
+from urllib.parse import urlparse, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+__title__ = "Metrics"
+__author__ = "Pau Matas and Tomás Gadea"
+__maintainer__ = "Pau Matas and Tomás Gadea"
+__email__ = "paumatasalbi@gmail.com and 01tomas.gadea@gmail.com"
+__status__ = "Production"
+
+
+PREFIX = 'scarlett_'  # prefix of the names of the exported metrics
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+           2.5, 5.0, 10.0, 30.0)  # upper bounds (seconds) of the histograms
+
+log_filename = None  # file of the structured log (None for no log)
+
+# Sampled profiling of the handlers (see set_profiling):
+_profiling = {'rate': 0.0, 'directory': 'profiles'}
+_profile_lock = threading.Lock()  # only one profiler can run at a time
+
+
+# ------------------------------ Metrics ---------------------------------
+
+
+class Metrics:
+    """ Thread-safe set of counters, gauges and histograms, each identified
+    by a name and a dict of labels. """
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = tuple(buckets)
+
+        self._counters = {}  # (name, labels) -> value
+        self._gauges = {}  # (name, labels) -> value
+        self._histograms = {}  # (name, labels) -> [bucket counts, sum]
+        self._lock = threading.Lock()
+
+    def inc(self, name, labels=None, amount=1):
+        """ Adds amount to a counter. """
+
+        key = (name, _labels(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def add(self, name, labels=None, amount=1):
+        """ Adds amount (which can be negative) to a gauge. """
+
+        key = (name, _labels(labels))
+        with self._lock:
+            self._gauges[key] = self._gauges.get(key, 0) + amount
+
+    def observe(self, name, labels=None, value=0.0):
+        """ Records a value (seconds) in a histogram. """
+
+        key = (name, _labels(labels))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = \
+                    [[0] * (len(self.buckets) + 1), 0.0]
+            i = 0
+            while i < len(self.buckets) and value > self.buckets[i]:
+                i += 1
+            histogram[0][i] += 1  # the last count is the +Inf bucket
+            histogram[1] += value
+
+    def export(self):
+        """ Returns a picklable copy of the counters and histograms (gauges
+        are not exported: they only make sense in their process). """
+
+        with self._lock:
+            return {'counters': dict(self._counters),
+                    'histograms': {key: [list(counts), total]
+                                   for key, (counts, total)
+                                   in self._histograms.items()}}
+
+    def merge(self, exported):
+        """ Adds the counters and histograms exported by another Metrics
+        (with the same buckets). """
+
+        with self._lock:
+            for key, value in exported['counters'].items():
+                self._counters[key] = self._counters.get(key, 0) + value
+            for key, (counts, total) in exported['histograms'].items():
+                histogram = self._histograms.get(key)
+                if histogram is None:
+                    self._histograms[key] = [list(counts), total]
+                else:
+                    histogram[0] = [a + b
+                                    for a, b in zip(histogram[0], counts)]
+                    histogram[1] += total
+
+    def reset(self):
+        """ Removes every metric. """
+
+        with self._lock:
+            self._counters.clear()
+            self._gauges.clear()
+            self._histograms.clear()
+
+    def text(self):
+        """ Returns the metrics in the Prometheus text exposition format. """
+
+        lines = []
+        with self._lock:
+            lines += _family(self._counters, 'counter')
+            lines += _family(self._gauges, 'gauge')
+
+            for name in sorted(set(key[0] for key in self._histograms)):
+                lines.append('# TYPE %s%s histogram' % (PREFIX, name))
+                for (other, labels), (counts, total) in \
+                        sorted(self._histograms.items()):
+                    if other != name:
+                        continue
+                    cumulative = 0
+                    bounds = [repr(b) for b in self.buckets] + ['+Inf']
+                    for bound, count in zip(bounds, counts):
+                        cumulative += count
+                        lines.append('%s%s_bucket%s %d' % (
+                            PREFIX, name,
+                            _format(labels + (('le', bound),)), cumulative))
+                    lines.append('%s%s_sum%s %r' % (PREFIX, name,
+                                                    _format(labels), total))
+                    lines.append('%s%s_count%s %d' % (PREFIX, name,
+                                                      _format(labels),
+                                                      cumulative))
+        return '\n'.join(lines) + '\n'
+
+
+# Metrics recorded by this process:
+recorded = Metrics()
+
+
+# ---------------------------- Public Functions --------------------------
+
+
+@contextlib.contextmanager
+def stage(name):
+    """ Context manager that records the seconds spent in a stage of the
+    guide (geocode, snap, route, sections, render, upload...). """
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        recorded.observe('stage_seconds', {'stage': name},
+                         time.perf_counter() - start)
+
+
+def handler(name, function):
+    """ Returns a telegram handler that runs function(update, context)
+    recording its latency, its result (ok or error) and the number of
+    updates being handled. Sampled updates are profiled (see set_profiling)
+    and every update is logged if log_filename is set. """
+
+    labels = {'handler': name}
+
+    def measured(update, context):
+        recorded.add('handler_in_flight', labels, 1)
+        profiler = _start_profiler()
+        start = time.perf_counter()
+        status = 'ok'
+        try:
+            return function(update, context)
+        except Exception:
+            status = 'error'
+            raise
+        finally:
+            seconds = time.perf_counter() - start
+            recorded.add('handler_in_flight', labels, -1)
+            recorded.observe('handler_seconds', labels, seconds)
+            recorded.inc('handler_total', dict(labels, status=status))
+            if profiler is not None:
+                _stop_profiler(profiler, name)
+            if log_filename is not None:
+                _log({'time': time.time(), 'handler': name,
+                      'chat': _chat_id(update), 'seconds': seconds,
+                      'status': status})
+
+    return measured
+
+
+def collect(function, *args, **kwargs):
+    """ Runs function(*args, **kwargs) in a worker process and returns the
+    tuple (result, metrics recorded meanwhile), to be merged in the bot with
+    recorded.merge. """
+
+    recorded.reset()
+    result = function(*args, **kwargs)
+    return result, recorded.export()
+
+
+def set_profiling(rate, directory=None):
+    """ Profiles a fraction rate (0 to 1) of the handled updates from now on,
+    dumping their cProfile stats into directory. 0 switches it off. """
+
+    _profiling['rate'] = min(max(float(rate), 0.0), 1.0)
+    if directory is not None:
+        _profiling['directory'] = directory
+
+
+def serve(port=9100, host='127.0.0.1'):
+    """ Starts, in a background thread, the HTTP server of the metrics and
+    returns it. GET /metrics returns the metrics and GET /profile?rate=r
+    sets the profiling rate (see set_profiling). The profiles directory can
+    only be set by the bot itself, not by the clients of the server. """
+
+    server = ThreadingHTTPServer((host, port), _Handler)
+    thread = threading.Thread(target=server.serve_forever, name='metrics',
+                              daemon=True)
+    thread.start()
+    return server
+
+
+# ------------------------------ Private functions -----------------------
+
+
+class _Handler(BaseHTTPRequestHandler):
+    """ Requests of the metrics HTTP server. """
+
+    def do_GET(self):
+        url = urlparse(self.path)
+
+        if url.path == '/metrics':
+            self._reply(200, recorded.text(),
+                        'text/plain; version=0.0.4; charset=utf-8')
+
+        elif url.path == '/profile':
+            query = parse_qs(url.query)
+            try:
+                if 'rate' in query:
+                    set_profiling(query['rate'][0])
+            except ValueError:
+                self._reply(400, 'bad rate\n', 'text/plain')
+                return
+            self._reply(200, json.dumps(_profiling) + '\n',
+                        'application/json')
+
+        else:
+            self._reply(404, 'not found\n', 'text/plain')
+
+    def log_message(self, format, *args):
+        pass  # scrapes are not worth a line of output
+
+    def _reply(self, code, text, content_type):
+        body = text.encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def _start_profiler():
+    """ Returns a running profiler if this update is sampled (and no other
+    one is being profiled), None otherwise. """
+
+    rate = _profiling['rate']
+    if rate <= 0.0 or random.random() >= rate:
+        return None
+    if not _profile_lock.acquire(blocking=False):
+        return None
+
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:  # another profiling tool is active
+        _profile_lock.release()
+        return None
+    return profiler
+
+
+def _stop_profiler(profiler, name):
+    """ Stops a profiler and dumps its stats to the profiles directory. """
+
+    try:
+        profiler.disable()
+        directory = _profiling['directory']
+        os.makedirs(directory, exist_ok=True)
+        profiler.dump_stats(os.path.join(directory, '%s-%d-%d.prof' % (
+            name, time.time() * 1000, threading.get_ident())))
+    finally:
+        _profile_lock.release()
+
+
+def _log(record):
+    """ Appends a record to the structured log. """
+
+    f = open(log_filename, 'a')  # open on append mode
+    f.write(json.dumps(record) + '\n')
+    f.close()
+
+
+def _chat_id(update):
+    chat = getattr(update, 'effective_chat', None)
+    return getattr(chat, 'id', None)
+
+
+def _labels(labels):
+    """ Returns the labels dict as a sorted tuple of pairs (a dict key). """
+
+    return tuple(sorted((labels or {}).items()))
+
+
+def _format(labels):
+    """ Returns the labels in Prometheus format: {a="1",b="2"}. """
+
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (key, str(value).replace('"', r'\"'))
+                             for key, value in labels)
+
+
+def _family(values, kind):
+    """ Returns the lines of the counters or gauges in values. """
+
+    lines = []
+    for name in sorted(set(key[0] for key in values)):
+        lines.append('# TYPE %s%s %s' % (PREFIX, name, kind))
+        for (other, labels), value in sorted(values.items()):
+            if other == name:
+                lines.append('%s%s%s %r' % (PREFIX, name, _format(labels),
+                                            value))
+    return lines
+
+
+##########################################################################
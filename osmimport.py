@@ -0,0 +1,434 @@
+# ----------------------- OSMIMPORT MODULE -----------------------
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" This is the python script of the osmimport module. It builds the compact
+graph (see compact module) of the streets of a local OpenStreetMap extract
+(.osm, .osm.bz2, .osm.gz or .osm.pbf file), without any network query.
+
+The extract is streamed twice: first the drivable ways are read (only their
+nodes, name and direction are kept, in flat arrays), then only the
+coordinates of the nodes of those ways. So the memory used grows with the
+size of the street network, not with the size of the extract. Lengths and
+bearings are computed at once with NumPy, and the ways are split in edges
+at the intersections (nodes shared by several ways) and at their ends, as
+osmnx does when it simplifies a graph. Extracts clipped by a bounding box
+have ways with nodes outside of it: the ways are cut there and the
+segments of those nodes are left out.
+
+The module can also be run as a script:
+
+    python3 osmimport.py catalonia.osm.pbf Barcelona_map.cg --name Barcelona
+
+Reading .osm.pbf files needs the osmium package (pip install osmium). """
+
+
+import bz2  # standard library
+import gzip
+import argparse
+from array import array
+import xml.etree.ElementTree as ET
+
+import numpy as np  # 3rd party packages
+
+import compact  # local source
+import guide
+
+
+__title__ = "Osmimport"
+__author__ = "Pau Matas and Tomás Gadea"
+__maintainer__ = "Pau Matas and Tomás Gadea"
+__email__ = "paumatasalbi@gmail.com and 01tomas.gadea@gmail.com"
+__status__ = "Production"
+
+
+# Values of the highway tag of the ways cars can drive (as osmnx 'drive'):
+DRIVABLE = {'motorway', 'motorway_link', 'trunk', 'trunk_link', 'primary',
+            'primary_link', 'secondary', 'secondary_link', 'tertiary',
+            'tertiary_link', 'unclassified', 'residential', 'living_street',
+            'road'}
+NO_ACCESS = {'no', 'private'}  # values of access tags that exclude a way
+CHUNK = 100000  # nodes read before filtering them (see _Coords)
+
+
+# ---------------------------- Public Functions --------------------------
+
+
+def import_osm(filename, directory, name=None):
+    """ Builds the compact graph of the drivable streets of an OpenStreetMap
+    extract, saves it into directory (with its spatial index, as
+    guide.save_graph) and returns it. """
+
+    ways = read_ways(filename)
+    if not ways.refs:
+        raise ValueError('no drivable streets in ' + filename)
+
+    needed = np.unique(np.frombuffer(ways.refs, np.int64))
+    lat, lon = read_node_coords(filename, needed)
+
+    graph = build_graph(ways, needed, lat, lon, name or '')
+    if graph.meta['missing_nodes']:
+        print("%d nodes of the streets are not in %s: %d segments left out" %
+              (graph.meta['missing_nodes'], filename,
+               graph.meta['dropped_segments']))
+    guide.save_graph(graph, directory)
+    return graph
+
+
+def read_ways(filename):
+    """ Returns the drivable ways (see Ways) of an extract. """
+
+    ways = Ways()
+    if filename.endswith('.pbf'):
+        _pbf_ways(filename, ways)
+    else:
+        for element in _xml_elements(filename, 'way'):
+            tags = {tag.get('k'): tag.get('v')
+                    for tag in element.iter('tag')}
+            refs = [int(nd.get('ref')) for nd in element.iter('nd')]
+            ways.add(refs, tags)
+    return ways
+
+
+def read_node_coords(filename, needed):
+    """ Returns two arrays with the latitude and longitude of the nodes of
+    the extract whose id is in needed (sorted array of ids), in the same
+    order. The coordinates of the nodes missing in the extract are NaN. """
+
+    coords = _Coords(needed)
+    if filename.endswith('.pbf'):
+        _pbf_nodes(filename, coords)
+    else:
+        for element in _xml_elements(filename, 'node'):
+            coords.add(int(element.get('id')), float(element.get('lat')),
+                       float(element.get('lon')))
+    coords.flush()
+    return coords.lat, coords.lon
+
+
+def build_graph(ways, needed, lat, lon, name=''):
+    """ Returns the CompactGraph of the ways, whose nodes (sorted array of
+    ids needed) have coordinates lat, lon. Only the largest weakly
+    connected component is kept, as osmnx does.
+
+    Nodes with NaN coordinates (missing in the extract) cut their ways: the
+    segments that reach them are left out. Their number and the number of
+    segments left out are kept in the metadata of the graph
+    (missing_nodes, dropped_segments). """
+
+    refs = np.frombuffer(ways.refs, np.int64)
+    starts = np.frombuffer(ways.starts, np.int64)
+    ends = np.append(starts[1:], len(refs))
+    way_of = np.repeat(np.arange(len(starts)), ends - starts)
+    pos = np.searchsorted(needed, refs)  # position of the node of each ref
+    known = ~np.isnan(lat[pos])
+    missing = np.flatnonzero(~known)  # refs to nodes not in the extract
+    gaps = np.cumsum(~known)  # missing refs up to every position
+
+    # Length of every segment (the ones between ways, or with a missing
+    # node, are not used):
+    seg = _haversine(lat[pos[:-1]], lon[pos[:-1]], lat[pos[1:]],
+                     lon[pos[1:]])
+    cumulative = np.concatenate([[0.0], np.cumsum(np.nan_to_num(seg))])
+    inner = way_of[:-1] == way_of[1:]
+    dropped = np.count_nonzero(inner & ~(known[:-1] & known[1:]))
+
+    # Graph nodes: intersections (nodes in more than one way position) and
+    # ends of ways, which are also cut next to their missing nodes. Edges
+    # join consecutive graph nodes of the same way with no missing node
+    # between them:
+    counts = np.bincount(pos, minlength=len(needed))
+    split = counts[pos] > 1
+    split[starts] = True
+    split[ends - 1] = True
+    split[missing[missing > 0] - 1] = True
+    split[missing[missing < len(pos) - 1] + 1] = True
+    split &= known
+    marked = np.flatnonzero(split)
+    first, second = marked[:-1], marked[1:]
+    same_way = (way_of[first] == way_of[second]) & \
+        (gaps[first] == gaps[second])
+    first, second = first[same_way], second[same_way]
+
+    u, v = pos[first], pos[second]
+    length = cumulative[second] - cumulative[first]
+    way = way_of[first]
+    oneway = np.frombuffer(ways.oneway, np.int8)[way]
+    name_id = np.frombuffer(ways.name_id, np.int32)[way]
+
+    forward = oneway >= 0
+    backward = oneway <= 0
+    u, v = np.concatenate([u[forward], v[backward]]), \
+        np.concatenate([v[forward], u[backward]])
+    length = np.concatenate([length[forward], length[backward]])
+    name_id = np.concatenate([name_id[forward], name_id[backward]])
+
+    loops = u == v
+    u, v, length, name_id = u[~loops], v[~loops], length[~loops], \
+        name_id[~loops]
+
+    # Graph nodes (positions in needed of the ends of the edges), numbered
+    # 0..n-1, and only the ones of the largest component are kept:
+    used = np.zeros(len(needed), bool)
+    used[u] = True
+    used[v] = True
+    nodes = np.flatnonzero(used)
+    index = np.full(len(needed), -1, np.int64)
+    index[nodes] = np.arange(len(nodes))
+    u, v = index[u], index[v]
+
+    keep = _largest_component(u, v, len(nodes))
+    kept = keep[u]  # v is in the same component
+    u, v, length, name_id = u[kept], v[kept], length[kept], name_id[kept]
+    index = np.full(len(nodes), -1, np.int64)
+    index[keep] = np.arange(np.count_nonzero(keep))
+    u, v = index[u], index[v]
+    nodes = nodes[keep]
+
+    # Parallel edges: only the shortest one is kept (as from_networkx):
+    order = np.lexsort((length, v, u))
+    u, v, length, name_id = u[order], v[order], length[order], name_id[order]
+    unique = np.ones(len(u), bool)
+    unique[1:] = (u[1:] != u[:-1]) | (v[1:] != v[:-1])
+    u, v, length, name_id = u[unique], v[unique], length[unique], \
+        name_id[unique]
+
+    node_lat, node_lon = lat[nodes], lon[nodes]
+    bearing = _bearing(node_lat[u], node_lon[u], node_lat[v], node_lon[v])
+    degree = np.bincount(u, minlength=len(nodes))
+    indptr = np.concatenate([[0], np.cumsum(degree)])
+
+    arrays = {'osmid': needed[nodes].astype(np.int64),
+              'lat': node_lat,
+              'lon': node_lon,
+              'indptr': indptr.astype(np.int64),
+              'indices': v.astype(np.int32),
+              'length': length.astype(np.float32),
+              'bearing': bearing.astype(np.float32),
+              'name_id': name_id.astype(np.int32)}
+
+    graph = compact.CompactGraph(
+        arrays, ways.names,
+        {'name': name,
+         'missing_nodes': int(np.count_nonzero(np.isnan(lat))),
+         'dropped_segments': int(dropped)})
+    graph.bounds()  # kept in the metadata (see registry.city_of)
+    return graph
+
+
+# --------------------------------- Ways ---------------------------------
+
+
+class Ways:
+    """ Drivable ways of an extract, in flat arrays: the node ids of the way
+    i are refs[starts[i]:starts[i + 1]], its street name is names[name_id[i]]
+    (-1 if it has none) and oneway[i] is 1 (only forward), -1 (only
+    backward) or 0 (both directions). """
+
+    def __init__(self):
+        self.refs = array('q')
+        self.starts = array('q')
+        self.name_id = array('i')
+        self.oneway = array('b')
+        self.names = []
+        self._name_ids = {}  # street name -> position in names
+
+    def add(self, refs, tags):
+        """ Adds a way (list of node ids and dict of tags) if it is drivable.
+        """
+
+        if not drivable(tags) or len(refs) < 2:
+            return
+
+        street = tags.get('name')
+        if street is not None and street not in self._name_ids:
+            self._name_ids[street] = len(self.names)
+            self.names.append(street)
+
+        self.starts.append(len(self.refs))
+        self.refs.extend(refs)
+        self.name_id.append(-1 if street is None else self._name_ids[street])
+        self.oneway.append(oneway(tags))
+
+
+def drivable(tags):
+    """ Returns True if the tags of a way are the ones of a street open to
+    cars. """
+
+    return tags.get('highway') in DRIVABLE and \
+        tags.get('area') != 'yes' and \
+        tags.get('access') not in NO_ACCESS and \
+        tags.get('motor_vehicle') not in NO_ACCESS and \
+        tags.get('motorcar') not in NO_ACCESS
+
+
+def oneway(tags):
+    """ Returns the direction of a way: 1 (only forward), -1 (only backward)
+    or 0 (both). """
+
+    value = tags.get('oneway')
+    if value in ('yes', 'true', '1'):
+        return 1
+    if value == '-1':
+        return -1
+    if value is None and (tags.get('junction') == 'roundabout' or
+                          tags.get('highway') == 'motorway'):
+        return 1
+    return 0
+
+
+# ------------------------------ Private functions -----------------------
+
+
+def _xml_elements(filename, tag):
+    """ Yields the top-level elements named tag of an .osm (XML) file,
+    freeing every element once it has been read. """
+
+    if filename.endswith('.bz2'):
+        f = bz2.open(filename, 'rb')
+    elif filename.endswith('.gz'):
+        f = gzip.open(filename, 'rb')
+    else:
+        f = open(filename, 'rb')  # open on read mode
+
+    try:
+        elements = ET.iterparse(f, events=('start', 'end'))
+        event, root = next(elements)
+        for event, element in elements:
+            if event == 'end' and element.tag in ('node', 'way', 'relation'):
+                if element.tag == tag:
+                    yield element
+                root.clear()  # free the elements read so far
+    finally:
+        f.close()
+
+
+def _pbf_ways(filename, ways):
+    """ Reads the drivable ways of a .osm.pbf file into ways. """
+
+    osmium = _osmium()
+
+    class Handler(osmium.SimpleHandler):
+        def way(self, way):
+            ways.add([nd.ref for nd in way.nodes],
+                     {tag.k: tag.v for tag in way.tags})
+
+    Handler().apply_file(filename)
+
+
+def _pbf_nodes(filename, coords):
+    """ Reads the nodes of a .osm.pbf file into coords (see _Coords). """
+
+    osmium = _osmium()
+
+    class Handler(osmium.SimpleHandler):
+        def node(self, node):
+            coords.add(node.id, node.location.lat, node.location.lon)
+
+    Handler().apply_file(filename)
+
+
+def _osmium():
+    try:
+        import osmium
+    except ImportError:
+        raise ImportError('reading .osm.pbf files needs the osmium package '
+                          '(pip install osmium)')
+    return osmium
+
+
+class _Coords:
+    """ Coordinates (lat, lon arrays, NaN until read) of the needed nodes
+    (sorted array of ids). The nodes read are filtered in chunks, with NumPy
+    instead of a set of ids. """
+
+    def __init__(self, needed):
+        self.needed = needed
+        self.lat = np.full(len(needed), np.nan)
+        self.lon = np.full(len(needed), np.nan)
+        self._chunk = (array('q'), array('d'), array('d'))
+
+    def add(self, node, lat, lon):
+        ids, lats, lons = self._chunk
+        ids.append(node)
+        lats.append(lat)
+        lons.append(lon)
+        if len(ids) >= CHUNK:
+            self.flush()
+
+    def flush(self):
+        ids, lats, lons = (np.frombuffer(values, dtype) for values, dtype
+                           in zip(self._chunk,
+                                  (np.int64, np.float64, np.float64)))
+        self._chunk = (array('q'), array('d'), array('d'))
+        if not len(ids):
+            return
+
+        pos = np.minimum(np.searchsorted(self.needed, ids),
+                         len(self.needed) - 1)
+        found = self.needed[pos] == ids
+        self.lat[pos[found]] = lats[found]
+        self.lon[pos[found]] = lons[found]
+
+
+def _haversine(lat1, lon1, lat2, lon2):
+    """ Returns the haversine distances (meters) between arrays of points. """
+
+    lat1, lon1, lat2, lon2 = (np.radians(a) for a in (lat1, lon1, lat2, lon2))
+    h = np.sin((lat2 - lat1) / 2)**2 + \
+        np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2)**2
+    return 2 * guide.EARTH_RADIUS * np.arcsin(np.sqrt(np.minimum(h, 1.0)))
+
+
+def _bearing(lat1, lon1, lat2, lon2):
+    """ Returns the compass bearings (degrees) from arrays of points to
+    others, as osmnx add_edge_bearings. """
+
+    lat1, lon1, lat2, lon2 = (np.radians(a) for a in (lat1, lon1, lat2, lon2))
+    x = np.sin(lon2 - lon1) * np.cos(lat2)
+    y = np.cos(lat1) * np.sin(lat2) - \
+        np.sin(lat1) * np.cos(lat2) * np.cos(lon2 - lon1)
+    return np.degrees(np.arctan2(x, y)) % 360
+
+
+def _largest_component(u, v, n):
+    """ Returns the boolean mask of the nodes (0..n-1) in the largest weakly
+    connected component of the edges u->v (every node must be the end of
+    some edge).
+
+    The components are found with whole-array operations: every round the
+    root of each edge end is hooked to the smaller root of the edge, and
+    then every node jumps to its root, until both ends of every edge have
+    the same root. """
+
+    root = np.arange(n)
+    while True:
+        ru, rv = root[u], root[v]
+        if np.array_equal(ru, rv):
+            break
+        low = np.minimum(ru, rv)
+        np.minimum.at(root, ru, low)  # roots only point to smaller nodes
+        np.minimum.at(root, rv, low)
+        while True:  # pointer jumping, to the roots
+            jumped = root[root]
+            if np.array_equal(jumped, root):
+                break
+            root = jumped
+
+    return root == np.argmax(np.bincount(root, minlength=n))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Build a compact city graph from an OpenStreetMap '
+        'extract.')
+    parser.add_argument('extract', help='.osm, .osm.bz2, .osm.gz or .osm.pbf')
+    parser.add_argument('directory', help='output directory')
+    parser.add_argument('--name', help='name of the city')
+    args = parser.parse_args()
+
+    graph = import_osm(args.extract, args.directory, args.name)
+    print(graph, '->', args.directory)
+
+
+##########################################################################
@@ -0,0 +1,221 @@
+# ----------------------- OUTBOX MODULE -----------------------
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" This is the python script of the outbox module. It defines the telegram
+Bot used by the bot to send its messages and photos.
+
+Sending is the slowest part of handling an update, so the messages are sent
+by many threads at once (the tasks of the users, see scheduler module) over
+a pool of kept-alive connections to the Bot API, instead of opening one per
+message. Telegram limits how fast a bot can send (about 30 messages per
+second in total and one per second to the same chat, on average: short
+bursts, like the photo and the text of a checkpoint, are accepted):
+RateLimiter makes the senders wait for their turn, so messages are spread
+instead of rejected, and when Telegram still asks to wait (RetryAfter) the
+message is sent again after the given time.
+
+The module can also be run as a script, to check that the send times given
+by RateLimiter never go over the limit of Telegram (simulated clock, it
+takes no time):
+
+    python3 outbox.py --seconds 120 """
+
+
+import sys  # standard library
+import time
+import random
+import argparse
+import threading
+
+import telegram  # 3rd party packages
+from telegram.error import RetryAfter
+from telegram.utils.request import Request
+
+import metrics  # local source
+
+
+__title__ = "Outbox"
+__author__ = "Pau Matas and Tomás Gadea"
+__maintainer__ = "Pau Matas and Tomás Gadea"
+__email__ = "paumatasalbi@gmail.com and 01tomas.gadea@gmail.com"
+__status__ = "Production"
+
+
+RATE = 25.0  # max messages per second of a bot (all chats). With the burst,
+# at most 30 are sent in any second, the limit of Telegram.
+CHAT_RATE = 1.0  # max messages per second to the same chat
+BURST = 5  # messages that can be sent at once before waiting for the rate
+CHAT_BURST = 3  # the same, to one chat (the replies to a reroute)
+LIMIT = 30  # max messages per second accepted by Telegram
+
+
+# ------------------------------ Rate limiter ----------------------------
+
+
+class RateLimiter:
+    """ Thread-safe limiter of the messages sent per second: in total (rate,
+    allowing bursts of burst messages) and to each chat (chat_rate, allowing
+    bursts of chat_burst messages). clock returns the current time in
+    seconds (time.monotonic, or a simulated clock). """
+
+    def __init__(self, rate=RATE, chat_rate=CHAT_RATE, burst=BURST,
+                 chat_burst=CHAT_BURST, clock=time.monotonic):
+        self.rate = rate
+        self.chat_rate = chat_rate
+        self.burst = burst
+        self.chat_burst = chat_burst
+        self.clock = clock
+
+        self._next = clock()  # when the bucket is empty again
+        self._chats = {}  # chat -> when its bucket is empty again
+        self._lock = threading.Lock()
+
+    def reserve(self, chat):
+        """ Returns the seconds to wait before sending a message to chat. The
+        slot is reserved: the caller must send it after that time. """
+
+        with self._lock:
+            now = self.clock()
+
+            # Token buckets (as virtual schedules): a message can be sent
+            # burst - 1 intervals before _next, the time at which the
+            # messages reserved so far would have been sent at the rate.
+            # The same with the bucket of the chat, which is looked at
+            # first: the slot of the bot is taken at the time the message
+            # is really sent, so at most burst + rate messages are sent in
+            # any second.
+            chat_next = self._chats.get(chat, now)
+            start = max(now,
+                        chat_next - (self.chat_burst - 1) / self.chat_rate,
+                        self._next - (self.burst - 1) / self.rate)
+            self._next = max(self._next, start) + 1.0 / self.rate
+            self._chats[chat] = max(chat_next, start) + 1.0 / self.chat_rate
+
+            if len(self._chats) > 4096:  # forget the chats already free
+                self._chats = {chat: free for chat, free in self._chats.items()
+                               if free > now}
+            return start - now
+
+    def wait(self, chat):
+        """ Waits until a message can be sent to chat. """
+
+        seconds = self.reserve(chat)
+        if seconds > 0:
+            metrics.recorded.observe('send_wait_seconds', None, seconds)
+            time.sleep(seconds)
+
+
+# ------------------------------ Bot -------------------------------------
+
+
+class Bot(telegram.Bot):
+    """ telegram Bot whose send_message and send_photo wait for the rate
+    limits (see RateLimiter) and are sent again, up to retries times, when
+    Telegram asks to wait. Timeouts are not retried: the message may have
+    been delivered.
+
+    The requests go through a pool of pool_size connections to base_url (the
+    Bot API of Telegram, or a local stand-in such as fakeapi). """
+
+    def __init__(self, token, base_url=None, pool_size=8, limiter=None,
+                 retries=3):
+        telegram.Bot.__init__(self, token, base_url=base_url,
+                              request=Request(con_pool_size=pool_size))
+        self.limiter = RateLimiter() if limiter is None else limiter
+        self.retries = retries
+
+    def send_message(self, *args, **kwargs):
+        return self._send(telegram.Bot.send_message, 'send_message', args,
+                          kwargs)
+
+    def send_photo(self, *args, **kwargs):
+        return self._send(telegram.Bot.send_photo, 'send_photo', args,
+                          kwargs)
+
+    def _send(self, send, name, args, kwargs):
+        chat = kwargs['chat_id'] if 'chat_id' in kwargs else args[0]
+        photo = kwargs.get('photo')
+
+        for attempt in range(self.retries + 1):
+            self.limiter.wait(chat)
+            if hasattr(photo, 'seek'):  # the file was read by the last try
+                photo.seek(0)
+            try:
+                return send(self, *args, **kwargs)
+            except RetryAfter as error:
+                if attempt == self.retries:
+                    raise
+                metrics.recorded.inc('send_retries_total', {'method': name})
+                time.sleep(error.retry_after)
+
+
+# ------------------------------ Check -----------------------------------
+
+
+def simulate(limiter, seconds=60.0, chats=40, messages=6, seed=0):
+    """ Returns the sorted send times given by limiter (whose clock must be
+    simulated, see SimulatedClock) to chats that send bursts of messages at
+    random times during some seconds, while new chats keep arriving. """
+
+    rng = random.Random(seed)
+    clock = limiter.clock
+    requests = []  # (time, chat)
+    for chat in range(chats):  # the regular users, in bursts
+        when = rng.uniform(0, 1)
+        while when < seconds:
+            requests += [(when, chat)] * rng.randint(1, messages)
+            when += rng.expovariate(1.0)
+    when = 0.0
+    while when < seconds:  # new chats, one message each
+        requests.append((when, chats + len(requests)))
+        when += rng.expovariate(10.0)
+
+    sent = []
+    for when, chat in sorted(requests):
+        clock.now = when
+        sent.append(when + limiter.reserve(chat))
+    return sorted(sent)
+
+
+def max_per_second(sent):
+    """ Returns the max number of the (sorted) times sent in any window of
+    one second (closed at both ends). """
+
+    most, first = 0, 0
+    for last, when in enumerate(sent):
+        while when - sent[first] > 1.0 + 1e-9:
+            first += 1
+        most = max(most, last - first + 1)
+    return most
+
+
+class SimulatedClock:
+    """ Clock of a RateLimiter that returns now, set by the caller. """
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Check the send times of the rate limiter.')
+    parser.add_argument('--seconds', type=float, default=60.0)
+    parser.add_argument('--chats', type=int, default=40)
+    parser.add_argument('--messages', type=int, default=6,
+                        help='max messages of a burst of a chat')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    sent = simulate(RateLimiter(clock=SimulatedClock()), args.seconds,
+                    args.chats, args.messages, args.seed)
+    most = max_per_second(sent)
+    print('%d messages, at most %d in one second (limit %d)' %
+          (len(sent), most, LIMIT))
+    sys.exit(0 if most <= LIMIT else 1)
+
+
+##########################################################################
@@ -0,0 +1,296 @@
+# ----------------------- REGISTRY MODULE -----------------------
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" This is the python script of the registry module. It defines
+GraphRegistry, the owner of the city graphs used by the bot.
+
+Every city (place name) has a CityGraph: its graph is loaded (or downloaded
+and cached on disk) only once, possibly in a background thread while the bot
+is already answering, and then the same read-only instance is handed out to
+every conversation. The registry keeps several cities loaded while they fit
+in a memory budget; when they don't, the least recently used ones are
+evicted, and loaded again from the on-disk cache (without downloading them)
+the next time a user needs them. """
+
+
+import os  # standard library
+import time
+import threading
+from collections import OrderedDict
+
+import compact  # local source
+import guide
+
+
+__title__ = "Registry"
+__author__ = "Pau Matas and Tomás Gadea"
+__maintainer__ = "Pau Matas and Tomás Gadea"
+__email__ = "paumatasalbi@gmail.com and 01tomas.gadea@gmail.com"
+__status__ = "Production"
+
+
+BUDGET = 1024 * 2**20  # default memory budget (bytes) for the loaded graphs
+
+
+# ---------------------------- Public Functions --------------------------
+
+
+def load_city(place, directory='.'):
+    """ Returns the compact graph of a city, loaded from directory (see
+    prepare_city). """
+
+    return guide.load_graph(prepare_city(place, directory))
+
+
+def prepare_city(place, directory='.'):
+    """ Saves the compact graph of a city in directory, with every file it
+    needs (see guide.prepare_graph), and returns its path. If it is not there,
+    converts the pickled graph of older versions or, if there is none either,
+    downloads the graph first. Nothing is kept loaded. """
+
+    filename = city_filename(place, directory)
+    if not compact.is_compact(filename + ".cg"):
+        if not os.path.exists(filename):
+            print("downloading...")
+            guide.save_graph(guide.download_graph(place), filename)
+            print("downloaded!")
+        print("converting...")
+        compact.convert_pickle(filename, filename + ".cg")
+
+    guide.prepare_graph(filename + ".cg")
+    return filename + ".cg"
+
+
+def city_filename(place, directory='.'):
+    """ Returns the name of the (pickle) file of the graph of a city. The
+    compact graph is saved in the same name followed by ".cg". """
+
+    return os.path.join(directory, place + "_map")
+
+
+def resident_size(graph):
+    """ Returns the bytes used by a loaded graph: its arrays and its node
+    index. """
+
+    return guide.graph_nbytes(graph)
+
+
+# ------------------------------ City graph ------------------------------
+
+
+class CityGraph:
+    """ Loads the graph of a city once and shares it.
+
+    warm() starts loading the graph in a background thread and returns at
+    once; get() returns the graph, waiting for it if it is still loading.
+    unload() forgets the graph, so the next get() loads it again. """
+
+    def __init__(self, place, directory='.', on_load=None):
+        self.place = place
+        self.directory = directory
+        self.on_load = on_load  # called with this CityGraph once loaded
+        self.load_time = None  # seconds it took to load the graph
+        self.nbytes = None  # resident size of the graph
+        self.loads = 0  # number of times the graph has been loaded
+        self.error = None  # exception raised while loading, if any
+
+        self._graph = None
+        self._bounds = None
+        self._loaded = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def warm(self):
+        """ Starts loading the graph in the background, unless it is already
+        loaded or loading. Never blocks. """
+
+        with self._lock:
+            if self._thread is None or (self.error is not None and
+                                        not self._thread.is_alive()):
+                self.error = None
+                self._loaded.clear()
+                self._thread = threading.Thread(target=self._load,
+                                                name='warm-' + self.place,
+                                                daemon=True)
+                self._thread.start()
+
+    def get(self, timeout=None):
+        """ Returns the graph of the city, loading it if needed. Raises the
+        exception of the load if it failed, or TimeoutError if the graph is
+        not loaded after timeout seconds. """
+
+        while True:
+            self.warm()
+            if not self._loaded.wait(timeout):
+                raise TimeoutError('graph of %s is still loading' %
+                                   self.place)
+            if self.error is not None:
+                raise self.error
+
+            graph = self._graph
+            if graph is not None:
+                return graph
+            # unloaded while we were waiting: load it again
+
+    def ready(self):
+        """ Returns True if the graph is loaded. """
+
+        return self._loaded.is_set() and self._graph is not None
+
+    def unload(self):
+        """ Forgets the graph. It is freed once no conversation uses it. """
+
+        with self._lock:
+            if self._loaded.is_set():
+                self._graph = None
+                self._thread = None
+                self._loaded.clear()
+
+    def bounds(self):
+        """ Returns the bounding box (south, west, north, east) of the city,
+        or None if it is unknown (the city has never been converted). """
+
+        if self._bounds is None:
+            graph = self._graph
+            if graph is not None:
+                self._bounds = graph.bounds()
+            else:
+                try:
+                    meta = compact.load_meta(
+                        city_filename(self.place, self.directory) + ".cg")
+                except FileNotFoundError:
+                    return None
+                if 'bounds' in meta:
+                    self._bounds = tuple(meta['bounds'])
+        return self._bounds
+
+    def stats(self):
+        """ Returns a dict with the load time (seconds) of the graph, its
+        resident size (bytes) and the number of times it has been loaded. """
+
+        return {'place': self.place, 'loaded': self.ready(),
+                'load_time': self.load_time, 'nbytes': self.nbytes,
+                'loads': self.loads}
+
+    def _load(self):
+        start = time.perf_counter()
+        try:
+            graph = load_city(self.place, self.directory)
+            self.nbytes = resident_size(graph)
+            self._graph = graph
+            self.loads += 1
+        except Exception as error:
+            self.error = error
+        finally:
+            self.load_time = time.perf_counter() - start
+            self._loaded.set()
+
+        if self.error is None:
+            print("%s loaded in %.2f s (%.1f MB)" % (
+                self.place, self.load_time, self.nbytes / 2**20))
+            if self.on_load is not None:
+                self.on_load(self)
+
+
+# ------------------------------ Registry --------------------------------
+
+
+class GraphRegistry:
+    """ Graphs of several cities, keyed by place name.
+
+    Graphs are loaded lazily, the first time they are needed. While the sum
+    of their resident sizes is above budget (bytes), the least recently used
+    cities are unloaded (the last one loaded is always kept). """
+
+    def __init__(self, places, default=None, directory='.', budget=BUDGET):
+        self.places = list(places)
+        self.default = default if default is not None else self.places[0]
+        self.directory = directory
+        self.budget = budget
+
+        self._cities = {place: CityGraph(place, directory, self._loaded)
+                        for place in self.places}
+        self._recent = OrderedDict()  # loaded places, least recent first
+        self._lock = threading.Lock()
+
+    def get(self, place=None, timeout=None):
+        """ Returns the graph of a city (the default one if place is None).
+        Raises KeyError if the city is not served. """
+
+        city = self._city(place)
+        self._touch(city.place)
+        return city.get(timeout)
+
+    def warm(self, place=None):
+        """ Starts loading the graph of a city in the background. """
+
+        self._city(place).warm()
+
+    def ready(self, place=None):
+        """ Returns True if the graph of a city is loaded. """
+
+        return self._city(place).ready()
+
+    def find(self, name):
+        """ Returns the served place whose name matches name (ignoring case),
+        or None. """
+
+        for place in self.places:
+            if place.lower() == name.strip().lower():
+                return place
+        return None
+
+    def city_of(self, location):
+        """ Returns the served place whose bounding box contains location
+        (lat,long), or None. If several do, the smallest one is chosen. """
+
+        found, best = None, None
+        for place in self.places:
+            bounds = self._cities[place].bounds()
+            if bounds is None:
+                continue
+            south, west, north, east = bounds
+            if south <= location[0] <= north and west <= location[1] <= east:
+                area = (north - south) * (east - west)
+                if best is None or area < best:
+                    found, best = place, area
+        return found
+
+    def stats(self):
+        """ Returns a dict with the stats of every city (see CityGraph.stats)
+        and the total resident size of the loaded ones. """
+
+        cities = [self._cities[place].stats() for place in self.places]
+        resident = sum(city['nbytes'] for city in cities if city['loaded'])
+        return {'cities': cities, 'resident': resident,
+                'budget': self.budget}
+
+    def _city(self, place):
+        if place is None:
+            place = self.default
+        return self._cities[place]  # KeyError if the city is not served
+
+    def _touch(self, place):
+        with self._lock:
+            if place in self._recent:
+                self._recent.move_to_end(place)
+
+    def _loaded(self, city):
+        """ Called when the graph of a city has been loaded: evicts the least
+        recently used cities until the loaded ones fit in the budget. """
+
+        with self._lock:
+            self._recent[city.place] = city
+            self._recent.move_to_end(city.place)
+
+            resident = sum(loaded.nbytes or 0
+                           for loaded in self._recent.values())
+            while resident > self.budget and len(self._recent) > 1:
+                place, evicted = self._recent.popitem(last=False)
+                resident -= evicted.nbytes or 0
+                evicted.unload()
+                print("%s evicted" % place)
+
+
+##########################################################################
@@ -0,0 +1,131 @@
+# ----------------------- ROUTECACHE MODULE -----------------------
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" This is the python script of the routecache module. It defines RouteCache,
+an in-memory LRU cache of the routes computed by the guide module.
+
+Routes are keyed by the graph nodes they join (the nodes the user and the
+destination are snapped to), the version of the graph (see
+compact.CompactGraph.version) and the routing options, so the part of a
+route that does not depend on the exact locations of the user and the
+destination is only computed once. The cache is bounded both by number of
+entries and by (estimated) bytes, and the routes of a graph can be dropped
+at once when the graph changes. """
+
+
+import sys  # standard library
+import threading
+from collections import OrderedDict
+
+
+__title__ = "Routecache"
+__author__ = "Pau Matas and Tomás Gadea"
+__maintainer__ = "Pau Matas and Tomás Gadea"
+__email__ = "paumatasalbi@gmail.com and 01tomas.gadea@gmail.com"
+__status__ = "Production"
+
+
+# ---------------------------- Public Functions --------------------------
+
+
+def route_nbytes(path, edges, coords):
+    """ Returns an estimate of the bytes used by a cached route: its node
+    path, the attribute dicts of its edges and the coordinates of its nodes.
+    """
+
+    nbytes = sys.getsizeof(path) + sum(sys.getsizeof(node) for node in path)
+    nbytes += sys.getsizeof(edges) + sum(
+        sys.getsizeof(edge) + sum(sys.getsizeof(value)
+                                  for value in edge.values())
+        for edge in edges)
+    nbytes += sys.getsizeof(coords) + len(coords) * (
+        sys.getsizeof((0.0, 0.0)) + 2 * sys.getsizeof(0.0))
+    return nbytes
+
+
+# ------------------------------ Route cache -----------------------------
+
+
+class RouteCache:
+    """ LRU cache of routes.
+
+    size is the max number of routes kept and max_bytes the max sum of their
+    estimated sizes. Keys are tuples (src, dst, version, *options); values
+    are anything, stored with the size given to put(). """
+
+    def __init__(self, size=4096, max_bytes=64 * 2**20):
+        self.size = size
+        self.max_bytes = max_bytes
+
+        self._routes = OrderedDict()  # key -> (value, nbytes)
+        self._nbytes = 0
+        self._lock = threading.Lock()
+        self._counters = dict.fromkeys(
+            ('hits', 'misses', 'evictions', 'invalidations'), 0)
+
+    def get(self, key):
+        """ Returns the route stored with key, or None if there is none. """
+
+        with self._lock:
+            entry = self._routes.get(key)
+            if entry is None:
+                self._counters['misses'] += 1
+                return None
+
+            self._routes.move_to_end(key)
+            self._counters['hits'] += 1
+            return entry[0]
+
+    def put(self, key, value, nbytes=0):
+        """ Stores a route of (estimated) nbytes bytes with key, evicting the
+        least recently used routes if the cache is full. Routes larger than
+        the whole cache are not stored. """
+
+        if nbytes > self.max_bytes:
+            return
+
+        with self._lock:
+            old = self._routes.pop(key, None)
+            if old is not None:
+                self._nbytes -= old[1]
+
+            self._routes[key] = (value, nbytes)
+            self._nbytes += nbytes
+
+            while len(self._routes) > self.size or \
+                    self._nbytes > self.max_bytes:
+                evicted, (value, size) = self._routes.popitem(last=False)
+                self._nbytes -= size
+                self._counters['evictions'] += 1
+
+    def invalidate(self, version=None):
+        """ Removes the routes of a graph version (every route if version is
+        None). Returns the number of routes removed. """
+
+        with self._lock:
+            if version is None:
+                keys = list(self._routes)
+            else:
+                keys = [key for key in self._routes if key[2] == version]
+
+            for key in keys:
+                self._nbytes -= self._routes.pop(key)[1]
+            self._counters['invalidations'] += len(keys)
+        return len(keys)
+
+    def stats(self):
+        """ Returns a dict with the counters of the cache, its number of
+        routes, their estimated bytes and the hit rate. """
+
+        with self._lock:
+            stats = dict(self._counters)
+            stats['size'] = len(self._routes)
+            stats['nbytes'] = self._nbytes
+
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = stats['hits'] / lookups if lookups else 0.0
+        return stats
+
+
+##########################################################################
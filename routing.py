@@ -0,0 +1,371 @@
+# ----------------------- ROUTING MODULE -----------------------
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" This is the python script of the routing module. It implements the shortest
+path algorithms used by the guide module on compact graphs (see compact
+module): a bidirectional A* search guided by the haversine distance, a plain
+bidirectional Dijkstra search, a breadth first search (fewest edges), a
+one-to-many Dijkstra search for batches of routes and a resumable
+many-to-one search (ReverseTree) to reroute users to their destination.
+
+The searches read the edges of every node they settle straight from the CSR
+arrays of the graph (forward and reverse), one slice per node, so no process
+holds a copy of the adjacency: the memory-mapped arrays are shared by all of
+them and nothing has to be built before the first search. """
+
+
+import heapq  # standard library
+import math
+import threading
+import weakref
+
+import numpy as np  # 3rd party packages
+
+
+__title__ = "Routing"
+__author__ = "Pau Matas and Tomás Gadea"
+__maintainer__ = "Pau Matas and Tomás Gadea"
+__email__ = "paumatasalbi@gmail.com and 01tomas.gadea@gmail.com"
+__status__ = "Production"
+
+
+# Earth polar radius in meters. It is the smallest radius of the Earth, so
+# haversine distances computed with it never exceed the length of the streets
+# (which keeps the A* heuristic admissible).
+EARTH_RADIUS = 6356752.3
+
+ALGORITHMS = ('astar', 'dijkstra', 'bfs')
+WEIGHTS = ('length', None)
+
+MAX_TREE_NODES = 4096  # nodes a ReverseTree settles before using A* instead
+MAX_UNREACHABLE = 1024  # sources without path remembered by a ReverseTree
+
+# Adjacency views of every graph used so far (freed with the graph):
+_adjacencies = weakref.WeakKeyDictionary()
+
+
+# ---------------------------- Public Functions --------------------------
+
+
+def shortest_path(graph, source, target, weight='length', algorithm='astar'):
+    """ Returns the shortest path (list of nodes) from source to target in a
+    compact graph.
+
+    weight is 'length' (meters) or None (fewest edges, in which case the
+    algorithm is always a breadth first search). algorithm is one of
+    'astar' (bidirectional A* with haversine heuristic), 'dijkstra'
+    (bidirectional Dijkstra) or 'bfs'. Raises ValueError if target can not be
+    reached from source or if the options are unknown. """
+
+    if weight not in WEIGHTS:
+        raise ValueError('unknown weight: %s' % weight)
+    if algorithm not in ALGORITHMS:
+        raise ValueError('unknown algorithm: %s' % algorithm)
+
+    source, target = int(source), int(target)
+
+    if weight is None or algorithm == 'bfs':
+        return graph.shortest_path(source, target)
+
+    adj = adjacency(graph)
+    if algorithm == 'astar':
+        potential = _potential(adj, source, target)
+    else:
+        potential = None
+
+    return _bidirectional(adj, source, target, potential)
+
+
+def shortest_paths(graph, source, targets, weight='length'):
+    """ Returns a dict {target: path} with the shortest paths (lists of
+    nodes) from source to every reachable node of targets in a compact graph,
+    all taken from a single shortest path tree (one-to-many Dijkstra, which
+    stops once every target has been reached). weight is as in
+    shortest_path. """
+
+    if weight not in WEIGHTS:
+        raise ValueError('unknown weight: %s' % weight)
+
+    source = int(source)
+    pending = set(int(target) for target in targets)
+    succ = adjacency(graph).succ
+
+    dist = {source: 0.0}
+    parent = {source: None}
+    done = set()
+    heap = [(0.0, source)]
+
+    while heap and pending:
+        d, node = heapq.heappop(heap)
+        if node in done:
+            continue
+        done.add(node)
+        pending.discard(node)
+
+        for nxt, w in succ[node]:
+            nd = d + (w if weight is not None else 1.0)
+            if nd < dist.get(nxt, math.inf):
+                dist[nxt] = nd
+                parent[nxt] = node
+                heapq.heappush(heap, (nd, nxt))
+
+    paths = {}
+    for target in targets:
+        target = int(target)
+        if target in done:
+            path = [target]
+            while parent[path[-1]] is not None:
+                path.append(parent[path[-1]])
+            paths[target] = path[::-1]
+    return paths
+
+
+def path_length(graph, path):
+    """ Returns the sum of the lengths (meters) of the edges along a path. """
+
+    adj = adjacency(graph)
+    return sum(adj.edge_length(u, v) for u, v in zip(path[:-1], path[1:]))
+
+
+def adjacency(graph):
+    """ Returns the Adjacency (forward and reverse edges) of a compact
+    graph. """
+
+    adj = _adjacencies.get(graph)
+    if adj is None:
+        adj = _adjacencies[graph] = Adjacency(graph)
+    return adj
+
+
+# ------------------------------ Adjacency -------------------------------
+
+
+class Adjacency:
+    """ Forward and reverse adjacency of a compact graph, read from its
+    arrays (nothing is copied).
+
+    succ[u] iterates over the pairs (v, length) of edges u->v and pred[v]
+    over the pairs (u, length) of the same edges seen from v. """
+
+    def __init__(self, graph):
+        self.succ = _Edges(graph.indptr, graph.indices, graph.length)
+        self.pred = _Edges(graph.rindptr, graph.rindices, graph.rlength)
+        self.lat = np.asarray(graph.lat)
+        self.lon = np.asarray(graph.lon)
+
+    def edge_length(self, node1, node2):
+        """ Returns the length of the edge node1->node2. """
+
+        for v, w in self.succ[node1]:
+            if v == node2:
+                return w
+        raise KeyError((node1, node2))
+
+    def distance(self, node1, node2):
+        """ Returns a lower bound of the length of any path between two nodes:
+        their haversine distance in meters on the polar radius sphere. """
+
+        lat1 = math.radians(self.lat.item(node1))
+        lat2 = math.radians(self.lat.item(node2))
+        dlon = math.radians(self.lon.item(node2) - self.lon.item(node1))
+        h = math.sin((lat2 - lat1) / 2)**2 + \
+            math.cos(lat1) * math.cos(lat2) * math.sin(dlon / 2)**2
+        return 2 * EARTH_RADIUS * math.asin(math.sqrt(min(h, 1.0)))
+
+
+class _Edges:
+    """ Edges of every node of a CSR adjacency: edges[u] iterates over the
+    pairs (v, length) of the positions indptr[u]..indptr[u + 1] - 1. """
+
+    def __init__(self, indptr, indices, length):
+        # plain views: slicing a memmap is slower and the pages are the same
+        self.indptr = np.asarray(indptr)
+        self.indices = np.asarray(indices)
+        self.length = np.asarray(length)
+
+    def __len__(self):
+        return len(self.indptr) - 1
+
+    def __getitem__(self, node):
+        start, stop = self.indptr.item(node), self.indptr.item(node + 1)
+        return zip(self.indices[start:stop].tolist(),
+                   self.length[start:stop].tolist())
+
+
+# ------------------------------ Reverse tree ----------------------------
+
+
+class ReverseTree:
+    """ Shortest path tree towards a target node of a compact graph, grown on
+    demand: a reverse Dijkstra search from target that is resumed (never
+    restarted) whenever a path from a node it has not reached yet is asked
+    for. Paths from nodes already reached cost only their length.
+
+    The tree stops growing once it has settled max_nodes nodes: paths from
+    farther nodes are searched with A* instead. The sources from which the
+    target can not be reached are remembered, so asking again is free. The
+    tree can be shared by several threads. """
+
+    def __init__(self, graph, target, max_nodes=MAX_TREE_NODES):
+        self.target = int(target)
+        self.max_nodes = max_nodes
+        self._adj = adjacency(graph)
+        self._dist = {self.target: 0.0}  # reached node -> distance to target
+        self._next = {}  # settled node -> next node towards target
+        self._heap = [(0.0, self.target, None)]  # (distance, node, next)
+        self._unreachable = set()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._next)
+
+    def nbytes(self):
+        """ Returns an estimate of the bytes used by the tree: about 100
+        bytes per entry of its dicts (key, value and slot) and heap. """
+
+        return 100 * (len(self._dist) + len(self._next) + len(self._heap) +
+                      len(self._unreachable))
+
+    def path_from(self, source):
+        """ Returns the shortest path (list of nodes) from source to the
+        target. Raises ValueError if target can not be reached from source.
+        """
+
+        source = int(source)
+        with self._lock:
+            reached = self._grow(source)
+            if reached:
+                path = [source]
+                while path[-1] != self.target:
+                    path.append(self._next[path[-1]])
+                return path
+            if source in self._unreachable or not self._heap:
+                raise ValueError('no path from %s to %s' %
+                                 (source, self.target))
+
+        try:  # too far for the tree
+            return _bidirectional(self._adj, source, self.target,
+                                  _potential(self._adj, source, self.target))
+        except ValueError:
+            with self._lock:
+                if len(self._unreachable) >= MAX_UNREACHABLE:
+                    self._unreachable.clear()
+                self._unreachable.add(source)
+            raise
+
+    def distance_from(self, source):
+        """ Returns the length of the shortest path from source to target.
+        """
+
+        path = self.path_from(source)
+        if int(source) in self._next:
+            return self._dist[int(source)]
+        return sum(self._adj.edge_length(u, v)
+                   for u, v in zip(path[:-1], path[1:]))
+
+    def _grow(self, source):
+        """ Settles nodes until source is settled, the whole tree is or it
+        has max_nodes nodes. Returns True if source is settled. """
+
+        heap, dist, nxt, pred = self._heap, self._dist, self._next, \
+            self._adj.pred
+
+        while source not in nxt and heap and len(nxt) < self.max_nodes:
+            d, node, following = heapq.heappop(heap)
+            if node in nxt:
+                continue
+            nxt[node] = following
+
+            for prev, w in pred[node]:
+                nd = d + w
+                if nd < dist.get(prev, math.inf):
+                    dist[prev] = nd
+                    heapq.heappush(heap, (nd, prev, node))
+
+        return source in nxt
+
+
+# ------------------------------ Private functions -----------------------
+
+
+def _potential(adj, source, target):
+    """ Returns the potential function of the forward search of bidirectional
+    A*: the average of the estimates to target and from source. The reverse
+    search uses its opposite, so both searches are consistent. """
+
+    cache = {}
+
+    def potential(node):
+        p = cache.get(node)
+        if p is None:
+            p = cache[node] = (adj.distance(node, target) -
+                               adj.distance(source, node)) / 2
+        return p
+
+    return potential
+
+
+def _bidirectional(adj, source, target, potential=None):
+    """ Bidirectional search from source and target with the given forward
+    potential (None for Dijkstra). Returns the shortest path as a list of
+    nodes. Raises ValueError if there is no path. """
+
+    if source == target:
+        return [source]
+
+    if potential is None:
+        def potential(node):
+            return 0.0
+
+    dist = ({source: 0.0}, {target: 0.0})  # forward, reverse distances
+    parent = ({source: None}, {target: None})
+    done = (set(), set())
+    heaps = ([(potential(source), source)], [(-potential(target), target)])
+    edges = (adj.succ, adj.pred)
+    sign = (1, -1)  # the reverse potential is the opposite of the forward
+
+    best, meet = math.inf, None
+
+    while heaps[0] and heaps[1]:
+        # Stop when no shorter path can be found by any of the searches:
+        if heaps[0][0][0] + heaps[1][0][0] >= best:
+            break
+
+        # Expand the search with the smaller frontier:
+        d = 0 if len(heaps[0]) <= len(heaps[1]) else 1
+        key, node = heapq.heappop(heaps[d])
+        if node in done[d]:
+            continue
+        done[d].add(node)
+
+        dist_d, dist_o, parent_d = dist[d], dist[1 - d], parent[d]
+        base = dist_d[node]
+
+        for nxt, w in edges[d][node]:
+            nd = base + w
+            if nd < dist_d.get(nxt, math.inf):
+                dist_d[nxt] = nd
+                parent_d[nxt] = node
+                heapq.heappush(heaps[d], (nd + sign[d] * potential(nxt), nxt))
+
+                if nxt in dist_o and nd + dist_o[nxt] < best:
+                    best, meet = nd + dist_o[nxt], nxt
+
+    if meet is None:
+        raise ValueError('no path from %s to %s' % (source, target))
+
+    forward = [meet]
+    while parent[0][forward[-1]] is not None:
+        forward.append(parent[0][forward[-1]])
+
+    backward = []
+    node = parent[1][meet]
+    while node is not None:
+        backward.append(node)
+        node = parent[1][node]
+
+    return forward[::-1] + backward
+
+
+##########################################################################
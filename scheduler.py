@@ -0,0 +1,204 @@
+# ----------------------- SCHEDULER MODULE -----------------------
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" This is the python script of the scheduler module. It defines Scheduler,
+which takes the work of the bot out of the telegram dispatcher threads.
+
+Every task belongs to a user and is run in a thread pool (good for I/O, as
+sending messages), always after the previous tasks of the same user have
+finished, so each user's updates are handled in order while different users
+don't wait for each other. A task can replace the last waiting task of its
+user if both have the same coalesce key (e.g. only the newest location of a
+user is worth handling). Inside a task, CPU-bound work (routing and
+rendering) can be sent to a process pool with cpu(). The number of pending
+tasks is bounded: when the scheduler is full, submit() waits or fails.
+
+A Scheduler that has not been started runs everything in the caller thread,
+which is handy for testing and benchmarking. """
+
+
+import threading  # standard library
+import traceback
+import multiprocessing
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+
+import metrics  # local source
+
+
+__title__ = "Scheduler"
+__author__ = "Pau Matas and Tomás Gadea"
+__maintainer__ = "Pau Matas and Tomás Gadea"
+__email__ = "paumatasalbi@gmail.com and 01tomas.gadea@gmail.com"
+__status__ = "Production"
+
+
+# ------------------------------ Errors ----------------------------------
+
+
+class Busy(Exception):
+    """ Raised when a task is submitted and the scheduler is full. """
+    pass
+
+
+# ------------------------------ Scheduler -------------------------------
+
+
+class Scheduler:
+    """ Per-user ordered task scheduler with a thread pool for I/O and a
+    process pool for CPU-bound work.
+
+    cpu_workers is the number of processes (0 to run CPU work in the task
+    thread), io_workers the number of threads, max_pending the max number of
+    tasks waiting or running and max_user_pending the max of a single user.
+    """
+
+    def __init__(self, cpu_workers=2, io_workers=8, max_pending=256,
+                 max_user_pending=16):
+        self.cpu_workers = cpu_workers
+        self.io_workers = io_workers
+        self.max_pending = max_pending
+        self.max_user_pending = max_user_pending
+
+        self._cpu = None  # pools, created by start()
+        self._io = None
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._lock = threading.Lock()
+        self._queues = {}  # user -> deque of (future, function, args, kwargs,
+        # coalesce key)
+        self._counters = dict.fromkeys(('done', 'failed', 'rejected',
+                                        'coalesced'), 0)
+
+    def start(self, initializer=None, initargs=()):
+        """ Creates the pools. Until then tasks are run in the caller. Every
+        process of the pool calls initializer(*initargs) when it starts. """
+
+        if self.cpu_workers:
+            # spawn: forking a process with running threads is not safe
+            context = multiprocessing.get_context('spawn')
+            self._cpu = ProcessPoolExecutor(self.cpu_workers,
+                                            mp_context=context,
+                                            initializer=initializer,
+                                            initargs=initargs)
+        self._io = ThreadPoolExecutor(self.io_workers,
+                                      thread_name_prefix='task')
+
+    def shutdown(self, wait=True):
+        """ Stops the pools (waiting for the running tasks if wait). """
+
+        if self._io is not None:
+            self._io.shutdown(wait)
+            self._io = None
+        if self._cpu is not None:
+            self._cpu.shutdown(wait)
+            self._cpu = None
+
+    def submit(self, user, function, *args, block=True, timeout=None,
+               coalesce=None, **kwargs):
+        """ Schedules function(*args, **kwargs) as a task of user, to be run
+        after the previous tasks of the same user. Returns a Future with its
+        result. If the scheduler is full waits for a free slot (at most
+        timeout seconds) when block is True; raises Busy otherwise.
+
+        If coalesce is not None and the last task of user is waiting (not
+        running) with the same coalesce key, this task takes its place and
+        the Future of the replaced one is cancelled. """
+
+        future = Future()
+
+        if self._io is None:  # not started: run it now
+            self._execute(future, function, args, kwargs)
+            return future
+
+        if coalesce is not None:
+            with self._lock:
+                queue = self._queues.get(user)
+                # queue[0] is running, the others are waiting:
+                if queue is not None and len(queue) > 1 and \
+                        queue[-1][4] == coalesce:
+                    replaced = queue[-1][0]
+                    queue[-1] = (future, function, args, kwargs, coalesce)
+                    self._counters['coalesced'] += 1
+                else:
+                    replaced = None
+            if replaced is not None:
+                replaced.cancel()
+                return future
+
+        if not self._slots.acquire(block, timeout):
+            self._count('rejected')
+            raise Busy('%d tasks pending' % self.max_pending)
+
+        with self._lock:
+            queue = self._queues.setdefault(user, deque())
+            if len(queue) >= self.max_user_pending:
+                self._slots.release()
+                self._counters['rejected'] += 1
+                raise Busy('%d tasks pending for %s' % (len(queue), user))
+
+            queue.append((future, function, args, kwargs, coalesce))
+            if len(queue) == 1:  # no task of this user running
+                self._io.submit(self._run, user)
+
+        return future
+
+    def cpu(self, function, *args, **kwargs):
+        """ Runs function(*args, **kwargs) in the process pool and returns its
+        result. Arguments and result must be picklable (compact graphs loaded
+        from disk are sent as their path, see compact.attach). The metrics
+        recorded by the process are merged into the ones of this process. """
+
+        if self._cpu is None:
+            return function(*args, **kwargs)
+        result, recorded = self._cpu.submit(metrics.collect, function, *args,
+                                            **kwargs).result()
+        metrics.recorded.merge(recorded)
+        return result
+
+    def stats(self):
+        """ Returns a dict with the number of pending tasks, of users with
+        pending tasks and the counters of done, failed, rejected and coalesced
+        tasks. """
+
+        with self._lock:
+            stats = dict(self._counters)
+            stats['users'] = len(self._queues)
+            stats['pending'] = sum(len(queue)
+                                   for queue in self._queues.values())
+        return stats
+
+    def _run(self, user):
+        """ Runs the tasks of user, in order, until there are no more. """
+
+        while True:
+            with self._lock:
+                future, function, args, kwargs = self._queues[user][0][:4]
+
+            self._execute(future, function, args, kwargs)
+            self._slots.release()
+
+            with self._lock:
+                queue = self._queues[user]
+                queue.popleft()
+                if not queue:
+                    del self._queues[user]
+                    return
+
+    def _execute(self, future, function, args, kwargs):
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            future.set_result(function(*args, **kwargs))
+            self._count('done')
+        except BaseException as error:
+            print(traceback.format_exc())
+            future.set_exception(error)
+            self._count('failed')
+
+    def _count(self, counter):
+        with self._lock:
+            self._counters[counter] += 1
+
+
+##########################################################################
@@ -0,0 +1,222 @@
+# ----------------------- SESSIONS MODULE -----------------------
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" This is the python script of the sessions module. It keeps the journeys
+of the users of the bot across restarts.
+
+A session is the part of the telegram user_data of a user that can not be
+computed again (see PERSISTED): the destination, the directions, the current
+checkpoint... SessionStore keeps them in memory only; SQLiteSessionStore
+also writes them to a SQLite database. Writes are batched (write-behind): a
+background thread writes every changed session at most every few seconds in
+a single transaction, so location updates don't cost a disk write each. At
+worst, a crash loses the changes of those last seconds, never a whole
+session (SQLite transactions are atomic). """
+
+
+import time  # standard library
+import pickle
+import sqlite3
+import threading
+
+
+__title__ = "Sessions"
+__author__ = "Pau Matas and Tomás Gadea"
+__maintainer__ = "Pau Matas and Tomás Gadea"
+__email__ = "paumatasalbi@gmail.com and 01tomas.gadea@gmail.com"
+__status__ = "Production"
+
+
+# Keys of user_data that are saved. The others are indexes computed from
+# these ones (checkpoints, route) and are built again on restore.
+PERSISTED = ('address', 'city', 'city_choice', 'journey_city', 'destination',
+             'directions', 'checkpoint', 'location', 'test')
+
+
+# ---------------------------- Public Functions --------------------------
+
+
+def session_of(user_data):
+    """ Returns the session (dict of the persisted keys) of a user_data. """
+
+    return {key: user_data[key] for key in PERSISTED if key in user_data}
+
+
+# ------------------------------ Session stores --------------------------
+
+
+class SessionStore:
+    """ Sessions kept in memory only (they are lost on restart).
+
+    Every store has the same interface: put() and delete() change the
+    session of a user, load() returns every session and close() writes the
+    pending changes and frees the store. """
+
+    def __init__(self):
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def put(self, user, session):
+        """ Saves the session (dict) of a user. An empty session deletes it.
+        """
+
+        if not session:
+            self.delete(user)
+            return
+        with self._lock:
+            self._sessions[user] = dict(session)
+
+    def delete(self, user):
+        """ Removes the session of a user. """
+
+        with self._lock:
+            self._sessions.pop(user, None)
+
+    def load(self):
+        """ Returns a dict {user: session} with every saved session. """
+
+        with self._lock:
+            return {user: dict(session)
+                    for user, session in self._sessions.items()}
+
+    def flush(self):
+        """ Writes the pending changes (nothing to do in memory). """
+
+        pass
+
+    def close(self):
+        """ Writes the pending changes and frees the store. """
+
+        self.flush()
+
+
+class SQLiteSessionStore(SessionStore):
+    """ Sessions saved in a SQLite database (filename).
+
+    Changes are written by a background thread every interval seconds.
+    Sessions not changed for ttl seconds are not restored. Several processes
+    (the shards of the bot) can share the database: a write waits up to
+    timeout seconds for the others' to end, and if it still fails the
+    changes are kept pending for the next flush. """
+
+    def __init__(self, filename='sessions.sqlite', interval=5.0,
+                 ttl=7 * 24 * 3600, timeout=30.0):
+        SessionStore.__init__(self)
+        self.filename = filename
+        self.interval = interval
+        self.ttl = ttl
+
+        self._pending = {}  # user -> (session or None to delete, time)
+        self._db = sqlite3.connect(filename, timeout=timeout,
+                                   check_same_thread=False)
+        self._db.execute('PRAGMA busy_timeout=%d' % int(timeout * 1000))
+        _set_wal(self._db, timeout)
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS sessions ('
+                         'user INTEGER PRIMARY KEY, data BLOB, '
+                         'updated REAL)')
+        self._db.commit()
+        self._db_lock = threading.Lock()  # serializes the writes
+
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._write_behind,
+                                        name='sessions', daemon=True)
+        self._thread.start()
+
+    def put(self, user, session):
+        if not session:
+            self.delete(user)
+            return
+        with self._lock:
+            self._pending[user] = (dict(session), time.time())
+
+    def delete(self, user):
+        with self._lock:
+            self._pending[user] = (None, time.time())
+
+    def load(self):
+        """ Returns a dict {user: session} with every saved session that has
+        changed in the last ttl seconds (the older ones are deleted). """
+
+        self.flush()
+        with self._db_lock:
+            self._db.execute('DELETE FROM sessions WHERE updated < ?',
+                             (time.time() - self.ttl,))
+            self._db.commit()
+            rows = self._db.execute('SELECT user, data FROM sessions') \
+                .fetchall()
+
+        sessions = {}
+        for user, data in rows:
+            try:
+                sessions[user] = pickle.loads(data)
+            except Exception:  # written by an incompatible version
+                print("session of", user, "could not be restored")
+        return sessions
+
+    def flush(self):
+        """ Writes the pending changes in a single transaction. If it fails
+        they are kept pending (unless changed again meanwhile). """
+
+        with self._db_lock:  # flushes are written in order
+            with self._lock:
+                pending, self._pending = self._pending, {}
+            if not pending:
+                return
+
+            # Serialized out of the lock, puts don't wait for it:
+            rows = [(user, None if session is None else
+                     pickle.dumps(session, pickle.HIGHEST_PROTOCOL), updated)
+                    for user, (session, updated) in pending.items()]
+
+            try:
+                with self._db:  # one transaction
+                    self._db.executemany(
+                        'DELETE FROM sessions WHERE user = ?',
+                        [(user,) for user, data, updated in rows
+                         if data is None])
+                    self._db.executemany(
+                        'INSERT OR REPLACE INTO sessions VALUES (?, ?, ?)',
+                        [row for row in rows if row[1] is not None])
+            except Exception:
+                with self._lock:
+                    for user, entry in pending.items():
+                        self._pending.setdefault(user, entry)
+                raise
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+        self.flush()
+        with self._db_lock:
+            self._db.close()
+
+    def _write_behind(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.flush()
+            except Exception as error:  # disk full, locked database...
+                print("sessions could not be saved (retrying):", error)
+
+
+# ------------------------------ Private functions -----------------------
+
+
+def _set_wal(db, timeout):
+    """ Switches db to write-ahead logging. SQLite does not wait for the
+    busy timeout here when another process is switching it too (the shards
+    starting at once), so it is retried for up to timeout seconds. """
+
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            db.execute('PRAGMA journal_mode=WAL')
+            return
+        except sqlite3.OperationalError:
+            if time.monotonic() >= deadline:
+                raise
+            time.sleep(0.05)
+
+
+##########################################################################
@@ -0,0 +1,130 @@
+# ----------------------- SHARDING MODULE -----------------------
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" This is the python script of the sharding module. It defines Supervisor,
+which spreads the work of the bot over several worker processes, to use more
+than one core.
+
+The users are split in shards by their id (see shard_of) and every shard is
+served by its own worker process, so the updates of a user are always
+handled, in order, by the same process, which keeps the state of their
+journey. The city graphs are not copied: the supervisor makes sure they are
+saved on disk in the compact format and the workers load them memory-mapped
+and read-only, so all of them share the same pages of memory. """
+
+
+import signal  # standard library
+import multiprocessing
+
+import metrics  # local source
+
+
+__title__ = "Sharding"
+__author__ = "Pau Matas and Tomás Gadea"
+__maintainer__ = "Pau Matas and Tomás Gadea"
+__email__ = "paumatasalbi@gmail.com and 01tomas.gadea@gmail.com"
+__status__ = "Production"
+
+
+# ---------------------------- Public Functions --------------------------
+
+
+def shard_of(user, shards):
+    """ Returns the shard (0 to shards - 1) of a user id (None is shard 0).
+    """
+
+    return 0 if user is None else user % shards
+
+
+def serve(queue, handle):
+    """ Calls handle(item) with every item received from queue, until the
+    supervisor sends None. To be used by the target of the workers. """
+
+    while True:
+        item = queue.get()
+        if item is None:
+            return
+        handle(item)
+
+
+# ------------------------------ Supervisor ------------------------------
+
+
+class Supervisor:
+    """ Worker processes, one per shard of the users.
+
+    Every worker runs target(shard, shards, queue, *args) in a new process
+    (target and args must be picklable) and gets the items of its users from
+    queue (see serve). A worker that dies is started again with the next
+    item of its shard. """
+
+    def __init__(self, target, shards=2, args=()):
+        self.target = target
+        self.shards = shards
+        self.args = tuple(args)
+
+        # spawn: forking a process with running threads is not safe
+        self._context = multiprocessing.get_context('spawn')
+        self._queues = [self._context.Queue() for shard in range(shards)]
+        self._workers = [None] * shards
+
+    def start(self):
+        """ Starts every worker process. """
+
+        for shard in range(self.shards):
+            self._start(shard)
+
+    def submit(self, user, item):
+        """ Sends item (picklable) to the worker of the shard of user. """
+
+        shard = shard_of(user, self.shards)
+        worker = self._workers[shard]
+        if worker is not None and not worker.is_alive():
+            print("worker", shard, "died with exit code", worker.exitcode)
+            metrics.recorded.inc('shard_restarts_total', {'shard': shard})
+            self._start(shard)
+
+        self._queues[shard].put(item)
+        metrics.recorded.inc('shard_items_total', {'shard': shard})
+
+    def shutdown(self, timeout=30.0):
+        """ Asks every worker to finish the items it has received and to stop,
+        and waits for them (killing the ones still running after timeout
+        seconds). """
+
+        for shard, worker in enumerate(self._workers):
+            if worker is not None and worker.is_alive():
+                self._queues[shard].put(None)
+
+        for shard, worker in enumerate(self._workers):
+            if worker is None:
+                continue
+            worker.join(timeout)
+            if worker.is_alive():
+                print("worker", shard, "did not stop, killing it")
+                worker.terminate()
+                worker.join()
+            self._workers[shard] = None
+
+    def _start(self, shard):
+        worker = self._context.Process(
+            target=_run, name='shard-%d' % shard,
+            args=(self.target, shard, self.shards, self._queues[shard]) +
+            self.args)
+        worker.start()
+        self._workers[shard] = worker
+
+
+# ------------------------------ Private functions -----------------------
+
+
+def _run(target, shard, shards, queue, *args):
+    """ Main function of a worker process. Ctrl-C is ignored: the supervisor
+    stops the workers once it has stopped receiving work. """
+
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    target(shard, shards, queue, *args)
+
+
+##########################################################################
@@ -0,0 +1,359 @@
+# ----------------------- SPATIAL MODULE -----------------------
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" This is the python script of the spatial module. It defines NodeIndex, a
+KD-tree over the nodes of a city graph used to find the nearest nodes to a
+location in logarithmic time.
+
+Points are placed on the unit sphere (x, y, z), where the straight line
+(chord) distance grows with the haversine distance, so nearest neighbours are
+exact everywhere on Earth. The tree is implicit: it is fully described by a
+permutation of the nodes and the split dimension and value of every inner
+tree node, so it can be saved as .npy files next to the graph and
+memory-mapped back.
+
+It also defines RouteIndex, a grid over the segments of a journey used to
+find how far the user is from it. """
+
+
+import os  # standard library
+import json
+import heapq
+import math
+
+import numpy as np  # 3rd party packages
+
+import compact  # local source
+
+
+__title__ = "Spatial"
+__author__ = "Pau Matas and Tomás Gadea"
+__maintainer__ = "Pau Matas and Tomás Gadea"
+__email__ = "paumatasalbi@gmail.com and 01tomas.gadea@gmail.com"
+__status__ = "Production"
+
+
+EARTH_RADIUS = 6371008.8  # mean Earth radius in meters (as haversine uses)
+LEAF_SIZE = 16  # max number of points in a leaf of the tree
+CELL = 50.0  # side (meters) of the cells of the grid of a RouteIndex
+
+# Offsets (dx, dy) of a cell and the 8 cells around it:
+_AROUND = np.array([(dx, dy) for dx in (-1, 0, 1) for dy in (-1, 0, 1)])
+
+
+# ------------------------------ Node index ------------------------------
+
+
+class NodeIndex:
+    """ KD-tree over the nodes of a graph.
+
+    points holds the unit sphere coordinates of the nodes in tree order and
+    ids the node (by ID) of each of them. The tree node t covering the
+    positions [lo, hi) is a leaf if hi - lo <= leaf_size; otherwise it splits
+    them at mid = (lo + hi) // 2 into the tree nodes 2t + 1 ([lo, mid)) and
+    2t + 2 ([mid, hi)): points on the left have coordinate split_dim[t] lower
+    or equal than split_value[t] and points on the right greater or equal. """
+
+    def __init__(self, points, ids, split_dim, split_value,
+                 leaf_size=LEAF_SIZE):
+        self.points = points
+        self.ids = ids
+        self.split_dim = split_dim
+        self.split_value = split_value
+        self.leaf_size = leaf_size
+
+    def __len__(self):
+        return len(self.ids)
+
+    def nbytes(self):
+        """ Returns the size in bytes of the arrays of the index. """
+
+        return self.points.nbytes + self.ids.nbytes + \
+            self.split_dim.nbytes + self.split_value.nbytes
+
+    @classmethod
+    def build(cls, lats, lons, ids, leaf_size=LEAF_SIZE):
+        """ Returns the NodeIndex of the nodes ids with coordinates lats and
+        lons (in degrees). The ids must be integers (OSM node IDs or compact
+        graph indexes), so that the index saves as plain numeric arrays. """
+
+        points = _unit_vectors(np.asarray(lats, np.float64),
+                               np.asarray(lons, np.float64))
+        ids = np.asarray(ids, np.int64)
+        order = np.arange(len(ids))
+
+        n_leaves = max(1, -(-len(ids) // leaf_size))
+        split_dim = np.full(4 * n_leaves, -1, np.int8)
+        split_value = np.zeros(4 * n_leaves, np.float64)
+
+        stack = [(0, 0, len(ids))]
+        while stack:
+            t, lo, hi = stack.pop()
+            if hi - lo <= leaf_size:
+                continue
+
+            block = points[order[lo:hi]]
+            dim = int(np.argmax(block.max(axis=0) - block.min(axis=0)))
+            mid = (lo + hi) // 2
+
+            part = np.argpartition(block[:, dim], mid - lo)
+            order[lo:hi] = order[lo:hi][part]
+            split_dim[t] = dim
+            split_value[t] = points[order[mid], dim]
+
+            stack.append((2 * t + 1, lo, mid))
+            stack.append((2 * t + 2, mid, hi))
+
+        return cls(points[order], ids[order], split_dim, split_value,
+                   leaf_size)
+
+    @classmethod
+    def from_graph(cls, graph, leaf_size=LEAF_SIZE):
+        """ Returns the NodeIndex of a networkx (osmnx) graph or of a compact
+        graph (whose nodes are identified by their index). """
+
+        if isinstance(graph, compact.CompactGraph):
+            return cls.build(graph.lat, graph.lon, np.arange(len(graph.lat)),
+                             leaf_size)
+
+        nodes = list(graph.nodes)
+        lats = [graph.nodes[node]['y'] for node in nodes]
+        lons = [graph.nodes[node]['x'] for node in nodes]
+        return cls.build(lats, lons, nodes, leaf_size)
+
+    def nearest(self, location):
+        """ Returns the node (by ID) nearest to location (lat,long). """
+
+        return self.knearest(location, 1)[0][0]
+
+    def knearest(self, location, k):
+        """ Returns two lists: the k nodes (by ID) nearest to location
+        (lat,long) sorted by distance, and their distances in meters. """
+
+        query = _unit_vectors(np.array([location[0]], np.float64),
+                              np.array([location[1]], np.float64))[0]
+        found = self._search(query, min(k, len(self)))
+
+        nodes = [_as_id(self.ids[pos]) for chord2, pos in found]
+        meters = [float(_chord_to_meters(math.sqrt(chord2)))
+                  for chord2, pos in found]
+        return nodes, meters
+
+    def query(self, locations, k=1):
+        """ Batched knearest: given an array of m locations (lat,long) returns
+        two (m, k) arrays with the nearest nodes (by ID) of each location and
+        their distances in meters. """
+
+        locations = np.asarray(locations, np.float64).reshape(-1, 2)
+        queries = _unit_vectors(locations[:, 0], locations[:, 1])
+        k = min(k, len(self))
+
+        positions = np.empty((len(locations), k), np.int64)
+        chords2 = np.empty((len(locations), k), np.float64)
+        for i, query in enumerate(queries):
+            found = self._search(query, k)
+            chords2[i] = [chord2 for chord2, pos in found]
+            positions[i] = [pos for chord2, pos in found]
+
+        return self.ids[positions], _chord_to_meters(np.sqrt(chords2))
+
+    def save(self, directory):
+        """ Saves the index into directory as .npy files. """
+
+        os.makedirs(directory, exist_ok=True)
+        np.save(os.path.join(directory, 'points.npy'), self.points)
+        np.save(os.path.join(directory, 'ids.npy'), self.ids)
+        np.save(os.path.join(directory, 'split_dim.npy'), self.split_dim)
+        np.save(os.path.join(directory, 'split_value.npy'), self.split_value)
+
+        f = open(os.path.join(directory, 'meta.json'), 'w')
+        json.dump({'leaf_size': self.leaf_size}, f)
+        f.close()
+
+    @classmethod
+    def load(cls, directory, mmap=True):
+        """ Returns the NodeIndex saved in directory (memory-mapped if mmap is
+        True). Raises FileNotFoundError if there is no index there. """
+
+        f = open(os.path.join(directory, 'meta.json'), 'r')
+        meta = json.load(f)
+        f.close()
+
+        mode = 'r' if mmap else None
+        arrays = [np.load(os.path.join(directory, key + '.npy'),
+                          mmap_mode=mode)
+                  for key in ('points', 'ids', 'split_dim', 'split_value')]
+
+        return cls(*arrays, leaf_size=meta['leaf_size'])
+
+    def _search(self, query, k):
+        """ Returns the list of pairs (squared chord distance, position) of the
+        k points nearest to query (unit vector), sorted by distance. """
+
+        points, leaf_size = self.points, self.leaf_size
+        split_dim, split_value = self.split_dim, self.split_value
+        best = []  # max heap of (-squared distance, position)
+
+        def visit(t, lo, hi):
+            if hi - lo <= leaf_size:
+                d2 = ((points[lo:hi] - query)**2).sum(axis=1).tolist()
+                for pos, value in enumerate(d2, lo):
+                    if len(best) < k:
+                        heapq.heappush(best, (-value, pos))
+                    elif value < -best[0][0]:
+                        heapq.heapreplace(best, (-value, pos))
+                return
+
+            dim = split_dim[t]
+            mid = (lo + hi) // 2
+            diff = query[dim] - split_value[t]
+
+            if diff < 0:
+                visit(2 * t + 1, lo, mid)
+                if len(best) < k or diff * diff < -best[0][0]:
+                    visit(2 * t + 2, mid, hi)
+            else:
+                visit(2 * t + 2, mid, hi)
+                if len(best) < k or diff * diff < -best[0][0]:
+                    visit(2 * t + 1, lo, mid)
+
+        visit(0, 0, len(points))
+        return sorted((-value, pos) for value, pos in best)
+
+
+# ------------------------------ Route index -----------------------------
+
+
+class RouteIndex:
+    """ Grid index over the segments of a route (a polyline of locations).
+
+    Locations are projected to meters on a plane (equirectangular projection
+    centered on the route, accurate at city scale) and every segment is put
+    in the grid cells (of side cell meters) its bounding box covers, so only
+    the segments around a location are looked at.
+
+    The grid is kept in CSR format, like the adjacency of compact graphs: the
+    segments of the cell with number keys[j] (see _cell_key) are
+    segments[starts[j]:starts[j + 1]]. """
+
+    def __init__(self, locations, cell=CELL):
+        locations = np.asarray(locations, np.float64).reshape(-1, 2)
+        if len(locations) == 1:  # a single point: a segment of length 0
+            locations = np.vstack([locations, locations])
+
+        self.cell = cell
+        self.coslat = math.cos(math.radians(float(locations[:, 0].mean())))
+        self.xy = self._project(locations)
+
+        start, end = self.xy[:-1], self.xy[1:]
+        low = np.floor(np.minimum(start, end) / cell).astype(np.int64)
+        high = np.floor(np.maximum(start, end) / cell).astype(np.int64)
+        self.origin = low.min(axis=0)  # first cell (cx, cy) of the grid
+        self.shape = high.max(axis=0) - self.origin + 1  # cells (x, y)
+
+        # One (cell, segment) pair per cell of the box of every segment:
+        width = high[:, 1] - low[:, 1] + 1
+        counts = (high[:, 0] - low[:, 0] + 1) * width
+        segment = np.repeat(np.arange(len(start)), counts)
+        offset = np.arange(len(segment)) - \
+            np.repeat(np.cumsum(counts) - counts, counts)
+        cx = low[segment, 0] + offset // width[segment]
+        cy = low[segment, 1] + offset % width[segment]
+        key = self._cell_key(cx, cy)
+
+        order = np.argsort(key, kind='stable')
+        self.keys, first = np.unique(key[order], return_index=True)
+        self.starts = np.append(first, len(order)).astype(np.int32)
+        self.segments = segment[order].astype(np.int32)
+
+    def __len__(self):
+        return len(self.xy) - 1
+
+    def nbytes(self):
+        """ Returns the size in bytes of the arrays of the index. """
+
+        return self.xy.nbytes + self.keys.nbytes + self.starts.nbytes + \
+            self.segments.nbytes
+
+    def distance(self, location):
+        """ Returns the segment i (from location i to i + 1 of the route)
+        nearest to location (lat,long) and its distance in meters. """
+
+        point = self._project(np.array([location], np.float64))[0]
+        cx, cy = (int(c) for c in np.floor(point / self.cell))
+
+        keys = self._cell_key(cx + _AROUND[:, 0], cy + _AROUND[:, 1])
+        found = np.minimum(np.searchsorted(self.keys, keys),
+                           len(self.keys) - 1)
+        found = found[(keys >= 0) & (self.keys[found] == keys)]
+
+        segments = [self.segments[self.starts[j]:self.starts[j + 1]]
+                    for j in found.tolist()]
+        if segments:
+            segments = np.unique(np.concatenate(segments))
+            meters = self._distances(point, segments)
+            nearest = int(np.argmin(meters))
+            # Exact: closer segments would be in one of these cells.
+            if meters[nearest] <= self.cell:
+                return int(segments[nearest]), float(meters[nearest])
+
+        segments = np.arange(len(self))
+        meters = self._distances(point, segments)
+        nearest = int(np.argmin(meters))
+        return nearest, float(meters[nearest])
+
+    def _cell_key(self, cx, cy):
+        """ Returns the number of the cell (cx, cy) of the grid (works on
+        arrays), or -1 if the cell is out of it. """
+
+        x, y = cx - self.origin[0], cy - self.origin[1]
+        inside = (x >= 0) & (x < self.shape[0]) & (y >= 0) & \
+            (y < self.shape[1])
+        return np.where(inside, x * self.shape[1] + y, -1)
+
+    def _project(self, locations):
+        """ Returns the (x, y) coordinates in meters of locations. """
+
+        radians = np.radians(locations) * EARTH_RADIUS
+        return np.column_stack([radians[:, 1] * self.coslat, radians[:, 0]])
+
+    def _distances(self, point, segments):
+        """ Returns the distances from point (x, y) to the given segments. """
+
+        start, end = self.xy[segments], self.xy[segments + 1]
+        direction = end - start
+        squared = (direction ** 2).sum(axis=1)
+        t = ((point - start) * direction).sum(axis=1) / \
+            np.where(squared > 0, squared, 1.0)
+        closest = start + np.clip(t, 0.0, 1.0)[:, None] * direction
+        return np.sqrt(((closest - point) ** 2).sum(axis=1))
+
+
+# ------------------------------ Private functions -----------------------
+
+
+def _unit_vectors(lats, lons):
+    """ Returns the (n, 3) array of unit sphere coordinates of the points with
+    latitudes lats and longitudes lons (arrays in degrees). """
+
+    lat, lon = np.radians(lats), np.radians(lons)
+    return np.column_stack((np.cos(lat) * np.cos(lon),
+                            np.cos(lat) * np.sin(lon),
+                            np.sin(lat)))
+
+
+def _chord_to_meters(chord):
+    """ Converts a chord length of the unit sphere into the great circle
+    distance in meters. Works on floats and on arrays. """
+
+    return 2 * EARTH_RADIUS * np.arcsin(np.minimum(chord / 2, 1.0))
+
+
+def _as_id(value):
+    """ Converts NumPy scalars into plain Python values. """
+
+    return value.item() if isinstance(value, np.generic) else value
+
+
+##########################################################################
@@ -0,0 +1,243 @@
+# ----------------------- TILES MODULE -----------------------
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" This is the python script of the tiles module. It defines TileCache, the
+source of the map tiles used to draw the images of the journeys, and
+TiledStaticMap, a StaticMap that reads its tiles from a TileCache instead of
+downloading them again on every render.
+
+A tile is looked up in three layers: an in-memory LRU dictionary, a tile
+directory on disk (zoom/x/y.png) and, if it is not in any of them, the tile
+server. In offline mode the tile server is never used, so the directory works
+as a local tile store. The url_template can also point to a local stand-in
+tile server. """
+
+
+import io  # standard library
+import os
+import math
+import threading
+from collections import OrderedDict
+
+import requests  # 3rd party packages
+from PIL import Image
+from staticmap import StaticMap
+
+
+__title__ = "Tiles"
+__author__ = "Pau Matas and Tomás Gadea"
+__maintainer__ = "Pau Matas and Tomás Gadea"
+__email__ = "paumatasalbi@gmail.com and 01tomas.gadea@gmail.com"
+__status__ = "Production"
+
+
+OSM_URL = "https://a.tile.openstreetmap.org/{z}/{x}/{y}.png"
+ZOOMS = range(12, 18)  # zoom levels of the images of city journeys
+
+_blank_tiles = {}  # tile size -> transparent PNG tile (see offline mode)
+
+
+# ------------------------------ Tile cache ------------------------------
+
+
+class TileCache:
+    """ Three layer (memory, disk, server) source of map tiles.
+
+    size is the max number of tiles kept in memory and directory the tile
+    directory on disk (None for no disk layer). If offline is True, tiles
+    that are not in memory nor on disk are not requested to the server. """
+
+    def __init__(self, url_template=OSM_URL, directory='tiles', size=512,
+                 offline=False, timeout=10, headers=None):
+        self.url_template = url_template
+        self.directory = directory
+        self.size = size
+        self.offline = offline
+        self.timeout = timeout
+        self.headers = headers or {'User-Agent': 'scarlett-guidebot'}
+
+        self._memory = OrderedDict()  # (z, x, y) -> bytes
+        self._lock = threading.Lock()
+        self._counters = dict.fromkeys(
+            ('memory_hits', 'disk_hits', 'downloads', 'failures'), 0)
+
+    def get(self, z, x, y):
+        """ Returns the content (bytes) of the tile z/x/y, or None if it can
+        not be found. """
+
+        key = (z, x, y)
+
+        with self._lock:
+            content = self._memory.get(key)
+            if content is not None:
+                self._memory.move_to_end(key)
+                self._counters['memory_hits'] += 1
+                return content
+
+        content = self._disk_get(key)
+        if content is not None:
+            self._count('disk_hits')
+        elif not self.offline:
+            content = self._download(key)
+            if content is not None:
+                self._disk_put(key, content)
+
+        if content is not None:
+            self._memory_put(key, content)
+        return content
+
+    def prefetch(self, south, west, north, east, zooms=ZOOMS,
+                 max_tiles=5000):
+        """ Downloads into the tile directory every tile of the bounding box
+        (in degrees) at the given zoom levels. Returns the number of tiles
+        that are now on disk. Raises ValueError if there would be more than
+        max_tiles tiles (please, respect the tile servers usage policies). """
+
+        keys = [(z, x, y) for z in zooms
+                for x, y in _tile_range(south, west, north, east, z)]
+        if len(keys) > max_tiles:
+            raise ValueError('%d tiles to prefetch (max %d)' %
+                             (len(keys), max_tiles))
+
+        stored = 0
+        for key in keys:
+            if self._disk_get(key, read=False) is not None:
+                stored += 1
+            elif not self.offline:
+                content = self._download(key)
+                if content is not None:
+                    self._disk_put(key, content)
+                    stored += 1
+        return stored
+
+    def stats(self):
+        """ Returns a dict with the counters of the cache and the number of
+        tiles in memory. """
+
+        with self._lock:
+            stats = dict(self._counters)
+            stats['memory_size'] = len(self._memory)
+        return stats
+
+    def _memory_put(self, key, content):
+        with self._lock:
+            self._memory[key] = content
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.size:
+                self._memory.popitem(last=False)  # least recently used
+
+    def _path(self, key):
+        return os.path.join(self.directory, str(key[0]), str(key[1]),
+                            str(key[2]) + '.png')
+
+    def _disk_get(self, key, read=True):
+        """ Returns the content of the tile on disk (or True if read is False),
+        None if it is not there. """
+
+        if self.directory is None:
+            return None
+        path = self._path(key)
+        if not os.path.isfile(path):
+            return None
+        if not read:
+            return True
+
+        f = open(path, 'rb')  # open on read mode
+        content = f.read()
+        f.close()
+        return content
+
+    def _disk_put(self, key, content):
+        if self.directory is None:
+            return
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # Write to a temporary file first so readers never see half a tile:
+        tmp = '%s.%d.tmp' % (path, threading.get_ident())
+        f = open(tmp, 'wb')  # open on write mode
+        f.write(content)
+        f.close()
+        os.replace(tmp, path)
+
+    def _download(self, key):
+        url = self.url_template.format(z=key[0], x=key[1], y=key[2])
+        try:
+            response = requests.get(url, timeout=self.timeout,
+                                    headers=self.headers)
+        except requests.RequestException:
+            response = None
+
+        if response is None or response.status_code != 200:
+            self._count('failures')
+            return None
+
+        self._count('downloads')
+        return response.content
+
+    def _count(self, counter):
+        with self._lock:
+            self._counters[counter] += 1
+
+
+# ------------------------------ Static map ------------------------------
+
+
+class TiledStaticMap(StaticMap):
+    """ StaticMap whose tiles come from a TileCache. The url_template of the
+    StaticMap is only used as the key 'z/x/y' of the tiles. If the cache is
+    offline, missing tiles are drawn blank instead of failing. """
+
+    def __init__(self, width, height, tile_cache, **kwargs):
+        StaticMap.__init__(self, width, height, url_template='{z}/{x}/{y}',
+                           **kwargs)
+        self.tile_cache = tile_cache
+
+    def get(self, url, **kwargs):
+        """ Returns the status code and content of the tile (see StaticMap).
+        """
+
+        z, x, y = (int(value) for value in url.split('/'))
+        content = self.tile_cache.get(z, x, y)
+        if content is None:
+            if self.tile_cache.offline:
+                return 200, _blank_tile(self.tile_size)
+            return 404, None
+        return 200, content
+
+
+# ------------------------------ Private functions -----------------------
+
+
+def _blank_tile(size):
+    """ Returns a transparent PNG tile of size x size pixels. """
+
+    if size not in _blank_tiles:
+        buffer = io.BytesIO()
+        Image.new('RGBA', (size, size), (0, 0, 0, 0)).save(buffer, 'PNG')
+        _blank_tiles[size] = buffer.getvalue()
+    return _blank_tiles[size]
+
+
+def _tile_range(south, west, north, east, z):
+    """ Returns the list of tiles (x, y) covering a bounding box at zoom z. """
+
+    x1, y1 = _tile_xy(north, west, z)
+    x2, y2 = _tile_xy(south, east, z)
+    return [(x, y) for x in range(x1, x2 + 1) for y in range(y1, y2 + 1)]
+
+
+def _tile_xy(lat, lon, z):
+    """ Returns the tile (x, y) that contains a point at zoom z (web mercator
+    projection, as used by StaticMap). """
+
+    n = 2 ** z
+    x = int((lon + 180.0) / 360.0 * n)
+    lat = math.radians(lat)
+    y = int((1.0 - math.log(math.tan(lat) + 1 / math.cos(lat)) / math.pi) / 2
+            * n)
+    return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+
+##########################################################################